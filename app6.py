@@ -1,12 +1,18 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mticker
 import os
+import hashlib
 
-# 確保中文字體顯示正常
-plt.rcParams['font.family'] = 'Microsoft JhengHei'
+# matplotlib 延遲到第一次繪圖才載入，中文字型於載入時解析一次
+from charts import plt, mticker
+
+from backtest_core import BacktestParams, data_fingerprint, date_range_bounds, month_numbers, run_backtest
+from indicators import SIGNALS, TIMEFRAMES, build_signal, sma
+from shared_cache import data_cache, result_cache
+from telemetry import PORT_ENV, start_metrics_server, telemetry
+# 其餘模組 (程序池、背景佇列、SQLite 執行紀錄、搜尋、壓力測試、投資組合、Bootstrap) 在用到的卡片中才匯入，
+# 不計入啟動時間；啟動時間預算見 startup_bench.py
 
 # ====================================
 # CSS 注入函式 (保持不變)
@@ -91,16 +97,124 @@ inject_custom_css()
 
 st.title("📈 台股加權指數回測系統")
 
+# Prometheus 端點 (選用)：只由 App 程序啟動，工作程序不會開啟
+if os.environ.get(PORT_ENV):
+    try:
+        start_metrics_server(os.environ[PORT_ENV])
+    except OSError as e:
+        st.warning(f"無法在埠號 {os.environ[PORT_ENV]} 啟動遙測端點：{e}")
+
 # 【🚨 檔案讀取修改區塊：優先從本地讀取 🚨】
 DATA_FILE = '加權指數資料.xlsx'
 data_source = None
 df = None
 
+def load_price_data(cache_key, reader):
+    """讀取並清理價格資料；同一份資料在所有 session 間只讀取一次 (回傳副本供本次執行修改)。"""
+    def compute():
+        with telemetry.timed('load', source=cache_key[0]) as event:
+            raw = reader()
+            event['rows'] = len(raw)
+        if raw.empty:
+            return raw
+        # 檢查並清理 DataFrame
+        raw.columns = ['日期', '收盤價']
+        raw['日期'] = pd.to_datetime(raw['日期'])
+        return raw.sort_values('日期').reset_index(drop=True)
+    return data_cache.get_or_compute(cache_key, compute).copy()
+
+def market_tables(df, data_fp):
+    """只依價格資料、與策略參數無關的彙總 (卡片 3、10、11、12)；同一份資料只計算一次。"""
+    def compute():
+        with telemetry.timed('market_tables', rows=len(df)):
+            dates = df['日期']
+            # 每年指數漲跌幅
+            yearly_index = df.groupby(dates.dt.year.rename('年份')).agg({'收盤價': ['first', 'last']})
+            yearly_index.columns = ['年初收盤', '年末收盤']
+            yearly_index['指數漲跌幅 (%)'] = (yearly_index['年末收盤'] / yearly_index['年初收盤'] - 1) * 100
+            # 每月指數漲跌幅
+            monthly_index = df.groupby(dates.dt.to_period('M').rename('月份')).agg({'收盤價': ['first', 'last']})
+            monthly_index.columns = ['月初收盤', '月末收盤']
+            monthly_index['指數漲跌幅 (%)'] = (monthly_index['月末收盤'] / monthly_index['月初收盤'] - 1) * 100
+            # 每月漲跌幅分布 (1% 一個區間)
+            bins = list(range(-20, 22))  # -20% ~ 21%
+            labels = [f"{i}%" for i in bins[:-1]]
+            buckets = pd.cut(monthly_index['指數漲跌幅 (%)'], bins=bins, right=False, labels=labels)
+            bucket_counts = buckets.value_counts().sort_index()
+            bucket_pct = (bucket_counts / len(monthly_index) * 100).round(2)
+            bucket_df = pd.DataFrame({
+                '區間': bucket_counts.index,
+                '次數': bucket_counts.values,
+                '百分比(%)': bucket_pct.values
+            })
+            bucket_df = bucket_df[bucket_df['次數'] > 0]
+            return {
+                'recent_labels': dates.iloc[-100:].dt.strftime('%m-%d').to_numpy(),
+                'yearly_index': yearly_index,
+                'monthly_index': monthly_index,
+                'bucket_df': bucket_df,
+            }
+    return data_cache.get_or_compute(('market_tables', data_fp), compute)
+
+# ====================================
+# 背景工作：長時間的優化與模擬交給背景佇列，頁面只輪詢進度
+# ====================================
+JOB_INLINE_WAIT = 1.0   # 短工作直接等待完成 (秒)，避免畫面閃爍
+SWEEP_BATCH = 8         # 優化每批的均線數 (每批完成即寫入檢查點)
+MC_BATCH = 100          # Monte Carlo 每批的模擬次數
+
+# 自適應搜尋：各訊號附加參數的搜尋範圍 (參數名稱, 下限, 上限, 步進；步進 None 為整數)，以及搜尋結果的中文欄名
+SIGNAL_SEARCH_SPACE = {
+    'cross': ('slow_days', 20, 250, None),
+    'band': ('band_pct', 0.0, 5.0, 0.5),
+    'atr_stop': ('atr_mult', 1.0, 6.0, 0.5),
+}
+SEARCH_LABELS = {'ma_days': '均線天數', 'slow_days': '慢線天數', 'band_pct': '濾網帶寬度 (%)',
+                 'atr_mult': 'ATR 倍數', 'dynamic_leverage': '動態口數槓桿倍率'}
+
+@st.fragment(run_every=1.0)
+def job_progress(key):
+    """每秒更新一次進度；工作結束時重跑整頁以顯示結果。"""
+    from job_queue import STATUS_LABELS, job_queue
+    job = job_queue.get(key)
+    if job is None or job.finished:
+        st.rerun()
+    st.progress(job.progress, text=f"{job.label}：{STATUS_LABELS[job.status]} {job.done}/{job.total} (工作 ID：{job.id})")
+    if st.button("取消", key=f"cancel-{job.id}"):
+        job.cancel()
+        job.wait()
+        st.rerun()
+
+def render_job(key, submit):
+    """提交 (或取回) 背景工作並顯示狀態；完成時回傳 Job，未完成時回傳 None。
+
+    submit(resume) 負責提交工作；已取消或失敗的工作需按「從中斷處繼續」才會接續執行。
+    """
+    from job_queue import DONE, FAILED, job_queue
+    job = job_queue.get(key) or submit(False)
+    if not job.finished:
+        job.wait(JOB_INLINE_WAIT)
+    if job.status == DONE:
+        return job
+    if job.finished:
+        if job.status == FAILED:
+            st.error(f"{job.label}失敗：{job.error}")
+        else:
+            st.warning(f"{job.label}已取消，已完成 {job.done}/{job.total} (工作 ID：{job.id})")
+        if st.button("從中斷處繼續", key=f"resume-{job.id}"):
+            submit(True)
+            st.rerun()
+        return None
+    job_progress(key)
+    return None
+
 # 1. 嘗試從本地目錄讀取（適用於已部署的 App 或本地執行）
 if os.path.exists(DATA_FILE):
     st.info(f"從本地文件讀取資料：**{DATA_FILE}** (無需上傳)")
     try:
-        df = pd.read_excel(DATA_FILE)
+        stat = os.stat(DATA_FILE)
+        df = load_price_data(('file', os.path.abspath(DATA_FILE), stat.st_mtime_ns, stat.st_size),
+                             lambda: pd.read_excel(DATA_FILE))
         data_source = DATA_FILE
     except Exception as e:
         st.error(f"讀取 {DATA_FILE} 失敗，錯誤訊息: {e}")
@@ -109,28 +223,18 @@ else:
     # 2. 如果本地沒有檔案，則顯示上傳按鈕 (備用)
     uploaded_file = st.file_uploader("請上傳加權指數Excel檔案 (格式：日期, 收盤價)", type=["xlsx"])
     if uploaded_file:
-        df = pd.read_excel(uploaded_file)
+        content_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+        df = load_price_data(('upload', content_hash), lambda: pd.read_excel(uploaded_file))
         data_source = uploaded_file.name
 
 # 【🚨 程式碼主體：確保 df 成功讀取才執行 🚨】
 if data_source and df is not None and not df.empty:
-    
-    # 檢查並清理 DataFrame
-    df.columns = ['日期', '收盤價']
-    df['日期'] = pd.to_datetime(df['日期'])
-    df = df.sort_values('日期').reset_index(drop=True)
-
-    available_years = sorted(list(set(df['日期'].dt.year)))
-    # 確保選單中 '全部' 是第一個選項
-    start_year_options = ["全部"] + available_years
-    end_year_options = ["全部"] + available_years[::-1]
-    
-    start_year = st.sidebar.selectbox("選擇回測開始年份", options=start_year_options, index=0)
-    end_year = st.sidebar.selectbox("選擇回測結束年份", options=end_year_options, index=0)
 
-    # 修正：只有年份都不是"全部"時才做篩選，且保證型態正確
-    if start_year != "全部" and end_year != "全部":
-        df = df[(df['日期'].dt.year >= int(start_year)) & (df['日期'].dt.year <= int(end_year))].reset_index(drop=True)
+    # 回測區間：可選任意起訖日 (預設為完整歷史)
+    first_date = df['日期'].iloc[0].date()
+    last_date = df['日期'].iloc[-1].date()
+    start_date = st.sidebar.date_input("回測開始日期", value=first_date, min_value=first_date, max_value=last_date)
+    end_date = st.sidebar.date_input("回測結束日期", value=last_date, min_value=first_date, max_value=last_date)
 
     # ====== 參數設定 (Sidebar) ======
     auto_opt = st.sidebar.checkbox("自動優化均線天數", value=False)
@@ -139,8 +243,37 @@ if data_source and df is not None and not df.empty:
         max_ma = st.sidebar.number_input("均線天數-結束", min_value=2, max_value=500, value=60, step=1)
         ma_range = range(min_ma, max_ma + 1)
         moving_avg_days = None  # 後續由優化器決定
+        from search import SEARCH_METHODS
+        opt_methods = {'exhaustive': '窮舉所有均線天數', **{key: label for key, (label, _) in SEARCH_METHODS.items()}}
+        opt_method = st.sidebar.selectbox("優化方法", list(opt_methods), format_func=opt_methods.get)
+        if opt_method != 'exhaustive':
+            # 自適應搜尋：同時搜尋訊號附加參數 (與可選的槓桿倍率)，評估次數有上限
+            opt_budget = st.sidebar.number_input("評估次數上限", min_value=10, max_value=2000, value=60, step=10)
+            opt_seed = st.sidebar.number_input("搜尋隨機種子", value=0, step=1)
+            opt_leverage = st.sidebar.checkbox("同時優化動態口數槓桿倍率", value=False)
     else:
         moving_avg_days = st.sidebar.number_input("輸入幾日線", min_value=2, max_value=500, value=13, step=1)
+    # ====== 訊號類型 (Sidebar) ======
+    signal_labels = {label: kind for kind, (label, _) in SIGNALS.items()}
+    signal_label = st.sidebar.selectbox("訊號類型", list(signal_labels))
+    signal_kind = signal_labels[signal_label]
+    signal_kw = {}
+    if signal_kind == 'cross':
+        signal_kw['slow_days'] = st.sidebar.number_input("慢線天數", min_value=2, max_value=500, value=60, step=1)
+    elif signal_kind == 'band':
+        signal_kw['band_pct'] = st.sidebar.number_input("濾網帶寬度 (%)", min_value=0.0, max_value=20.0, value=1.0, step=0.5)
+    elif signal_kind == 'atr_stop':
+        signal_kw['atr_mult'] = st.sidebar.number_input("ATR 倍數", min_value=0.5, max_value=10.0, value=3.0, step=0.5)
+    # ====== 多週期設定 (Sidebar)：只在非日線或加上濾網時寫入 signal_kw，日線設定的快取與執行紀錄鍵值不變 ======
+    signal_tf = st.sidebar.selectbox("訊號週期", list(TIMEFRAMES), format_func=TIMEFRAMES.get)
+    if signal_tf != 'D':
+        signal_kw['timeframe'] = signal_tf
+        st.sidebar.caption(f"均線天數以{TIMEFRAMES[signal_tf]} K 棒計算 (例如 13 = 13 根{TIMEFRAMES[signal_tf]})")
+    trend_options = {None: '不使用', 'W': '週線', 'M': '月線'}
+    trend_tf = st.sidebar.selectbox("趨勢濾網", list(trend_options), format_func=trend_options.get)
+    if trend_tf is not None:
+        signal_kw['trend_tf'] = trend_tf
+        signal_kw['trend_days'] = st.sidebar.number_input("濾網均線長度 (K 棒數)", min_value=2, max_value=120, value=10, step=1)
     strategy_mode = st.sidebar.selectbox("選擇回測模式", ("雙向：站上多、跌破空", "只做多", "只做空", "從頭抱到尾"))
     start_capital = st.sidebar.number_input("輸入初始資金 (元)", value=1000000, step=50000)
     monthly_invest = st.sidebar.number_input("每月定期投入金額 (元)", value=0, step=1000)
@@ -153,181 +286,139 @@ if data_source and df is not None and not df.empty:
     use_fee = st.sidebar.checkbox("納入交易成本", value=True)
     buy_fee = st.sidebar.number_input("每口買進手續費", value=35, step=1)
     sell_fee = st.sidebar.number_input("每口賣出手續費", value=35, step=1)
+    # ====== 期貨執行模型 (Sidebar)：預設全為 0 / 關閉，與不考慮執行成本時的結果相同 ======
+    slippage = st.sidebar.number_input("每口每邊滑價 (點)", min_value=0.0, value=0.0, step=0.5)
+    slippage_per_lot = st.sidebar.number_input("每多一口增加的滑價 (點)", min_value=0.0, value=0.0, step=0.01)
+    roll = st.sidebar.checkbox("結算日轉倉 (計入轉倉成本)", value=False)
+    maint_margin_pct = st.sidebar.number_input("維持保證金率 (% 契約價值，0 = 不檢查)", min_value=0.0, max_value=100.0,
+                                               value=0.0, step=0.5)
     # ====== Monte Carlo 模擬設定 (Sidebar) ======
     do_mc = st.sidebar.checkbox("Monte Carlo 模擬", value=False)
     mc_sim_round = st.sidebar.number_input("Monte Carlo模擬次數", value=500, min_value=100, max_value=2000, step=100)
     mc_seed = st.sidebar.number_input("Monte Carlo隨機種子", value=42, step=1)
     remove_low_pct = st.sidebar.number_input("去除前幾%最低值", min_value=0, max_value=40, value=5, step=1)
     remove_high_pct = st.sidebar.number_input("去除後幾%最高值", min_value=0, max_value=40, value=5, step=1)
+    # ====== 交易 Bootstrap 信賴區間 (Sidebar) ======
+    do_bootstrap = st.sidebar.checkbox("交易 Bootstrap 信賴區間", value=False)
+    boot_rounds = st.sidebar.number_input("Bootstrap 重抽次數", value=10000, min_value=1000, max_value=50000, step=1000)
+    boot_level = st.sidebar.number_input("信賴水準 (%)", value=95.0, min_value=50.0, max_value=99.9, step=2.5)
+    # ====== 壓力情境測試 (Sidebar) ======
+    do_stress = st.sidebar.checkbox("壓力情境測試", value=False)
+    if do_stress:
+        from stress import SCENARIOS
+        stress_min_ma = st.sidebar.number_input("壓力測試均線-起始", min_value=2, max_value=500, value=5, step=1)
+        stress_max_ma = st.sidebar.number_input("壓力測試均線-結束", min_value=2, max_value=500, value=60, step=1)
+        stress_step = st.sidebar.number_input("壓力測試均線-間隔", min_value=1, max_value=100, value=5, step=1)
+        stress_modes = st.sidebar.multiselect("壓力測試回測模式", ["雙向：站上多、跌破空", "只做多", "只做空", "從頭抱到尾"],
+                                              default=[strategy_mode])
+        stress_keys = st.sidebar.multiselect("壓力情境", list(SCENARIOS), default=list(SCENARIOS),
+                                             format_func=lambda key: SCENARIOS[key].label)
+    # ====== 多策略投資組合 (Sidebar)：各策略共用上方的訊號、資金與成本設定 ======
+    do_portfolio = st.sidebar.checkbox("多策略投資組合 (共用資金)", value=False)
+    if do_portfolio:
+        from portfolio import Sleeve
+        portfolio_modes = ["雙向：站上多、跌破空", "只做多", "只做空"]
+        portfolio_defaults = [(60, "只做多"), (13, "雙向：站上多、跌破空")]
+        n_sleeves = st.sidebar.number_input("策略數量", min_value=2, max_value=8, value=2, step=1)
+        sleeves = []
+        for k in range(n_sleeves):
+            ma0, mode0 = portfolio_defaults[k] if k < len(portfolio_defaults) else (20, "雙向：站上多、跌破空")
+            sleeves.append(Sleeve(
+                st.sidebar.number_input(f"策略 {k + 1} 均線天數", min_value=2, max_value=500, value=ma0, step=1),
+                st.sidebar.selectbox(f"策略 {k + 1} 回測模式", portfolio_modes, index=portfolio_modes.index(mode0)),
+                st.sidebar.number_input(f"策略 {k + 1} 資金權重", min_value=0.0, value=1.0, step=0.5)))
+    # ====== 執行紀錄 (Sidebar) ======
+    show_history = st.sidebar.checkbox("顯示執行紀錄", value=False)
+
+    params = BacktestParams(
+        strategy_mode=strategy_mode, start_capital=start_capital, monthly_invest=monthly_invest,
+        lot_mode=lot_mode, fixed_lots=fixed_lots, dynamic_leverage=dynamic_leverage,
+        point_value=point_value, use_fee=use_fee, buy_fee=buy_fee, sell_fee=sell_fee,
+        slippage=slippage, slippage_per_lot=slippage_per_lot, roll=roll, maint_margin_pct=maint_margin_pct)
+
+    # 指標一律在完整歷史上計算 (區間開頭已有足夠的暖機資料)，回測區間以二分搜尋切片
+    full_dates = df['日期'].to_numpy(dtype='datetime64[ns]')
+    full_close = df['收盤價'].to_numpy(dtype='float64')
+    full_fp = data_fingerprint(full_dates, full_close)
+    lo, hi = date_range_bounds(full_dates, start_date, end_date)
+    if hi == lo:
+        st.warning("所選回測區間沒有任何資料，請調整開始/結束日期。")
+        st.stop()
+    df = df.iloc[lo:hi].reset_index(drop=True)
+    dates_arr, close_arr = full_dates[lo:hi], full_close[lo:hi]
+    months_arr = month_numbers(full_dates)[lo:hi]
+    # 區間資料的指紋：完整歷史指紋 + 切片範圍
+    data_fp = f"{full_fp}:{lo}:{hi}"
+    # 與策略參數無關的市場統計，資料不變時直接沿用
+    market = market_tables(df, data_fp)
+
+    signal_key = tuple(sorted(signal_kw.items()))
 
     # ====== 參數優化主體 (註釋：用於自動尋找最佳均線天數) ======
     def backtest(moving_avg_days):
-        df_bt = df.copy()
-        df_bt[f'{moving_avg_days}日線'] = df_bt['收盤價'].rolling(window=moving_avg_days).mean()
-        trades, capital_history, capital_date, index_history = [], [], [], []
-        capital = start_capital
-        holding = False
-        position = None
-        entry_price = None
-        entry_date = None
-        last_month = df_bt.iloc[0]['日期'].month
-        
-        # 初始資金紀錄 (解決 capital_history 初始為空的問題)
-        capital_history.append(capital)
-        capital_date.append(df_bt.loc[0, '日期'])
-        index_history.append(df_bt.loc[0, '收盤價'])
-        
-        for i in range(1, len(df_bt)):
-            this_month = df_bt.loc[i, '日期'].month
-            # 定期投入
-            if monthly_invest > 0 and this_month != last_month:
-                capital += monthly_invest
-            last_month = this_month
-            
-            # 確保均線數據存在
-            if pd.isna(df_bt.loc[i, f'{moving_avg_days}日線']):
-                capital_history.append(capital)
-                capital_date.append(df_bt.loc[i, '日期'])
-                index_history.append(df_bt.loc[i, '收盤價'])
-                continue
-                
-            action = df_bt.loc[i, '收盤價'] - df_bt.loc[i, f'{moving_avg_days}日線']
-            current_price = df_bt.loc[i, '收盤價']
-            date = df_bt.loc[i, '日期']
-            
-            # 進場判斷
-            if not holding:
-                if strategy_mode == "只做多" and action > 0:
-                    holding = True
-                    position = '多'
-                    entry_price = current_price
-                    entry_date = date
-                elif strategy_mode == "只做空" and action < 0:
-                    holding = True
-                    position = '空'
-                    entry_price = current_price
-                    entry_date = date
-                elif strategy_mode == "雙向：站上多、跌破空" and action != 0:
-                    holding = True
-                    position = '多' if action > 0 else '空'
-                    entry_price = current_price
-                    entry_date = date
-            
-            # 出場/換倉判斷
-            else:
-                # 動態口數計算 (在進場時 entry_price 確定後，口數也確定)
-                lots = fixed_lots if lot_mode == "固定口數" else max(
-                    int((capital * dynamic_leverage) / (entry_price * point_value)) if entry_price else 0, 0)
-                
-                # 只做多平倉
-                if strategy_mode == "只做多" and action < 0 and position == '多':
-                    fee = (buy_fee + sell_fee) * lots if use_fee else 0
-                    profit = (current_price - entry_price) * lots * point_value - fee
-                    capital += profit
-                    trades.append({
-                        '進場日期': entry_date, '出場日期': date,
-                        '方向': position, '持有天數': (date - entry_date).days,
-                        '進場價': entry_price, '出場價': current_price,
-                        '交易口數': lots, '交易成本(元)': fee,
-                        '損益金額(元)': round(profit, 2),
-                        '累積資金(元)': round(capital, 2)
-                    })
-                    # 重設狀態
-                    holding = False
-                    position = None
-                    entry_price = None
-                    entry_date = None
-
-                # 只做空平倉
-                elif strategy_mode == "只做空" and action > 0 and position == '空':
-                    fee = (buy_fee + sell_fee) * lots if use_fee else 0
-                    profit = (entry_price - current_price) * lots * point_value - fee
-                    capital += profit
-                    trades.append({
-                        '進場日期': entry_date, '出場日期': date,
-                        '方向': position, '持有天數': (date - entry_date).days,
-                        '進場價': entry_price, '出場價': current_price,
-                        '交易口數': lots, '交易成本(元)': fee,
-                        '損益金額(元)': round(profit, 2),
-                        '累積資金(元)': round(capital, 2)
-                    })
-                    # 重設狀態
-                    holding = False
-                    position = None
-                    entry_price = None
-                    entry_date = None
-
-                # 雙向換倉
-                elif strategy_mode == "雙向：站上多、跌破空":
-                    if position == '多' and action < 0: # 多單平倉 + 開空單
-                        fee = (buy_fee + sell_fee) * lots if use_fee else 0
-                        profit = (current_price - entry_price) * lots * point_value - fee
-                        capital += profit
-                        trades.append({
-                            '進場日期': entry_date, '出場日期': date,
-                            '方向': position, '持有天數': (date - entry_date).days,
-                            '進場價': entry_price, '出場價': current_price,
-                            '交易口數': lots, '交易成本(元)': fee,
-                            '損益金額(元)': round(profit, 2),
-                            '累積資金(元)': round(capital, 2)
-                        })
-                        
-                        # 開空單
-                        holding = True
-                        position = '空'
-                        entry_price = current_price
-                        entry_date = date
-                        
-                    elif position == '空' and action > 0: # 空單平倉 + 開多單
-                        fee = (buy_fee + sell_fee) * lots if use_fee else 0
-                        profit = (entry_price - current_price) * lots * point_value - fee
-                        capital += profit
-                        trades.append({
-                            '進場日期': entry_date, '出場日期': date,
-                            '方向': position, '持有天數': (date - entry_date).days,
-                            '進場價': entry_price, '出場價': current_price,
-                            '交易口數': lots, '交易成本(元)': fee,
-                            '損益金額(元)': round(profit, 2),
-                            '累積資金(元)': round(capital, 2)
-                        })
-                        
-                        # 開多單
-                        holding = True
-                        position = '多'
-                        entry_price = current_price
-                        entry_date = date
-                        
-            capital_history.append(capital)
-            capital_date.append(date)
-            index_history.append(current_price)
-
-        # 確保 capital_history 不是空的，並只返回累積報酬率
-        if not capital_history:
-             return 0, [], [], []
-             
-        # 計算總累積報酬率（優化器只關注這個值）
-        total_return = (capital_history[-1] - start_capital) / start_capital * 100
-        return total_return, capital_history, capital_date, index_history
+        # 回測結果在所有 session 間共用，相同設定同時請求時只計算一次
+        def compute():
+            from run_store import compact_equity, make_row, run_store
+            with telemetry.timed('backtest', rows=len(dates_arr), signal=signal_kind):
+                signal = build_signal(signal_kind, full_close, full_fp, moving_avg_days, full_dates, **signal_kw)[lo:hi]
+                res = run_backtest(dates_arr, close_arr, signal, params, months_arr).freeze()
+            # 每次實際計算的回測都寫入執行紀錄
+            run_store.record([make_row('backtest', data_fp, dates_arr, signal_kind, signal_kw, moving_avg_days, params,
+                                       res.metrics(start_capital), compact_equity(res.dates, res.capital))])
+            return res
+        return result_cache.get_or_compute(
+            ('backtest', data_fp, signal_kind, signal_key, moving_avg_days, params), compute)
 
     # ====== 自動優化均線天數 (卡片 1) ======
-    if auto_opt:
+    if auto_opt and opt_method == 'exhaustive':
         st.markdown("<div class='data-card'>", unsafe_allow_html=True)
         st.markdown("<h2 class='card-header'><span>🔎</span> 自動優化均線天數</h2>", unsafe_allow_html=True)
+        from job_queue import job_queue
+        from parallel_sweep import PARALLEL_MIN_TASKS, get_backend, sweep_ma
+        from run_store import make_row, run_key, run_store
+
+        ma_list = list(ma_range)
+        # 執行後端由環境變數 SWEEP_BACKEND 決定 (本機程序池 / Dask / Ray)
+        backend = get_backend()
+        parallel = len(ma_list) >= PARALLEL_MIN_TASKS and backend.workers > 1
+        # 掃描分批執行：每批完成即保留結果，取消或重跑時不會丟失已完成的部分
+        batch = PARALLEL_MIN_TASKS if parallel else SWEEP_BATCH
+        batches = [tuple(ma_list[i:i + batch]) for i in range(0, len(ma_list), batch)]
+        def sweep_batch(mas, job):
+            # 執行紀錄中已有的設定直接取用，不再重新回測
+            keys = {ma: run_key(data_fp, signal_kind, signal_kw, ma, params) for ma in mas}
+            known = run_store.lookup(keys.values())
+            returns = {ma: known[keys[ma]]['total_return'] for ma in mas if keys[ma] in known}
+            todo = [ma for ma in mas if ma not in returns]
+            if parallel and todo:
+                # 任務多時交給執行後端 (本機時價格陣列經共享記憶體傳給工作程序)
+                rows = []
+                for ma, metrics, equity in sweep_ma(full_dates, full_close, todo, params, signal_kind, signal_kw, lo, hi,
+                                                    backend=backend, fingerprint=full_fp):
+                    returns[ma] = metrics['total_return'] if metrics else np.nan
+                    if metrics:
+                        rows.append(make_row('sweep', data_fp, dates_arr, signal_kind, signal_kw, ma, params, metrics, equity))
+                run_store.record(rows)
+            else:
+                # 優化迴圈中使用 backtest 函式 (計算時即寫入執行紀錄)
+                for ma in todo:
+                    try:
+                        returns[ma] = backtest(ma).total_return(start_capital)
+                    except Exception:
+                        returns[ma] = np.nan
+            return [{'均線天數': ma, '累積報酬率': returns[ma]} for ma in mas]
+        # 同一組掃描在所有 session 間共用 (工作 ID 由鍵值決定，重跑後仍可取回)
+        sweep_key = ('sweep', data_fp, signal_kind, signal_key, min_ma, max_ma, params)
+        sweep_job = render_job(sweep_key, lambda resume: job_queue.submit(
+            sweep_key, "均線優化", batches, sweep_batch,
+            finalize=lambda parts: [row for part in parts for row in part], resume=resume))
         
-        results = []
-        bar = st.progress(0)
-        # 優化迴圈中使用 backtest 函式
-        for idx, ma in enumerate(ma_range):
-            try:
-                r, _, _, _ = backtest(ma)
-                results.append({'均線天數': ma, '累積報酬率': r})
-            except Exception as e:
-                results.append({'均線天數': ma, '累積報酬率': np.nan}) 
-            bar.progress((idx+1)/len(ma_range))
-        bar.empty()
-        
-        results_df = pd.DataFrame(results).dropna()
-        if not results_df.empty:
+        results_df = pd.DataFrame(sweep_job.result if sweep_job is not None else []).dropna()
+        if sweep_job is None:
+            # 優化尚未完成：先以預設均線回測，完成後頁面自動更新
+            moving_avg_days = max(min_ma, 13)
+            st.info(f"優化完成前，暫以 {moving_avg_days}日線 進行回測")
+        elif not results_df.empty:
             best_row = results_df.loc[results_df['累積報酬率'].idxmax()]
             st.success(f"最佳均線天數：{int(best_row['均線天數'])}，累積報酬率：{best_row['累積報酬率']:.2f}%")
             
@@ -349,9 +440,100 @@ if data_source and df is not None and not df.empty:
 
         st.markdown("</div>", unsafe_allow_html=True)
         
+    # ====== 自適應參數搜尋 (卡片 1：逐步減半 / 貝氏搜尋) ======
+    if auto_opt and opt_method != 'exhaustive':
+        st.markdown("<div class='data-card'>", unsafe_allow_html=True)
+        st.markdown("<h2 class='card-header'><span>🧭</span> 自適應參數搜尋</h2>", unsafe_allow_html=True)
+        from job_queue import job_queue
+        from run_store import compact_equity, make_row, run_key, run_store
+        from search import FloatRange, IntRange, best_of
+
+        # 搜尋空間：均線天數 + 目前訊號的附加參數 (+ 動態口數槓桿倍率)
+        space = [IntRange('ma_days', min_ma, max_ma)]
+        if signal_kind in SIGNAL_SEARCH_SPACE:
+            name, low, high, step = SIGNAL_SEARCH_SPACE[signal_kind]
+            space.append(IntRange(name, low, high) if step is None else FloatRange(name, low, high, step=step))
+        search_leverage = opt_leverage and lot_mode == "資金動態口數"
+        if search_leverage:
+            space.append(FloatRange('dynamic_leverage', 0.5, 5.0, step=0.5))
+
+        def evaluate_config(config, fraction):
+            kw = {**signal_kw, **{k: v for k, v in config.items() if k in signal_kw}}
+            p = params._replace(**{k: v for k, v in config.items() if k in BacktestParams._fields})
+            if fraction >= 1.0:
+                # 完整區間的評估與執行紀錄共用：算過的設定直接取用
+                key = run_key(data_fp, signal_kind, kw, config['ma_days'], p)
+                known = run_store.lookup([key])
+                if key in known:
+                    return known[key]['total_return']
+            # 前幾輪只用回測區間的最後一段 (資料區間隨輪數放大)
+            sub_lo = max(lo, hi - max(2, int(round((hi - lo) * fraction))))
+            signal = build_signal(signal_kind, full_close, full_fp, config['ma_days'], full_dates, **kw)[sub_lo:hi]
+            res = run_backtest(full_dates[sub_lo:hi], full_close[sub_lo:hi], signal, p, month_numbers(full_dates)[sub_lo:hi])
+            if fraction >= 1.0:
+                run_store.record([make_row('search', data_fp, dates_arr, signal_kind, kw, config['ma_days'], p,
+                                           res.metrics(start_capital), compact_equity(res.dates, res.capital))])
+            return res.total_return(start_capital)
+
+        def search_step(i, job):
+            # job.state 為搜尋器本身 (連同亂數狀態寫入檢查點，可從中斷處繼續)
+            config, fraction = job.state.ask()
+            score = evaluate_config(config, fraction)
+            job.state.tell(score)
+            return config, fraction, score
+
+        search_key = ('search', opt_method, data_fp, signal_kind, signal_key, min_ma, max_ma, search_leverage,
+                      opt_budget, opt_seed, params)
+        def submit_search(resume):
+            # 搜尋器只在提交工作時建立 (工作已存在時沿用其中的搜尋器狀態)
+            searcher = SEARCH_METHODS[opt_method][1](space, opt_budget, opt_seed)
+            return job_queue.submit(search_key, opt_methods[opt_method], list(range(searcher.total)), search_step,
+                                    finalize=best_of, state=searcher, resume=resume)
+        search_job = render_job(search_key, submit_search)
+
+        if search_job is None:
+            moving_avg_days = max(min_ma, 13)
+            st.info(f"搜尋完成前，暫以 {moving_avg_days}日線 進行回測")
+        elif not np.isfinite(search_job.result.best_score):
+            moving_avg_days = max(min_ma, 13)
+            st.warning("自適應搜尋沒有有效結果，請檢查參數設定。")
+            st.info(f"將使用預設均線天數：{moving_avg_days}日線")
+        else:
+            best = search_job.result
+            n_full = sum(1 for _, f, _ in best.history if f >= 1.0)
+            best_desc = "，".join(f"{SEARCH_LABELS[k]} {v}" for k, v in best.best_config.items())
+            st.success(f"最佳設定：{best_desc}；累積報酬率：{best.best_score:.2f}%")
+            st.caption(f"共評估 {len(best.history)} 組設定 (其中 {n_full} 組使用完整回測區間)，"
+                       f"窮舉相同空間需要更多次回測；相同種子與評估次數上限可重現同一結果。")
+
+            history_df = pd.DataFrame([{**c, '資料區間比例': f, '累積報酬率': sc} for c, f, sc in best.history])
+            history_df = history_df.replace([np.inf, -np.inf], np.nan).rename(columns=SEARCH_LABELS)
+            fig_opt, ax_opt = plt.subplots(figsize=(10, 4))
+            for frac, part in history_df.groupby('資料區間比例'):
+                ax_opt.scatter(part.index, part['累積報酬率'], s=12, label=f"資料區間 {frac:.0%}")
+            ax_opt.set_xlabel("評估順序")
+            ax_opt.set_ylabel("累積報酬率(%)")
+            ax_opt.set_title("自適應搜尋過程")
+            ax_opt.legend()
+            st.pyplot(fig_opt)
+            st.dataframe(history_df.style.format({'累積報酬率': '{:.2f}', '資料區間比例': '{:.0%}'}),
+                         use_container_width=True)
+
+            # 後續回測與模擬採用最佳設定
+            moving_avg_days = int(best.best_config['ma_days'])
+            signal_kw.update({k: v for k, v in best.best_config.items() if k in signal_kw})
+            signal_key = tuple(sorted(signal_kw.items()))
+            if 'dynamic_leverage' in best.best_config:
+                dynamic_leverage = best.best_config['dynamic_leverage']
+                params = params._replace(dynamic_leverage=dynamic_leverage)
+            st.info(f"後續回測與模擬將自動採用最佳設定：{moving_avg_days}日線")
+
+        st.markdown("</div>", unsafe_allow_html=True)
+
     # 如果是非優化模式，直接使用設定的 moving_avg_days
     if moving_avg_days is not None:
-        df[f'{moving_avg_days}日線'] = df['收盤價'].rolling(window=moving_avg_days).mean()
+        df[f'{moving_avg_days}日線'] = sma(full_close, full_fp, moving_avg_days)[lo:hi]
+        signal_arr = build_signal(signal_kind, full_close, full_fp, moving_avg_days, full_dates, **signal_kw)[lo:hi]
     else:
         st.error("均線天數未設定，請檢查側邊欄。")
         st.stop() # 停止執行以避免後續錯誤
@@ -363,21 +545,37 @@ if data_source and df is not None and not df.empty:
     
     latest_price = df.iloc[-1]['收盤價']
     latest_date_str = df.iloc[-1]['日期'].strftime('%Y-%m-%d')
-    latest_ma = df.iloc[-1][f'{moving_avg_days}日線']
+    latest_signal = signal_arr[-1]
+    # 日線 SMA 訊號才以「N 日線」為判斷依據；其他訊號類型或週期改列出實際的訊號值
+    show_ma = signal_kind == 'sma' and signal_tf == 'D'
+    latest_ma = df.iloc[-1][f'{moving_avg_days}日線'] if show_ma else np.nan
     
-    if not pd.isna(latest_ma):
+    if not pd.isna(latest_signal) and not (show_ma and pd.isna(latest_ma)):
+        if show_ma:
+            reference_line = f"- 最新 {moving_avg_days} 日線：**{latest_ma:.2f}**"
+        else:
+            reference_line = f"- 最新 {signal_label} 訊號值：**{latest_signal:.2f}**"
         st.markdown(f"""
             - 最新日期：**{latest_date_str}**
             - 最新收盤價：**{latest_price:,.2f}**
-            - 最新 {moving_avg_days} 日線：**{latest_ma:.2f}**
+            {reference_line}
             """)
-        diff = latest_price - latest_ma
-        if latest_price > latest_ma:
-            st.success(f"📈 現在收盤價高於 {moving_avg_days} 日線 ({diff:.2f}) ➜ **建議：做多**")
+        if signal_kind == 'sma' and signal_tf == 'D' and trend_tf is None:
+            diff = latest_price - latest_ma
+            if latest_price > latest_ma:
+                st.success(f"📈 現在收盤價高於 {moving_avg_days} 日線 ({diff:.2f}) ➜ **建議：做多**")
+            else:
+                st.error(f"📉 現在收盤價低於 {moving_avg_days} 日線 ({diff:.2f}) ➜ **建議：做空**")
+        elif latest_signal > 0:
+            st.success(f"📈 {signal_label} 訊號偏多 ({latest_signal:.2f}) ➜ **建議：做多**")
+        elif latest_signal < 0:
+            st.error(f"📉 {signal_label} 訊號偏空 ({latest_signal:.2f}) ➜ **建議：做空**")
+        elif trend_tf is not None:
+            st.info(f"➖ {signal_label} 訊號與{trend_options[trend_tf]}趨勢濾網方向不一致 ➜ **建議：維持原部位**")
         else:
-            st.error(f"📉 現在收盤價低於 {moving_avg_days} 日線 ({diff:.2f}) ➜ **建議：做空**")
+            st.info(f"➖ {signal_label} 訊號位於濾網帶內 ➜ **建議：維持原部位**")
     else:
-        st.warning("均線數據不足，無法進行最新市場判斷。")
+        st.warning("均線數據不足，無法進行最新市場判斷。" if show_ma else "訊號數據不足，無法進行最新市場判斷。")
         
     st.markdown("</div>", unsafe_allow_html=True)
 
@@ -386,18 +584,19 @@ if data_source and df is not None and not df.empty:
     st.markdown("<h2 class='card-header'><span>📊</span> 近 100 日多空建議趨勢圖</h2>", unsafe_allow_html=True)
     
     if len(df) >= 100:
-        recent_df = df.iloc[-100:].copy()
-        # 確保均線數據存在
-        if not pd.isna(recent_df[f'{moving_avg_days}日線']).all():
-            recent_df['建議方向'] = recent_df.apply(
-                lambda row: 1 if row['收盤價'] > row[f'{moving_avg_days}日線'] else -1, axis=1
-            )
-            recent_df['簡化日期'] = recent_df['日期'].dt.strftime('%m-%d')
+        recent_signal = signal_arr[-100:]
+        # 確保訊號數據存在
+        if not np.isnan(recent_signal).all():
+            # 訊號為 0 (濾網帶內) 或缺值時記為 0
+            recent_df = pd.DataFrame({
+                '簡化日期': market['recent_labels'],
+                '建議方向': np.where(recent_signal > 0, 1, np.where(recent_signal < 0, -1, 0)),
+            })
             fig, ax = plt.subplots(figsize=(16, 4))
             ax.bar(
                 recent_df['簡化日期'],
                 recent_df['建議方向'],
-                color=recent_df['建議方向'].map({1: '#ffb6c1', -1: '#90ee90'})
+                color=recent_df['建議方向'].map({1: '#ffb6c1', -1: '#90ee90', 0: '#d3d3d3'})
             )
             ax.axhline(0, color='black', linewidth=1)
             ax.set_ylabel('建議方向')
@@ -420,7 +619,7 @@ if data_source and df is not None and not df.empty:
     st.markdown("<h2 class='card-header'><span>📊</span> 近 100 日建議方向統計</h2>", unsafe_allow_html=True)
     
     # 確保 recent_df 存在且均線數據存在
-    if 'recent_df' in locals() and len(df) >= 100 and not pd.isna(recent_df[f'{moving_avg_days}日線']).all():
+    if 'recent_df' in locals() and len(df) >= 100 and not np.isnan(recent_signal).all():
         long_days = (recent_df['建議方向'] == 1).sum()
         short_days = (recent_df['建議方向'] == -1).sum()
         total = long_days + short_days
@@ -455,239 +654,22 @@ if data_source and df is not None and not df.empty:
     st.markdown("</div>", unsafe_allow_html=True)
 
     # ===== 回測主邏輯 (在後台運行) ======
-    
-    # 初始化用於回測的變數
-    trades, capital_history, capital_date, index_history = [], [], [], []
-    capital = start_capital
-    yearly_lots = {}
-    
-    holding = False
-    position = None
-    entry_price = None
-    entry_date = None
-    
-    if len(df) > 0:
-        # 初始資金紀錄
-        capital_history.append(capital)
-        capital_date.append(df.iloc[0]['日期'])
-        index_history.append(df.iloc[0]['收盤價'])
-        last_month = df.iloc[0]['日期'].month
-    else:
+    if len(df) == 0:
         st.error("數據檔案沒有任何資料。")
         st.stop()
-        
-
-    if strategy_mode == "從頭抱到尾":
-        # 僅適用於策略模式為「從頭抱到尾」
-        if len(df) > 1:
-            entry_price = df.iloc[0]['收盤價']
-            entry_date = df.iloc[0]['日期']
-            
-            # 動態口數計算需確保 entry_price 不為 0
-            if entry_price > 0:
-                lots = fixed_lots if lot_mode == "固定口數" else max(
-                    int((capital * dynamic_leverage) / (entry_price * point_value)), 0)
-            else:
-                lots = fixed_lots
-                
-            fee = (buy_fee + sell_fee) * lots if use_fee else 0
-            
-            # 資金變動軌跡 (計算中間過程的資金變化)
-            for i in range(1, len(df)):
-                this_month = df.loc[i, '日期'].month
-                if monthly_invest > 0 and this_month != last_month:
-                    capital += monthly_invest
-                last_month = this_month
-                
-                price = df.loc[i, '收盤價']
-                prev_price = df.loc[i - 1, '收盤價']
-                
-                # 每日未平倉損益反映到資本
-                profit = (price - prev_price) * lots * point_value
-                capital += profit
-                
-                capital_history.append(capital)
-                capital_date.append(df.loc[i, '日期'])
-                index_history.append(price)
-
-            # 處理交易明細，將結果計入最終交易 (視為在最後一天平倉)
-            final_profit = (df.iloc[-1]['收盤價'] - entry_price) * lots * point_value - fee
-            
-            # 由於資金已經每日計算，這裡只記錄交易細節
-            trades.append({
-                '進場日期': entry_date, '出場日期': df.iloc[-1]['日期'],
-                '方向': '多', '持有天數': (df.iloc[-1]['日期'] - entry_date).days,
-                '進場價': entry_price, '出場價': df.iloc[-1]['收盤價'],
-                '交易口數': lots, '交易成本(元)': fee,
-                '損益金額(元)': round(final_profit, 2),
-                '累積資金(元)': round(capital, 2)
-            })
-            
-            year = entry_date.year
-            yearly_lots[year] = yearly_lots.get(year, 0) + lots
-            
-        else:
-            st.warning("資料不足，無法執行「從頭抱到尾」策略。")
-            
-    else:
-        # 其他均線策略
-        for i in range(1, len(df)):
-            this_month = df.loc[i, '日期'].month
-            # 定期投入
-            if monthly_invest > 0 and this_month != last_month:
-                capital += monthly_invest
-            last_month = this_month
-            
-            # 如果均線數據缺失，則跳過當日交易判斷
-            if pd.isna(df.loc[i, f'{moving_avg_days}日線']):
-                capital_history.append(capital)
-                capital_date.append(df.loc[i, '日期'])
-                index_history.append(df.loc[i, '收盤價'])
-                continue
-                
-            action = df.loc[i, '收盤價'] - df.loc[i, f'{moving_avg_days}日線']
-            current_price = df.loc[i, '收盤價']
-            date = df.loc[i, '日期']
-            
-            # 進場判斷
-            if not holding:
-                if strategy_mode == "只做多" and action > 0:
-                    holding = True
-                    position = '多'
-                    entry_price = current_price
-                    entry_date = date
-                elif strategy_mode == "只做空" and action < 0:
-                    holding = True
-                    position = '空'
-                    entry_price = current_price
-                    entry_date = date
-                elif strategy_mode == "雙向：站上多、跌破空" and action != 0:
-                    holding = True
-                    position = '多' if action > 0 else '空'
-                    entry_price = current_price
-                    entry_date = date
-            
-            # 出場/換倉判斷
-            else:
-                
-                # 動態口數計算 (此處的 lots 是為了計算平倉損益)
-                lots = fixed_lots if lot_mode == "固定口數" else max(
-                    int((capital * dynamic_leverage) / (entry_price * point_value)) if entry_price else 0, 0)
-                
-                # 只做多平倉
-                if strategy_mode == "只做多" and action < 0 and position == '多':
-                    fee = (buy_fee + sell_fee) * lots if use_fee else 0
-                    profit = (current_price - entry_price) * lots * point_value - fee
-                    capital += profit
-                    trades.append({
-                        '進場日期': entry_date, '出場日期': date,
-                        '方向': position, '持有天數': (date - entry_date).days,
-                        '進場價': entry_price, '出場價': current_price,
-                        '交易口數': lots, '交易成本(元)': fee,
-                        '損益金額(元)': round(profit, 2),
-                        '累積資金(元)': round(capital, 2)
-                    })
-                    year = entry_date.year
-                    yearly_lots[year] = yearly_lots.get(year, 0) + lots
-                    holding = False
-                    position = None
-                    entry_price = None
-                    entry_date = None
-                    
-                # 只做空平倉
-                elif strategy_mode == "只做空" and action > 0 and position == '空':
-                    fee = (buy_fee + sell_fee) * lots if use_fee else 0
-                    profit = (entry_price - current_price) * lots * point_value - fee
-                    capital += profit
-                    trades.append({
-                        '進場日期': entry_date, '出場日期': date,
-                        '方向': position, '持有天數': (date - entry_date).days,
-                        '進場價': entry_price, '出場價': current_price,
-                        '交易口數': lots, '交易成本(元)': fee,
-                        '損益金額(元)': round(profit, 2),
-                        '累積資金(元)': round(capital, 2)
-                    })
-                    year = entry_date.year
-                    yearly_lots[year] = yearly_lots.get(year, 0) + lots
-                    holding = False
-                    position = None
-                    entry_price = None
-                    entry_date = None
-                    
-                # 雙向換倉
-                elif strategy_mode == "雙向：站上多、跌破空":
-                    if position == '多' and action < 0: # 多單平倉 + 開空單
-                        fee = (buy_fee + sell_fee) * lots if use_fee else 0
-                        profit = (current_price - entry_price) * lots * point_value - fee
-                        capital += profit
-                        trades.append({
-                            '進場日期': entry_date, '出場日期': date,
-                            '方向': position, '持有天數': (date - entry_date).days,
-                            '進場價': entry_price, '出場價': current_price,
-                            '交易口數': lots, '交易成本(元)': fee,
-                            '損益金額(元)': round(profit, 2),
-                            '累積資金(元)': round(capital, 2)
-                        })
-                        year = entry_date.year
-                        yearly_lots[year] = yearly_lots.get(year, 0) + lots
-                        
-                        holding = True
-                        position = '空'
-                        entry_price = current_price
-                        entry_date = date
-                        
-                    elif position == '空' and action > 0: # 空單平倉 + 開多單
-                        fee = (buy_fee + sell_fee) * lots if use_fee else 0
-                        profit = (entry_price - current_price) * lots * point_value - fee
-                        capital += profit
-                        trades.append({
-                            '進場日期': entry_date, '出場日期': date,
-                            '方向': position, '持有天數': (date - entry_date).days,
-                            '進場價': entry_price, '出場價': current_price,
-                            '交易口數': lots, '交易成本(元)': fee,
-                            '損益金額(元)': round(profit, 2),
-                            '累積資金(元)': round(capital, 2)
-                        })
-                        year = entry_date.year
-                        yearly_lots[year] = yearly_lots.get(year, 0) + lots
-                        
-                        holding = True
-                        position = '多'
-                        entry_price = current_price
-                        entry_date = date
-            
-            # 每日資金與指數紀錄
-            capital_history.append(capital)
-            capital_date.append(date)
-            index_history.append(current_price)
+    if strategy_mode == "從頭抱到尾" and len(df) <= 1:
+        st.warning("資料不足，無法執行「從頭抱到尾」策略。")
 
-    trades_df = pd.DataFrame(trades)
-    
-    # 設置即時損益的預設值，即使無持倉，也確保變數存在
-    unrealized_profit = 0
-    lots = 0
+    result = backtest(moving_avg_days)
+    trades_df = result.trades_frame()
+    yearly_lots = result.yearly_lots()
+    holding, position = result.holding, result.position
+    entry_price = result.entry_price
     last_price = df.iloc[-1]['收盤價']
-    
-    # 如果回測結束仍有部位，將當前部位視為未平倉損益
-    if holding and strategy_mode != "從頭抱到尾" and entry_price is not None:
-        # 由於在迴圈中 lots 每次都會計算，這裡要重新計算一次最終口數
-        lots = fixed_lots if lot_mode == "固定口數" else max(
-            int((capital * dynamic_leverage) / (entry_price * point_value)) if entry_price else 0, 0)
-        
-        # 僅計算出場手續費
-        fee_exit = sell_fee * lots if use_fee else 0 
-        
-        if position == '多':
-            unrealized_profit = (last_price - entry_price) * lots * point_value - fee_exit
-        else:
-            unrealized_profit = (entry_price - last_price) * lots * point_value - fee_exit
-        
-        # 將未平倉損益反映到最終資金上 (僅在最後一個點)
-        if capital_history:
-            # 為了簡化，我們直接在最後一個點做調整，確保總結數據正確
-            capital_history[-1] += unrealized_profit
-            capital += unrealized_profit # 更新 capital 總值
-            
+
+    # 如果回測結束仍有部位，將當前部位視為未平倉損益 (已反映到最終資金上)
+    result, lots, unrealized_profit = result.mark_to_market(params)
+
     # ===== 樣式處理 (後台函式) ======
     def highlight_direction(row):
         color = 'background-color: #fddddd' if row['方向'] == '多' else 'background-color: #d4f4dd'
@@ -715,39 +697,40 @@ if data_source and df is not None and not df.empty:
     st.markdown(f"""
     - 策略模式：**{strategy_mode}**
     - 均線設定：**{moving_avg_days}日線**
+    - 訊號類型：**{signal_label}**
     - 口數模式：**{lot_mode}**
     - 每點價值：**{point_value}元**
     - 固定口數槓桿：**{leverage}倍**
     - 動態口數槓桿：**{dynamic_leverage}倍**
-    - 回測區間：**{start_year if start_year != '全部' else '最早'} ➔ {end_year if end_year != '全部' else '最晚'}**
+    - 回測區間：**{df['日期'].iloc[0]:%Y-%m-%d} ➔ {df['日期'].iloc[-1]:%Y-%m-%d}**
     - 初始資金：**{start_capital:,.0f} 元**
     - 每月定期投入金額：**{monthly_invest:,.0f} 元**
     - 是否計入交易成本：**{'是' if use_fee else '否'}**
     - 每口交易成本（買/賣）：**{buy_fee}/{sell_fee} 元**
+    - 滑價（每口每邊）：**{slippage} 點 + 每口 {slippage_per_lot} 點**
+    - 結算日轉倉：**{'是' if roll else '否'}**
+    - 維持保證金率：**{f'{maint_margin_pct}%' if maint_margin_pct > 0 else '不檢查'}**
     """)
     
     st.markdown("</div>", unsafe_allow_html=True)
 
     # ===== 資金 vs 大盤曲線 (卡片 7) ======
-    if capital_date and capital_history:
+    if len(result):
         st.markdown("<div class='data-card'>", unsafe_allow_html=True)
         st.markdown("<h2 class='card-header'><span>📈</span> 資金成長曲線 vs 大盤指數</h2>", unsafe_allow_html=True)
         
-        # 繪圖前，確保 capital_history 長度一致
-        if len(capital_date) == len(capital_history) and len(capital_date) == len(index_history):
-            fig, ax1 = plt.subplots(figsize=(14, 6))
-            ax1.plot(capital_date, capital_history, color='blue', label='資金成長')
-            ax1.set_ylabel("資金", color='blue')
-            ax1.yaxis.set_major_formatter(mticker.FuncFormatter(lambda x, _: f"{int(x):,}"))
-            ax2 = ax1.twinx()
-            ax2.plot(capital_date, index_history, color='green', linestyle='--', label='大盤指數')
-            ax2.set_ylabel("大盤", color='green')
-            fig.legend(loc="upper left")
-            ax1.grid(True)
-            st.pyplot(fig)
-            st.caption("藍線代表回測期間的資金變化曲線，綠色虛線代表台股大盤指數走勢，用於比較策略與大盤的表現。")
-        else:
-            st.warning("資金數據或大盤數據長度不一致，無法繪製圖表。")
+        # 每日序列由同一個結果容器產生，長度必然一致
+        fig, ax1 = plt.subplots(figsize=(14, 6))
+        ax1.plot(result.dates, result.capital, color='blue', label='資金成長')
+        ax1.set_ylabel("資金", color='blue')
+        ax1.yaxis.set_major_formatter(mticker.FuncFormatter(lambda x, _: f"{int(x):,}"))
+        ax2 = ax1.twinx()
+        ax2.plot(result.dates, result.index, color='green', linestyle='--', label='大盤指數')
+        ax2.set_ylabel("大盤", color='green')
+        fig.legend(loc="upper left")
+        ax1.grid(True)
+        st.pyplot(fig)
+        st.caption("藍線代表回測期間的資金變化曲線，綠色虛線代表台股大盤指數走勢，用於比較策略與大盤的表現。")
         
         st.markdown("</div>", unsafe_allow_html=True)
 
@@ -755,9 +738,8 @@ if data_source and df is not None and not df.empty:
     st.markdown("<div class='data-card'>", unsafe_allow_html=True)
     st.markdown("<h2 class='card-header'><span>📅</span> 每年年化報酬率</h2>", unsafe_allow_html=True)
     
-    if capital_date and capital_history:
-        # 確保 capital_history 是 DataFrame
-        df_capital = pd.DataFrame({'日期': capital_date, '資金': capital_history})
+    if len(result):
+        df_capital = result.capital_frame()
         df_capital['年份'] = pd.to_datetime(df_capital['日期']).dt.year
         yearly = df_capital.groupby('年份').agg({'資金': ['first', 'last']})
         yearly.columns = ['期初資金', '期末資金']
@@ -801,10 +783,7 @@ if data_source and df is not None and not df.empty:
     st.markdown("<div class='data-card'>", unsafe_allow_html=True)
     st.markdown("<h2 class='card-header'><span>📅</span> 每年指數漲跌幅（收盤價）</h2>", unsafe_allow_html=True)
     
-    df['年份'] = df['日期'].dt.year
-    yearly_index = df.groupby('年份').agg({'收盤價': ['first', 'last']})
-    yearly_index.columns = ['年初收盤', '年末收盤']
-    yearly_index['指數漲跌幅 (%)'] = (yearly_index['年末收盤'] / yearly_index['年初收盤'] - 1) * 100
+    yearly_index = market['yearly_index']
     st.dataframe(yearly_index.style.format({
         '年初收盤': '{:,.2f}', '年末收盤': '{:,.2f}', '指數漲跌幅 (%)': '{:.2f}%'
     }))
@@ -827,10 +806,7 @@ if data_source and df is not None and not df.empty:
     st.markdown("<div class='data-card'>", unsafe_allow_html=True)
     st.markdown("<h2 class='card-header'><span>📊</span> 每月指數漲跌幅（收盤價）</h2>", unsafe_allow_html=True)
     
-    df['月份'] = df['日期'].dt.to_period('M')
-    monthly_index = df.groupby('月份').agg({'收盤價': ['first', 'last']})
-    monthly_index.columns = ['月初收盤', '月末收盤']
-    monthly_index['指數漲跌幅 (%)'] = (monthly_index['月末收盤'] / monthly_index['月初收盤'] - 1) * 100
+    monthly_index = market['monthly_index']
     st.dataframe(monthly_index.reset_index().style.format({
         '月初收盤': '{:,.2f}', '月末收盤': '{:,.2f}', '指數漲跌幅 (%)': '{:.2f}%'
     }))
@@ -860,20 +836,7 @@ if data_source and df is not None and not df.empty:
     st.markdown("<div class='data-card'>", unsafe_allow_html=True)
     st.markdown("<h2 class='card-header'><span>📊</span> 每月指數漲跌幅分布統計（1%、2%、3%...）</h2>", unsafe_allow_html=True)
     
-    bins = list(range(-20, 22))  # -20% ~ 21%
-    labels = [f"{i}%" for i in bins[:-1]]
-    monthly_index['漲跌幅桶'] = pd.cut(
-        monthly_index['指數漲跌幅 (%)'], bins=bins, right=False, labels=labels
-    )
-    bucket_counts = monthly_index['漲跌幅桶'].value_counts().sort_index()
-    total_months = len(monthly_index)
-    bucket_pct = (bucket_counts / total_months * 100).round(2)
-    result_df = pd.DataFrame({
-        '區間': bucket_counts.index,
-        '次數': bucket_counts.values,
-        '百分比(%)': bucket_pct.values
-    })
-    result_df = result_df[result_df['次數'] > 0]
+    result_df = market['bucket_df']
     st.dataframe(result_df, use_container_width=True)
     
     # 長條圖
@@ -913,8 +876,8 @@ if data_source and df is not None and not df.empty:
         win_rate = (trades_df['損益金額(元)'] > 0).mean() * 100 
         
         # --- 最大回撤 (MDD) 計算 ---
-        if capital_history:
-            capital_arr_mdd = np.array(capital_history)
+        if len(result):
+            capital_arr_mdd = result.capital
             
             # 累積高點：找出從開始到每一天為止資金的最高點
             peak_mdd = np.maximum.accumulate(capital_arr_mdd) 
@@ -954,11 +917,28 @@ if data_source and df is not None and not df.empty:
         col6.metric("總交易持有天數", f"{total_days:,} 天")
         
         # MDD 期間的提示
-        if capital_history:
+        if len(result):
              # 【此處是總體最大回撤率比率】
              st.markdown(f"**🔻 最大回撤率 (比率)：** **{max_dd_ratio * 100:.2f} %**") 
              st.caption("此數值為**整個回測期間**，資金從歷史最高峰跌落到谷底的最大百分比損失。")
 
+        # 【交易層級 Bootstrap 信賴區間】
+        if do_bootstrap:
+            st.markdown("### 🎯 交易 Bootstrap 信賴區間")
+            if len(result.trades) >= 2:
+                from bootstrap import confidence_intervals
+                def compute_ci():
+                    with telemetry.timed('bootstrap', rows=boot_rounds, trades=len(result.trades)):
+                        return confidence_intervals(result.trades, boot_rounds, mc_seed, boot_level)
+                ci_df = result_cache.get_or_compute(
+                    ('bootstrap', data_fp, signal_kind, signal_key, moving_avg_days, params,
+                     boot_rounds, mc_seed, boot_level), compute_ci)
+                st.dataframe(ci_df.style.format('{:,.2f}'), use_container_width=True)
+                st.caption(f"將交易明細以放回抽樣重排 {boot_rounds:,} 次，取各指標的 {boot_level:g}% 百分位區間"
+                           "（最大回撤率以每筆交易報酬複利累積，只計平倉點，故可能低於每日資金曲線的回撤）。")
+            else:
+                st.info("交易次數不足，無法計算信賴區間 (至少需要 2 筆交易)。")
+
 
         # 【即時損益狀態顯示】
         st.markdown("### 💡 即時損益")
@@ -971,7 +951,7 @@ if data_source and df is not None and not df.empty:
             st.info("目前無持倉，無即時損益。")
             
         st.markdown("### 💰 總資產與累積報酬率")
-        final_capital = capital_history[-1] if capital_history else start_capital
+        final_capital = result.final_capital if len(result) else start_capital
         total_return = (final_capital - start_capital) / start_capital * 100
         col1, col2 = st.columns(2)
         col1.metric("回測結束資產", f"{final_capital:,.0f} 元")
@@ -1012,12 +992,11 @@ if data_source and df is not None and not df.empty:
 
     # ===== Monte Carlo 模擬 (卡片 15) ======
     # 僅在有足夠資金歷史數據時執行
-    if do_mc and capital_history and len(capital_history) > 2:
+    if do_mc and len(result) > 2:
         st.markdown("<div class='data-card'>", unsafe_allow_html=True)
         st.markdown("<h2 class='card-header'><span>🔀</span> Monte Carlo 模擬資產路徑</h2>", unsafe_allow_html=True)
         
-        np.random.seed(mc_seed)
-        capital_arr = np.array(capital_history)
+        capital_arr = result.capital
         
         # 策略日報酬率：避免除以零
         # 修正：確保分母不為零，且日報酬率的長度是 N-1
@@ -1025,24 +1004,26 @@ if data_source and df is not None and not df.empty:
         capital_arr_safe[capital_arr_safe == 0] = 1 # 避免除以 0，但這情況極少發生
         returns = np.diff(capital_arr) / capital_arr_safe
         
+        sim_results = None
         if len(returns) > 0:
             sim_days = len(returns)
-            sim_rounds = mc_sim_round
-            sim_results = []
-            
-            # 使用進度條顯示模擬進度
-            mc_bar = st.progress(0)
-            for i in range(sim_rounds):
-                # 隨機重抽樣歷史報酬率
-                rand_returns = np.random.choice(returns, sim_days, replace=True)
-                # 計算累積資產路徑 (從 start_capital 開始累積)
-                path = start_capital * np.cumprod(1 + rand_returns)
-                sim_results.append(path)
-                mc_bar.progress((i + 1) / sim_rounds)
-            mc_bar.empty()
-            
-            sim_results = np.array(sim_results)
-            
+            # 分批模擬 (背景執行、可取消)；整個工作共用同一個亂數產生器，結果與逐次抽樣相同
+            rounds = [min(MC_BATCH, mc_sim_round - i) for i in range(0, mc_sim_round, MC_BATCH)]
+            def simulate(k, job):
+                # 隨機重抽樣歷史報酬率，計算累積資產路徑 (從 start_capital 開始累積)
+                with telemetry.timed('monte_carlo', rows=k, days=sim_days):
+                    rand_returns = job.state.choice(returns, (k, sim_days), replace=True)
+                    return start_capital * np.cumprod(1 + rand_returns, axis=1)
+            # 模擬路徑很大，只保留在記憶體 (不寫入檢查點檔案)
+            from job_queue import job_queue
+            mc_key = ('mc', data_fp, signal_kind, signal_key, moving_avg_days, params, mc_sim_round, mc_seed)
+            mc_job = render_job(mc_key, lambda resume: job_queue.submit(
+                mc_key, "Monte Carlo 模擬", rounds, simulate, finalize=np.vstack,
+                state=np.random.RandomState(mc_seed), persist=False, resume=resume))
+            if mc_job is not None:
+                sim_results = mc_job.result
+        
+        if sim_results is not None:
             # 畫出部分模擬路徑
             fig, ax = plt.subplots(figsize=(14, 6))
             for i in range(min(50, sim_results.shape[0])):
@@ -1097,13 +1078,145 @@ if data_source and df is not None and not df.empty:
                 st.dataframe(hist_df, use_container_width=True)
             else:
                  st.warning("模擬數據不足，無法繪製分佈圖。")
-        else:
+        elif len(returns) == 0:
             st.warning("歷史日報酬率數據不足，無法執行 Monte Carlo 模擬。")
         
         st.markdown("</div>", unsafe_allow_html=True)
     elif do_mc:
         st.info("資料不足，無法執行 Monte Carlo 模擬 (至少需要 3 個交易日數據)。")
 
+    # ===== 執行紀錄 (卡片 16) ======
+    if show_history:
+        st.markdown("<div class='data-card'>", unsafe_allow_html=True)
+        st.markdown("<h2 class='card-header'><span>🗂️</span> 執行紀錄</h2>", unsafe_allow_html=True)
+        from run_store import METRIC_LABELS, run_store
+
+        history_metric = st.selectbox("排序指標", list(METRIC_LABELS), format_func=METRIC_LABELS.get)
+        same_period = st.checkbox("只看目前回測區間內的紀錄", value=True)
+        history_df = run_store.best(history_metric,
+                                    start_date if same_period else None, end_date if same_period else None)
+        if not history_df.empty:
+            st.dataframe(history_df.rename(columns={
+                'id': 'ID', 'created': '時間', 'source': '來源', 'start_date': '開始日期', 'end_date': '結束日期',
+                'signal_kind': '訊號', 'signal_kw': '訊號參數', 'ma_days': '均線天數', 'strategy_mode': '回測模式',
+                **METRIC_LABELS}), use_container_width=True, hide_index=True)
+            st.caption("所有 session 的回測與優化結果都會存入本機資料庫；相同設定再次優化時直接取用，不重新計算。")
+
+            compare_ids = st.multiselect("比較資金曲線 (紀錄 ID)", history_df['id'].tolist(),
+                                         default=history_df['id'].tolist()[:3])
+            if compare_ids:
+                fig, ax = plt.subplots(figsize=(14, 5))
+                for run_id in compare_ids:
+                    curve = run_store.equity(run_id)
+                    if curve is not None:
+                        curve_dates, curve_values = curve
+                        ax.plot(curve_dates, curve_values / curve_values[0], label=f"#{run_id}")
+                ax.set_title("資金曲線比較（以起點為 1）")
+                ax.set_ylabel("資金倍數")
+                ax.legend()
+                st.pyplot(fig)
+        else:
+            st.info("目前沒有符合條件的執行紀錄。")
+
+        st.markdown("</div>", unsafe_allow_html=True)
+
+    # ===== 壓力情境測試 (卡片 17) ======
+    if do_stress:
+        st.markdown("<div class='data-card'>", unsafe_allow_html=True)
+        st.markdown("<h2 class='card-header'><span>🧨</span> 壓力情境測試</h2>", unsafe_allow_html=True)
+        from job_queue import job_queue
+        from parallel_sweep import PARALLEL_MIN_TASKS, get_backend
+        from stress import PRE_SHOCK_DAYS, STRESS_METRICS, scenario_info, stress_sweep, worst_case_matrix
+
+        scenarios = {key: SCENARIOS[key] for key in stress_keys}
+        # 候選參數組合：均線天數 × 回測模式 (「從頭抱到尾」與均線無關，只需一組)
+        stress_configs, stress_labels = [], []
+        for mode in stress_modes:
+            for ma in (range(stress_min_ma, stress_max_ma + 1, stress_step) if mode != "從頭抱到尾" else [stress_min_ma]):
+                stress_configs.append({'ma_days': ma, 'strategy_mode': mode, **signal_kw})
+                stress_labels.append(mode if mode == "從頭抱到尾" else f"{ma}日 / {mode}")
+
+        if scenarios and stress_configs:
+            st.dataframe(scenario_info(full_dates, full_close, scenarios, hi).style.format(
+                {'指數漲跌幅 (%)': '{:.2f}'}), use_container_width=True)
+            st.caption("歷史情境取自完整歷史的固定區間；合成情境將衝擊報酬接在目前回測區間的最後一天之後，"
+                       f"並保留衝擊前 {PRE_SHOCK_DAYS} 個交易日讓部位依訊號建立。")
+
+            stress_backend = get_backend() if len(stress_configs) >= PARALLEL_MIN_TASKS else get_backend('serial')
+            batch = PARALLEL_MIN_TASKS if stress_backend.workers > 1 else SWEEP_BATCH
+            stress_batches = [tuple(stress_configs[i:i + batch]) for i in range(0, len(stress_configs), batch)]
+            def stress_batch(configs, job):
+                # 每批：所有情境 × 本批參數組合 (歷史情境共用指標快取中的完整歷史訊號)
+                return stress_sweep(full_dates, full_close, configs, params, signal_kind, scenarios, hi,
+                                    backend=stress_backend, fingerprint=full_fp)
+            stress_key = ('stress', full_fp, hi, signal_kind, signal_key, params, stress_min_ma, stress_max_ma,
+                          stress_step, tuple(stress_modes), tuple(stress_keys))
+            stress_job = render_job(stress_key, lambda resume: job_queue.submit(
+                stress_key, "壓力情境測試", stress_batches, stress_batch,
+                finalize=lambda parts: [row for part in parts for row in part], resume=resume))
+
+            if stress_job is not None:
+                stress_metric = st.selectbox("矩陣指標", list(STRESS_METRICS),
+                                             format_func=lambda key: STRESS_METRICS[key][0])
+                matrix = worst_case_matrix(stress_job.result, stress_labels, stress_metric, scenarios)
+                # 最差值由好到壞排序 (回撤率越小越好)
+                matrix = matrix.sort_values('最差值', ascending=STRESS_METRICS[stress_metric][1] is max)
+                st.dataframe(matrix.style.format('{:.2f}', subset=list(matrix.columns.drop('最差情境'))),
+                             use_container_width=True)
+                st.caption(f"每格為該參數組合在該情境的{STRESS_METRICS[stress_metric][0]}（各情境皆以初始資金重新起算）；"
+                           "「最差值」為所有情境中最差的結果，排序越前面的組合在壓力情境下越穩健。")
+        else:
+            st.info("請至少選擇一個壓力情境與一種回測模式。")
+
+        st.markdown("</div>", unsafe_allow_html=True)
+
+    # ===== 多策略投資組合 (卡片 18) ======
+    if do_portfolio:
+        st.markdown("<div class='data-card'>", unsafe_allow_html=True)
+        st.markdown("<h2 class='card-header'><span>🧺</span> 多策略投資組合</h2>", unsafe_allow_html=True)
+        from portfolio import run_portfolio, sleeve_correlation, sleeve_label, sleeve_summary
+
+        def compute_portfolio():
+            # 所有策略在同一次逐日迴圈中回測 (訊號與單一回測共用指標快取)
+            res = run_portfolio(full_dates, full_close, full_fp, sleeves, params, signal_kind, signal_kw, lo, hi)
+            res.combined.freeze()
+            for arr in (res.equity, res.sleeve_pnl, res.trade_sleeve):
+                arr.setflags(write=False)
+            return res
+        portfolio = result_cache.get_or_compute(
+            ('portfolio', data_fp, signal_kind, signal_key, tuple(sleeves), params), compute_portfolio)
+        pm = portfolio.combined.metrics(start_capital)
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("組合最終資金 (含未平倉)", f"{portfolio.equity[-1]:,.0f} 元")
+        col2.metric("組合累積報酬率", f"{pm['total_return']:.2f}%")
+        col3.metric("組合夏普值", f"{pm['sharpe']:.2f}")
+        col4.metric("組合最大回撤率", f"{pm['max_drawdown']:.2f}%")
+
+        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 8), sharex=True)
+        ax1.plot(portfolio.combined.dates, portfolio.equity, color='blue', label='組合權益 (含未平倉)')
+        ax1.plot(portfolio.combined.dates, portfolio.combined.capital, color='gray', linestyle='--', label='已實現資金')
+        ax1.set_ylabel("資金")
+        ax1.yaxis.set_major_formatter(mticker.FuncFormatter(lambda x, _: f"{int(x):,}"))
+        ax1.legend(loc="upper left")
+        ax1.grid(True)
+        for j, sleeve in enumerate(sleeves):
+            ax2.plot(portfolio.combined.dates, portfolio.sleeve_pnl[:, j], label=sleeve_label(sleeve, j))
+        ax2.set_ylabel("累積損益")
+        ax2.yaxis.set_major_formatter(mticker.FuncFormatter(lambda x, _: f"{int(x):,}"))
+        ax2.legend(loc="upper left")
+        ax2.grid(True)
+        st.pyplot(fig)
+
+        st.dataframe(sleeve_summary(portfolio, sleeves, start_capital).style.format(
+            {'權重 (%)': '{:.1f}', '累積損益 (元)': '{:,.0f}', '報酬貢獻 (%)': '{:.2f}', '勝率 (%)': '{:.2f}'}),
+            use_container_width=True)
+        st.markdown("**各策略每日損益相關係數**")
+        st.dataframe(sleeve_correlation(portfolio, sleeves).style.format('{:.2f}'), use_container_width=True)
+        st.caption("所有策略共用同一個資金池：動態口數依「當日資金 × 權重」計算，固定口數時每個策略各交易設定的口數；"
+                   "保證金追繳以整個帳戶判斷。相關係數越低，組合的分散效果越好。")
+
+        st.markdown("</div>", unsafe_allow_html=True)
+
 else:
     # 這是上傳檔案前的提示
     st.error("❌ 檔案讀取失敗或資料檔案為空。請確認：\n\n1. 您已將資料檔案命名為 **加權指數資料.xlsx**。\n2. 檔案與 `appV6.py` 位於**同一個資料夾**。\n3. 如果是網站部署，請檢查 GitHub 倉庫中是否有這個 Excel 檔案。")
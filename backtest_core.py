@@ -0,0 +1,575 @@
+import hashlib
+import threading
+import types
+import weakref
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+# ====================================
+# 回測參數 (與側邊欄設定一一對應)
+# ====================================
+BacktestParams = namedtuple('BacktestParams', [
+    'strategy_mode', 'start_capital', 'monthly_invest', 'lot_mode', 'fixed_lots',
+    'dynamic_leverage', 'point_value', 'use_fee', 'buy_fee', 'sell_fee',
+    # 期貨執行模型：每口每邊滑價點數、每多一口增加的滑價點數、結算日轉倉、維持保證金率 (% 契約價值，0 = 不檢查)
+    'slippage', 'slippage_per_lot', 'roll', 'maint_margin_pct',
+], defaults=(0.0, 0.0, False, 0.0))
+
+# 執行模型欄位的預設值 (全部為預設值時，回測結果與未加入執行模型前相同)
+EXECUTION_DEFAULTS = dict(zip(BacktestParams._fields[-4:], BacktestParams._field_defaults.values()))
+
+# 命令列工具 (穩健度研究、串流回測) 的預設參數，與側邊欄的預設值相同
+DEFAULT_PARAMS = BacktestParams("雙向：站上多、跌破空", 1000000, 0, "資金動態口數", 1, 2.0, 50, True, 35, 35)
+
+
+def params_from_dict(overrides, base=DEFAULT_PARAMS):
+    """以 dict (例如命令列傳入的 JSON) 覆寫回測參數；不認得的欄位名稱視為錯誤。"""
+    unknown = sorted(set(overrides) - set(BacktestParams._fields))
+    if unknown:
+        raise ValueError(f"未知的回測參數：{', '.join(unknown)}")
+    return base._replace(**overrides)
+
+
+# ====================================
+# 交易紀錄結構 (structured array，每筆固定 70 bytes)
+# ====================================
+TRADE_DTYPE = np.dtype([
+    ('entry_date', 'datetime64[ns]'),
+    ('exit_date', 'datetime64[ns]'),
+    ('direction', 'i1'),        # 1 = 多, -1 = 空
+    ('hold_days', 'i4'),
+    ('entry_price', 'f8'),
+    ('exit_price', 'f8'),
+    ('lots', 'i8'),
+    ('fee', 'f8'),
+    ('profit', 'f8'),
+    ('capital', 'f8'),
+    ('forced', '?'),            # 保證金不足遭強制平倉
+])
+
+# 欄位 -> 交易明細表中文欄名
+TRADE_COLUMNS = {
+    'entry_date': '進場日期', 'exit_date': '出場日期',
+    'direction': '方向', 'hold_days': '持有天數',
+    'entry_price': '進場價', 'exit_price': '出場價',
+    'lots': '交易口數', 'fee': '交易成本(元)',
+    'profit': '損益金額(元)', 'capital': '累積資金(元)',
+    'forced': '強制平倉',
+}
+
+DIRECTION_LABELS = {1: '多', -1: '空'}
+NS_DTYPE = np.dtype('datetime64[ns]')
+
+
+class BacktestResult:
+    """回測結果容器：每日序列為預先配置的 NumPy 陣列，交易為 structured array。"""
+
+    __slots__ = ('dates', 'capital', 'index', 'trades',
+                 'holding', 'position', 'entry_price', 'entry_date')
+
+    def __init__(self, dates, capital, index, trades):
+        self.dates = dates          # datetime64[ns]
+        self.capital = capital      # float64，每日資金
+        self.index = index          # float64，每日收盤價
+        self.trades = trades        # TRADE_DTYPE
+        # 回測結束時的未平倉部位
+        self.holding = False
+        self.position = None
+        self.entry_price = None
+        self.entry_date = None
+
+    def __len__(self):
+        return len(self.capital)
+
+    @property
+    def final_capital(self):
+        return self.capital[-1] if len(self.capital) else np.nan
+
+    def total_return(self, start_capital):
+        """總累積報酬率 (%)。"""
+        if not len(self.capital):
+            return 0
+        return (self.capital[-1] - start_capital) / start_capital * 100
+
+    def metrics(self, start_capital):
+        """摘要指標：最終資金、累積報酬率 (%)、年化夏普值、最大回撤率 (%)、交易次數、勝率 (%)。"""
+        capital = self.capital
+        n_trades = len(self.trades)
+        win_rate = float((self.trades['profit'] > 0).mean() * 100) if n_trades else 0.0
+        if len(capital) < 2:
+            return {'final_capital': float(capital[-1]) if len(capital) else float(start_capital),
+                    'total_return': float(self.total_return(start_capital)), 'sharpe': 0.0,
+                    'max_drawdown': 0.0, 'n_trades': n_trades, 'win_rate': win_rate}
+        prev = capital[:-1].copy()
+        prev[prev == 0] = 1
+        returns = np.diff(capital) / prev
+        std = returns.std()
+        peak = np.maximum.accumulate(capital)
+        return {
+            'final_capital': float(capital[-1]),
+            'total_return': float(self.total_return(start_capital)),
+            'sharpe': float(returns.mean() / std * np.sqrt(252)) if std > 0 else 0.0,
+            'max_drawdown': float(np.max(1 - capital / peak) * 100),
+            'n_trades': n_trades,
+            'win_rate': win_rate,
+        }
+
+    def freeze(self):
+        """將陣列設為唯讀 (放入共享快取前呼叫)。
+
+        dates/index 通常是呼叫端傳入的陣列，改以唯讀的 view 持有，不影響呼叫端原本的陣列。
+        """
+        self.dates = self.dates.view()
+        self.index = self.index.view()
+        for arr in (self.dates, self.capital, self.index, self.trades):
+            arr.setflags(write=False)
+        return self
+
+    def mark_to_market(self, params):
+        """將未平倉部位以最後收盤價計入最終資金。
+
+        回傳 (新結果, 口數, 即時損益)；原結果不變，因此可安全地用於快取中的結果。
+        """
+        if not self.holding or self.entry_price is None:
+            return self, 0, 0
+        p = params
+        capital = self.capital[-1]
+        lots = _lots(capital, self.entry_price, p)
+        # 出場手續費，加上平倉時一併扣除的進出場滑價
+        fee_exit = p.sell_fee * lots if p.use_fee else 0
+        fee_exit += 2 * (p.slippage + p.slippage_per_lot * lots) * p.point_value * lots
+        last_price = self.index[-1]
+        if self.position == '多':
+            unrealized_profit = (last_price - self.entry_price) * lots * p.point_value - fee_exit
+        else:
+            unrealized_profit = (self.entry_price - last_price) * lots * p.point_value - fee_exit
+        settled = BacktestResult(self.dates, self.capital.copy(), self.index, self.trades)
+        settled.holding, settled.position = self.holding, self.position
+        settled.entry_price, settled.entry_date = self.entry_price, self.entry_date
+        settled.capital[-1] += unrealized_profit
+        return settled, lots, unrealized_profit
+
+    def trades_frame(self):
+        """交易明細表 (中文欄名)。"""
+        if not len(self.trades):
+            return pd.DataFrame()
+        t = self.trades
+        data = {TRADE_COLUMNS[name]: t[name] for name in TRADE_DTYPE.names}
+        data['方向'] = np.where(t['direction'] > 0, '多', '空')
+        if not t['forced'].any():
+            # 沒有強制平倉時不顯示該欄
+            del data['強制平倉']
+        return pd.DataFrame(data)
+
+    def capital_frame(self):
+        """每日資金表 (日期, 資金)。"""
+        return pd.DataFrame({'日期': self.dates, '資金': self.capital}, copy=False)
+
+    def yearly_lots(self):
+        """依進場年份加總的交易口數。"""
+        if not len(self.trades):
+            return {}
+        years = self.trades['entry_date'].astype('datetime64[Y]').astype(int) + 1970
+        uniq, inv = np.unique(years, return_inverse=True)
+        totals = np.bincount(inv, weights=self.trades['lots'])
+        return {int(y): int(v) for y, v in zip(uniq, totals)}
+
+
+def data_fingerprint(dates, closes):
+    """資料指紋：以日期與收盤價內容計算，用於快取與共享記憶體的鍵值。"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(dates, dtype='datetime64[ns]').view('int64').tobytes())
+    h.update(np.ascontiguousarray(closes, dtype='float64').tobytes())
+    return h.hexdigest()
+
+
+# 日期陣列 -> 月份陣列 / 結算日旗標的小型備忘錄 (以物件身分為鍵)；掃描時同一日期陣列會被回測上百次。
+# Session 執行緒與背景工作執行緒會同時回測，讀寫都在鎖內進行
+_months_memo = {}
+_settlement_memo = {}
+_memo_lock = threading.Lock()
+
+
+def _memo_get(memo, dates):
+    with _memo_lock:
+        entry = memo.get(id(dates))
+    if entry is not None and entry[0]() is dates:
+        return entry[1]
+    return None
+
+
+def _memo_put(memo, dates, value):
+    """寫入備忘錄 (最多 8 筆，超過時淘汰最早的一筆)；其他執行緒已先寫入時沿用它的結果。"""
+    with _memo_lock:
+        entry = memo.get(id(dates))
+        if entry is not None and entry[0]() is dates:
+            return entry[1]
+        if len(memo) >= 8:
+            memo.pop(next(iter(memo)))
+        memo[id(dates)] = (weakref.ref(dates), value)
+    return value
+
+
+def month_numbers(dates):
+    """月份 (0~11)，僅用於判斷是否換月。"""
+    months = _memo_get(_months_memo, dates)
+    if months is None:
+        months = _memo_put(_months_memo, dates, dates.astype('datetime64[M]').astype('int64') % 12)
+    return months
+
+
+def date_range_bounds(dates, start=None, end=None):
+    """在已排序的日期陣列中以二分搜尋找出 [start, end] (含兩端，以日為單位) 的切片範圍 (lo, hi)。"""
+    lo = 0 if start is None else int(np.searchsorted(dates, np.datetime64(start, 'D'), side='left'))
+    hi = len(dates) if end is None else int(
+        np.searchsorted(dates, np.datetime64(end, 'D') + np.timedelta64(1, 'D'), side='left'))
+    return lo, max(lo, hi)
+
+
+def _lots(capital, entry_price, p):
+    """口數計算：固定口數，或依目前資金與動態槓桿換算。"""
+    if p.lot_mode == "固定口數":
+        return p.fixed_lots
+    return max(int((capital * p.dynamic_leverage) / (entry_price * p.point_value)) if entry_price else 0, 0)
+
+
+# ====================================
+# 回測核心狀態機 (只使用型別固定的陣列與純量，可由 Numba 編譯)
+# ====================================
+# 策略模式代碼：1 = 只做多, -1 = 只做空, 0 = 雙向
+MODE_CODES = {"只做多": 1, "只做空": -1, "雙向：站上多、跌破空": 0}
+
+class LazyJit:
+    """延遲編譯：第一次呼叫時才載入 Numba 並編譯 (載入 Numba 需要數秒，不計入 App 啟動時間)。
+
+    未安裝 Numba 時以純 Python 執行同一份程式碼。
+    """
+
+    def __init__(self, fn, options):
+        self.py_func = fn
+        self._options = options
+        self._compiled = None
+        self._lock = threading.Lock()
+        self.__name__ = fn.__name__
+        self.__doc__ = fn.__doc__
+
+    def _compile(self):
+        with self._lock:
+            if self._compiled is None:
+                try:
+                    from numba import njit as numba_njit
+                    self._compiled = numba_njit(**self._options)(self._with_compiled_helpers())
+                except ImportError:
+                    self._compiled = self.py_func
+            return self._compiled
+
+    def _with_compiled_helpers(self):
+        """函式內呼叫的其他 LazyJit 函式 (例如共用的狀態轉移) 先編譯，並以編譯後的版本取代全域名稱；
+        Numba 只能呼叫已編譯的函式。"""
+        fn = self.py_func
+        helpers = {name: fn.__globals__[name]._compile() for name in fn.__code__.co_names
+                   if isinstance(fn.__globals__.get(name), LazyJit)}
+        if not helpers:
+            return fn
+        scope = dict(fn.__globals__, **helpers)
+        patched = types.FunctionType(fn.__code__, scope, fn.__name__, fn.__defaults__, fn.__closure__)
+        patched.__qualname__, patched.__module__, patched.__doc__ = fn.__qualname__, fn.__module__, fn.__doc__
+        return patched
+
+    def __call__(self, *args):
+        fn = self._compiled
+        if fn is None:
+            fn = self._compile()
+        return fn(*args)
+
+
+def njit(*args, **kwargs):
+    """與 numba.njit 相同的裝飾器用法，但延遲到第一次呼叫才編譯。"""
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return LazyJit(args[0], {})
+    return lambda fn: LazyJit(fn, kwargs)
+
+
+# ====================================
+# 單一部位的狀態轉移 (backtest_kernel 與 portfolio.portfolio_kernel 共用)
+# ====================================
+@njit(cache=True, nogil=True)
+def position_size(capital, entry_price, fixed_lot_mode, fixed_lots, dynamic_leverage, point_value,
+                  fee_per_lot, slippage, slippage_per_lot):
+    """持倉口數 (固定口數，或以 capital 與動態槓桿換算) 與平倉成本 (手續費 + 進出場兩邊的滑價)。"""
+    lots = 0
+    if fixed_lot_mode:
+        lots = fixed_lots
+    elif entry_price != 0:
+        lots = max(int((capital * dynamic_leverage) / (entry_price * point_value)), 0)
+    return lots, (fee_per_lot + 2 * (slippage + slippage_per_lot * lots) * point_value) * lots
+
+
+@njit(cache=True, nogil=True)
+def signal_step(mode_code, holding, position, action):
+    """依當日訊號決定部位變化，回傳 (是否平倉, 收盤後方向)；方向 0 為空手。
+
+    訊號數據缺失 (NaN) 時部位不變；雙向模式平倉後反手。
+    """
+    if action != action:
+        return False, position
+    # 進場判斷
+    if not holding:
+        if mode_code == 1 and action > 0:
+            return False, 1
+        if mode_code == -1 and action < 0:
+            return False, -1
+        if mode_code == 0 and action != 0:
+            return False, 1 if action > 0 else -1
+        return False, 0
+    # 出場/換倉判斷
+    if mode_code == 1:
+        close_out = action < 0 and position == 1
+    elif mode_code == -1:
+        close_out = action > 0 and position == -1
+    elif mode_code == 0:
+        close_out = (position == 1 and action < 0) or (position == -1 and action > 0)
+    else:
+        close_out = False
+    if not close_out:
+        return False, position
+    return True, -position if mode_code == 0 else 0
+
+
+@njit(cache=True, nogil=True)
+def close_position(k, exit_idx, current_price, entry_price, entry_idx, position, lots, point_value,
+                   exit_cost, carry, capital, forced, trades):
+    """以當日收盤價平倉並寫入第 k 筆交易 (trades 為 trade_buffers 的 tuple)，回傳 (平倉後資金, 平倉損益)。
+
+    交易紀錄的成本與損益包含持倉期間的轉倉成本 carry (已在轉倉日自資金扣除)。
+    """
+    profit = (current_price - entry_price) * position * lots * point_value - exit_cost
+    capital += profit
+    trades[0][k] = entry_idx
+    trades[1][k] = exit_idx
+    trades[2][k] = position
+    trades[3][k] = lots
+    trades[4][k] = exit_cost + carry
+    trades[5][k] = profit - carry
+    trades[6][k] = capital
+    trades[7][k] = forced
+    return capital, profit
+
+
+@njit(cache=True, nogil=True)
+def backtest_kernel(months, closes, signal, roll_days, mode_code, monthly_invest,
+                    fixed_lot_mode, fixed_lots, dynamic_leverage, point_value, fee_per_lot,
+                    slippage, slippage_per_lot, margin_rate,
+                    capital, holding, position, entry_price, entry_idx, carry,
+                    capital_out, t_entry, t_exit, t_dir, t_lots, t_fee, t_profit, t_capital, t_forced):
+    """逐日執行進出場、手續費、定期投入與動態口數，以及期貨執行模型 (滑價、轉倉、保證金追繳)。
+
+    第 0 筆視為前一日 (只提供月份/收盤價)，從第 1 筆開始交易；capital/holding/position/
+    entry_price/entry_idx/carry 為起始狀態 (entry_idx = -1 代表部位在本段資料之前建立，
+    carry 為目前部位已支付的轉倉成本)，因此可分段 (串流) 呼叫。
+    滑價每邊每口為 slippage + slippage_per_lot * 口數 (點)，進出場兩邊於平倉時一併扣除；
+    roll_days 為結算日，部位持有跨過結算日 (當天未平倉或反手) 時扣除平舊倉、建新倉的手續費與滑價；
+    權益 (資金 + 未實現損益) 低於 margin_rate * 契約價值時，以當日收盤價強制平倉。
+    回傳 (交易筆數, 資金, 是否持倉, 方向, 進場價, 進場索引, 轉倉成本)。
+    """
+    n = len(closes)
+    trades = (t_entry, t_exit, t_dir, t_lots, t_fee, t_profit, t_capital, t_forced)
+    capital_out[0] = capital
+    n_trades = 0
+
+    for i in range(1, n):
+        # 定期投入
+        if monthly_invest > 0 and months[i] != months[i - 1]:
+            capital += monthly_invest
+
+        current_price = closes[i]
+
+        # 動態口數以當下資金計算
+        lots, exit_cost = 0, 0.0
+        if holding:
+            lots, exit_cost = position_size(capital, entry_price, fixed_lot_mode, fixed_lots, dynamic_leverage,
+                                            point_value, fee_per_lot, slippage, slippage_per_lot)
+
+        # 保證金追繳：權益不足維持保證金時強制平倉
+        if holding and margin_rate > 0 and lots > 0:
+            equity = capital + (current_price - entry_price) * position * lots * point_value
+            if equity < margin_rate * current_price * point_value * lots:
+                capital, _ = close_position(n_trades, i, current_price, entry_price, entry_idx, position, lots,
+                                            point_value, exit_cost, carry, capital, True, trades)
+                n_trades += 1
+                holding = False
+                position = 0
+                entry_idx = -1
+                carry = 0.0
+                capital_out[i] = capital
+                continue
+
+        # 進出場判斷
+        closed, new_position = signal_step(mode_code, holding, position, signal[i])
+        if closed:
+            capital, _ = close_position(n_trades, i, current_price, entry_price, entry_idx, position, lots,
+                                        point_value, exit_cost, carry, capital, False, trades)
+            n_trades += 1
+            carry = 0.0
+        if new_position != 0 and (closed or not holding):
+            # 新進場，或平倉後反手
+            entry_price = current_price
+            entry_idx = i
+        elif closed:
+            entry_idx = -1
+        holding = new_position != 0
+        position = new_position
+
+        # 結算日轉倉 (平舊倉、建新倉各一次)：只適用於收盤後仍持有、且不是當天才建立的部位；
+        # 當天平倉或反手的部位不需轉倉
+        if holding and roll_days[i] and entry_idx != i:
+            capital -= exit_cost
+            carry += exit_cost
+
+        capital_out[i] = capital
+
+    return n_trades, capital, holding, position, entry_price, entry_idx, carry
+
+
+def kernel_params(p):
+    """BacktestParams -> backtest_kernel 的型別化參數 (定期投入 ~ 維持保證金率)。"""
+    fee_per_lot = float(p.buy_fee + p.sell_fee) if p.use_fee else 0.0
+    return (float(p.monthly_invest), p.lot_mode == "固定口數", int(p.fixed_lots),
+            float(p.dynamic_leverage), float(p.point_value), fee_per_lot,
+            float(p.slippage), float(p.slippage_per_lot), float(p.maint_margin_pct) / 100)
+
+
+# 台指期 (TX) 每月第三個星期三結算；遇休市順延至下一個交易日
+def settlement_days(dates):
+    """結算日旗標 (bool 陣列)：每月第三個星期三，當天沒有資料時取其後同月份的第一個交易日。"""
+    flags = _memo_get(_settlement_memo, dates)
+    if flags is not None:
+        return flags
+    flags = np.zeros(len(dates), dtype='bool')
+    if len(dates):
+        days = dates.astype('datetime64[D]')
+        month_starts = np.unique(days.astype('datetime64[M]')).astype('datetime64[D]')
+        third_wed = np.busday_offset(month_starts, 2, roll='forward', weekmask='Wed')
+        idx = np.searchsorted(days, third_wed, side='left')
+        ok = idx < len(days)
+        idx = idx[ok]
+        same_month = days[idx].astype('datetime64[M]') == third_wed[ok].astype('datetime64[M]')
+        flags[idx[same_month]] = True
+    return _memo_put(_settlement_memo, dates, flags)
+
+
+def roll_flags(dates, p):
+    """回測使用的轉倉旗標；未啟用轉倉時全為 False。"""
+    return settlement_days(dates) if p.roll else np.zeros(len(dates), dtype='bool')
+
+
+def trade_buffers(n):
+    """核心寫入交易用的暫存陣列：(進場索引, 出場索引, 方向, 口數, 手續費, 損益, 累積資金, 強制平倉)。"""
+    return (np.empty(n, dtype='int64'), np.empty(n, dtype='int64'), np.empty(n, dtype='int8'),
+            np.empty(n, dtype='int64'), np.empty(n, dtype='float64'), np.empty(n, dtype='float64'),
+            np.empty(n, dtype='float64'), np.empty(n, dtype='bool'))
+
+
+def assemble_trades(dates, closes, k, buffers, carried_entry=None):
+    """將核心輸出的前 k 筆交易組成 structured array (向量化)。
+
+    carried_entry 為 (進場日期, 進場價)，用於進場索引為 -1 (在本段資料之前進場) 的交易。
+    """
+    t_entry, t_exit, t_dir, t_lots, t_fee, t_profit, t_capital, t_forced = (b[:k] for b in buffers)
+    trades = np.empty(k, dtype=TRADE_DTYPE)
+    entry = np.maximum(t_entry, 0)
+    trades['entry_date'] = dates[entry]
+    trades['entry_price'] = closes[entry]
+    if carried_entry is not None and k and t_entry[0] < 0:
+        trades['entry_date'][0] = carried_entry[0]
+        trades['entry_price'][0] = carried_entry[1]
+    trades['exit_date'] = dates[t_exit]
+    trades['direction'] = t_dir
+    trades['hold_days'] = (trades['exit_date'] - trades['entry_date']) // np.timedelta64(1, 'D')
+    trades['exit_price'] = closes[t_exit]
+    trades['lots'] = t_lots
+    trades['fee'] = t_fee
+    trades['profit'] = np.round(t_profit, 2)
+    trades['capital'] = np.round(t_capital, 2)
+    trades['forced'] = t_forced
+    return trades
+
+
+def run_backtest(dates, closes, signal, params, months=None):
+    """均線策略回測。dates/closes/signal 為等長陣列。
+
+    signal 為訊號值 (例如 收盤價 - 均線)：>0 偏多、<0 偏空，NaN 代表暖機期。
+    months 可傳入預先算好的月份陣列 (例如完整歷史月份的切片)，省去重算。
+    """
+    p = params
+    dates = np.asarray(dates)
+    if dates.dtype != NS_DTYPE:
+        dates = dates.astype(NS_DTYPE)
+    closes = np.asarray(closes, dtype='float64')
+    n = len(closes)
+
+    capital_arr = np.empty(n, dtype='float64')
+    result = BacktestResult(dates, capital_arr, closes, np.empty(0, dtype=TRADE_DTYPE))
+    if n == 0:
+        return result
+
+    if months is None:
+        months = month_numbers(dates)
+    capital = p.start_capital
+    capital_arr[0] = capital
+
+    if p.strategy_mode == "從頭抱到尾":
+        if n > 1:
+            entry_price = closes[0]
+            lots = _lots(capital, entry_price, p) if entry_price > 0 else p.fixed_lots
+            fee_per_lot = (p.buy_fee + p.sell_fee) if p.use_fee else 0
+            slip_cost = 2 * (p.slippage + p.slippage_per_lot * lots) * p.point_value * lots
+            fee = fee_per_lot * lots + slip_cost
+            rolls = roll_flags(dates, p)
+            margin_rate = p.maint_margin_pct / 100
+            carry = 0.0
+            exit_i, forced = n - 1, False
+            for i in range(1, n):
+                # 定期投入
+                if p.monthly_invest > 0 and months[i] != months[i - 1]:
+                    capital += p.monthly_invest
+                if exit_i < i:
+                    # 已遭強制平倉，之後只累計定期投入
+                    capital_arr[i] = capital
+                    continue
+                # 每日未平倉損益反映到資本
+                capital += (closes[i] - closes[i - 1]) * lots * p.point_value
+                if margin_rate > 0 and capital < margin_rate * closes[i] * p.point_value * lots:
+                    # 強制平倉：與 backtest_kernel 相同，當日即自資金扣除出場成本 (手續費 + 滑價)，當天不再轉倉
+                    capital -= fee
+                    exit_i, forced = i, True
+                elif rolls[i]:
+                    # 結算日轉倉成本
+                    capital -= fee
+                    carry += fee
+                capital_arr[i] = capital
+            # 視為在最後一天 (或強制平倉日) 平倉，資金已每日計算，這裡只記錄交易細節；
+            # 正常持有到最後一天時沿用原本的做法，出場成本只記在交易紀錄、不自資金曲線扣除
+            final_profit = (closes[exit_i] - entry_price) * lots * p.point_value - fee - carry
+            result.trades = np.empty(1, dtype=TRADE_DTYPE)
+            result.trades[0] = (dates[0], dates[exit_i], 1, (dates[exit_i] - dates[0]) // np.timedelta64(1, 'D'),
+                         entry_price, closes[exit_i], lots, fee + carry, round(final_profit, 2),
+                         round(capital_arr[exit_i], 2), forced)
+        else:
+            capital_arr[:] = capital
+        return result
+
+    mode_code = MODE_CODES.get(p.strategy_mode, 9)
+    buffers = trade_buffers(n)
+    n_trades, _, holding, position, entry_price, entry_idx, _ = backtest_kernel(
+        months, closes, np.asarray(signal, dtype='float64'), roll_flags(dates, p), mode_code, *kernel_params(p),
+        float(p.start_capital), False, 0, 0.0, -1, 0.0, capital_arr, *buffers)
+
+    result.trades = assemble_trades(dates, closes, n_trades, buffers)
+    if holding:
+        result.holding = True
+        result.position = DIRECTION_LABELS[position]
+        result.entry_price = entry_price
+        result.entry_date = pd.Timestamp(dates[entry_idx])
+    return result
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+# 每批重抽樣矩陣的元素上限 (批次數 × 交易數)；暫存記憶體約為此值 × 30 bytes
+BATCH_ELEMENTS = 1_000_000
+
+# 指標 -> 中文名稱
+BOOTSTRAP_LABELS = {
+    'win_rate': '勝率 (%)',
+    'profit_factor': '獲利因子',
+    'expectancy': '每筆期望值 (元)',
+    'max_drawdown': '最大回撤率 (%)',
+}
+
+
+def trade_returns(trades):
+    """每筆交易相對於進場前資金的報酬率 (交易的 capital 欄為平倉後資金)。"""
+    before = trades['capital'] - trades['profit']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.where(before > 0, trades['profit'] / before, 0.0)
+    # 虧損超過本金時以 -99.9999% 計，避免對數發散
+    return np.maximum(r, -0.999999)
+
+
+# ====================================
+# 向量化指標：idx 為 (重抽次數, 交易數) 的索引矩陣，每一列是一組重抽後的交易序列
+# ====================================
+def trade_metrics(profit, log_returns, idx):
+    p = profit[idx]
+    total = p.sum(axis=1)
+    gains = np.maximum(p, 0.0).sum(axis=1)
+    losses = gains - total
+    # 沒有虧損的樣本獲利因子無定義 (以 NaN 表示，計算區間時略過)
+    profit_factor = np.full(len(p), np.nan)
+    np.divide(gains, losses, out=profit_factor, where=losses > 0)
+
+    # 依重抽順序複利累積 (對數空間)，回撤率 = 1 - 資金 / 歷史高點 (起點資金為第一個高點)
+    equity = np.cumsum(log_returns[idx], axis=1)
+    peak = np.maximum(np.maximum.accumulate(equity, axis=1), 0.0)
+    max_drawdown = (1 - np.exp((equity - peak).min(axis=1))) * 100
+    return {
+        'win_rate': np.count_nonzero(p > 0, axis=1) / p.shape[1] * 100,
+        'profit_factor': profit_factor,
+        'expectancy': total / p.shape[1],
+        'max_drawdown': max_drawdown,
+    }
+
+
+def bootstrap_trades(trades, rounds, seed=0):
+    """交易層級 bootstrap：以放回抽樣重排交易清單 rounds 次，回傳 {指標: 長度 rounds 的陣列}。
+
+    每批一次產生整個索引矩陣，向量化計算所有樣本的指標。
+    """
+    n = len(trades)
+    profit = np.ascontiguousarray(trades['profit'], dtype='float64')
+    # 對數報酬以 float32 累加 (回撤率精度足夠，記憶體與時間減半)
+    log_returns = np.log1p(trade_returns(trades)).astype('float32')
+    rng = np.random.default_rng(seed)
+    batch = max(1, BATCH_ELEMENTS // max(n, 1))
+    parts = []
+    for start in range(0, rounds, batch):
+        k = min(batch, rounds - start)
+        idx = rng.integers(0, n, size=(k, n), dtype=np.int32)
+        parts.append(trade_metrics(profit, log_returns, idx))
+    return {name: np.concatenate([part[name] for part in parts]) for name in BOOTSTRAP_LABELS}
+
+
+def confidence_intervals(trades, rounds, seed=0, level=95.0):
+    """各指標的原始值與 bootstrap 百分位信賴區間 (DataFrame，索引為中文指標名稱)。"""
+    samples = bootstrap_trades(trades, rounds, seed)
+    point = trade_metrics(np.asarray(trades['profit'], dtype='float64'),
+                          np.log1p(trade_returns(trades)), np.arange(len(trades))[None, :])
+    tail = (100 - level) / 2
+    rows = []
+    for name, label in BOOTSTRAP_LABELS.items():
+        values = samples[name]
+        values = values[np.isfinite(values)]
+        low, median, high = np.percentile(values, [tail, 50, 100 - tail]) if len(values) else (np.nan,) * 3
+        rows.append({'指標': label, '實際值': point[name][0], '下界': low, '中位數': median, '上界': high})
+    return pd.DataFrame(rows).set_index('指標')
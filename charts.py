@@ -0,0 +1,65 @@
+import importlib
+import threading
+
+# ====================================
+# 中文字型：依序嘗試，第一個存在於系統的字型即採用
+# ====================================
+CJK_FONT_CANDIDATES = [
+    'Microsoft JhengHei',       # Windows
+    'PingFang TC', 'Heiti TC',  # macOS
+    'Noto Sans CJK TC', 'Noto Sans TC', 'Noto Sans CJK JP',  # Linux
+    'WenQuanYi Zen Hei', 'AR PL UMing TW', 'Arial Unicode MS',
+]
+
+_font_lock = threading.Lock()
+_resolved_font = None
+_font_resolved = False
+
+
+def resolve_cjk_font():
+    """找出可用的中文字型 (只掃描一次字型清單，結果快取)；找不到時回傳 None。"""
+    global _resolved_font, _font_resolved
+    with _font_lock:
+        if not _font_resolved:
+            from matplotlib import font_manager
+            installed = {f.name for f in font_manager.fontManager.ttflist}
+            _resolved_font = next((name for name in CJK_FONT_CANDIDATES if name in installed), None)
+            _font_resolved = True
+        return _resolved_font
+
+
+def _setup_pyplot(plt):
+    font = resolve_cjk_font()
+    if font:
+        plt.rcParams['font.family'] = font
+        # 中文字型多半沒有 Unicode 負號字元
+        plt.rcParams['axes.unicode_minus'] = False
+    # 找不到中文字型時維持預設字型，避免每次繪圖都重複查找並警告
+
+
+class LazyModule:
+    """延遲匯入：第一次存取屬性時才 import，並執行一次 setup。"""
+
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name)
+                    if self._setup is not None:
+                        self._setup(module)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+# 畫第一張圖時才載入 matplotlib (模組層級單例，所有 session 共用)
+plt = LazyModule('matplotlib.pyplot', setup=_setup_pyplot)
+mticker = LazyModule('matplotlib.ticker')
@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+
+from shared_cache import indicator_cache
+
+# ====================================
+# 指標快取：鍵值為 (指標, 參數, 資料指紋)，所有 session 共用
+# ====================================
+
+
+def cached(name, params, fingerprint, compute):
+    """取出快取的指標陣列；沒有時呼叫 compute() 計算並存入 (同鍵同時請求只計算一次)。
+
+    fingerprint 為 None 時 (例如串流中的暫時資料段) 不使用快取。
+    """
+    if fingerprint is None:
+        return compute()
+
+    def compute_readonly():
+        arr = compute()
+        # 快取中的陣列由多個回測共用，設為唯讀避免被意外修改
+        arr.setflags(write=False)
+        return arr
+    return indicator_cache.get_or_compute((name, params, fingerprint), compute_readonly)
+
+
+def clear_cache():
+    indicator_cache.clear()
+
+
+# ====================================
+# 基礎指標
+# ====================================
+def sma(closes, fingerprint, days):
+    """簡單移動平均 (與 pandas rolling().mean() 結果一致)。"""
+    return cached('sma', (days,), fingerprint,
+                  lambda: pd.Series(closes).rolling(window=days).mean().to_numpy())
+
+
+def ema(closes, fingerprint, days):
+    """指數移動平均，前 days-1 筆為 NaN。"""
+    return cached('ema', (days,), fingerprint,
+                  lambda: pd.Series(closes).ewm(span=days, adjust=False, min_periods=days).mean().to_numpy())
+
+
+def atr(closes, fingerprint, days):
+    """平均真實波幅 (Wilder 平滑)。資料只有收盤價，真實波幅以 |今收 - 昨收| 近似。"""
+    def compute():
+        tr = pd.Series(closes).diff().abs()
+        return tr.ewm(alpha=1 / days, adjust=False, min_periods=days).mean().to_numpy()
+    return cached('atr', (days,), fingerprint, compute)
+
+
+# ====================================
+# 訊號：回傳 action 陣列 (>0 偏多、<0 偏空、0 觀望、NaN 暖機期)
+# ====================================
+def signal_sma(closes, fingerprint, days):
+    return closes - sma(closes, fingerprint, days)
+
+
+def signal_ema(closes, fingerprint, days):
+    return closes - ema(closes, fingerprint, days)
+
+
+def signal_cross(closes, fingerprint, days, slow_days=60):
+    """雙均線交叉：快線 (days) 減慢線 (slow_days)。"""
+    return sma(closes, fingerprint, days) - sma(closes, fingerprint, slow_days)
+
+
+def signal_band(closes, fingerprint, days, band_pct=1.0):
+    """均線濾網帶：收盤價需穿越均線 ±band_pct% 才轉向，帶內為 0 (維持原部位)。"""
+    ma = sma(closes, fingerprint, days)
+    upper = ma * (1 + band_pct / 100)
+    lower = ma * (1 - band_pct / 100)
+    action = np.where(closes > upper, closes - upper, np.where(closes < lower, closes - lower, 0.0))
+    action[np.isnan(ma)] = np.nan
+    return action
+
+
+def signal_atr_stop(closes, fingerprint, days, atr_mult=3.0):
+    """ATR 移動停損：多頭時停損點只上移，收盤跌破即翻空；空頭反之。"""
+    a = atr(closes, fingerprint, days)
+    out = np.full(len(closes), np.nan)
+    direction = 0
+    stop = np.nan
+    for i in range(len(closes)):
+        if np.isnan(a[i]):
+            continue
+        c = closes[i]
+        if direction == 0:
+            direction, stop = 1, c - atr_mult * a[i]
+        elif direction == 1:
+            if c < stop:
+                direction, stop = -1, c + atr_mult * a[i]
+            else:
+                stop = max(stop, c - atr_mult * a[i])
+        else:
+            if c > stop:
+                direction, stop = 1, c - atr_mult * a[i]
+            else:
+                stop = min(stop, c + atr_mult * a[i])
+        out[i] = c - stop
+    return out
+
+
+# 訊號註冊表：key -> (顯示名稱, 函式)
+SIGNALS = {
+    'sma': ('收盤價 vs 均線 (SMA)', signal_sma),
+    'ema': ('收盤價 vs 指數均線 (EMA)', signal_ema),
+    'cross': ('雙均線交叉', signal_cross),
+    'band': ('均線 + 濾網帶', signal_band),
+    'atr_stop': ('ATR 移動停損', signal_atr_stop),
+}
+
+
+# ====================================
+# 多週期：日 K 重新取樣為週 K / 月 K (每份資料每個週期只計算一次)
+# ====================================
+# 週期代碼 -> 顯示名稱
+TIMEFRAMES = {'D': '日線', 'W': '週線', 'M': '月線'}
+
+# 重新取樣後的 K 棒；資料只有收盤價，開高低收取自該週期內的每日收盤價，last 為週期最後一天的日 K 索引
+BAR_DTYPE = np.dtype([
+    ('date', 'datetime64[ns]'),
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('last', 'i8'),
+])
+
+
+def _period_ids(dates, timeframe):
+    if timeframe == 'W':
+        # datetime64 的週以星期四為起點，位移 3 天改為以星期一為一週的開始
+        return (dates.astype('datetime64[D]').astype('int64') + 3) // 7
+    if timeframe == 'M':
+        return dates.astype('datetime64[M]').astype('int64')
+    raise ValueError(f"未知的週期：{timeframe}")
+
+
+def resample_bars(dates, closes, fingerprint, timeframe):
+    """將日 K 收盤價重新取樣為週 K / 月 K (BAR_DTYPE)，以快取保存。"""
+    def compute():
+        d = np.asarray(dates, dtype='datetime64[ns]')
+        c = np.asarray(closes, dtype='float64')
+        bars = np.empty(0, dtype=BAR_DTYPE)
+        if len(c) == 0:
+            return bars
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(_period_ids(d, timeframe))) + 1])
+        ends = np.concatenate([starts[1:] - 1, [len(c) - 1]])
+        bars = np.empty(len(starts), dtype=BAR_DTYPE)
+        bars['date'] = d[ends]
+        bars['open'] = c[starts]
+        bars['high'] = np.maximum.reduceat(c, starts)
+        bars['low'] = np.minimum.reduceat(c, starts)
+        bars['close'] = c[ends]
+        bars['last'] = ends
+        return bars
+    return cached('bars', (timeframe,), fingerprint, compute)
+
+
+def _timeframe_signal(kind, dates, closes, fingerprint, timeframe, days, kwargs):
+    """在週 K / 月 K 上計算訊號，再對齊回日 K：每天只使用「已收完」的最後一根 K 棒 (不偷看未來)。"""
+    bars = resample_bars(dates, closes, fingerprint, timeframe)
+    bar_fp = None if fingerprint is None else f"{fingerprint}:{timeframe}"
+    action = build_signal(kind, np.ascontiguousarray(bars['close']), bar_fp, days, **kwargs)
+    pos = np.searchsorted(bars['last'], np.arange(len(closes)), side='right') - 1
+    out = np.full(len(closes), np.nan)
+    ok = pos >= 0
+    out[ok] = action[pos[ok]]
+    return out
+
+
+def build_signal(kind, closes, fingerprint, days, dates=None, **kwargs):
+    """依訊號類型產生 action 陣列；days 為主要的均線/波動天數 (優化器掃描的參數)。
+
+    kwargs 中的 timeframe (訊號週期) 與 trend_tf / trend_days (趨勢濾網的週期與均線長度) 為多週期設定，
+    需傳入 dates；加上趨勢濾網時，只有兩者方向一致才給出訊號，不一致時為 0 (維持原部位)。
+    """
+    closes = np.asarray(closes, dtype='float64')
+    timeframe = kwargs.pop('timeframe', 'D')
+    trend_tf = kwargs.pop('trend_tf', None)
+    trend_days = kwargs.pop('trend_days', None)
+    fn = SIGNALS[kind][1]
+    if timeframe == 'D' and trend_tf is None:
+        return cached('signal:' + kind, (days,) + tuple(sorted(kwargs.items())), fingerprint,
+                      lambda: fn(closes, fingerprint, days, **kwargs))
+    if dates is None:
+        raise ValueError("多週期訊號需要傳入日期陣列 (dates)")
+
+    def compute():
+        if timeframe == 'D':
+            action = build_signal(kind, closes, fingerprint, days, **kwargs)
+        else:
+            action = _timeframe_signal(kind, dates, closes, fingerprint, timeframe, days, kwargs)
+        if trend_tf is None:
+            return action
+        trend = _timeframe_signal('sma', dates, closes, fingerprint, trend_tf, int(trend_days), {})
+        out = np.where(np.sign(action) == np.sign(trend), action, 0.0)
+        out[np.isnan(action) | np.isnan(trend)] = np.nan
+        return out
+    return cached('signal:' + kind, (days,) + tuple(sorted(kwargs.items())) + (timeframe, trend_tf, trend_days),
+                  fingerprint, compute)
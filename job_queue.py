@@ -0,0 +1,232 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_cache import estimate_nbytes
+from telemetry import telemetry
+
+# 工作檢查點目錄 (伺服器重啟後可從中斷處繼續)
+JOB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.jobs')
+# 同時執行的背景工作數
+JOB_WORKERS = 2
+# 記憶體中保留的工作數與結果大小上限 (超過時淘汰最舊的已結束工作)
+MAX_JOBS = 64
+MAX_JOB_BYTES = 512 * 2**20
+# 兩次寫入檢查點的最短間隔 (秒)
+CHECKPOINT_INTERVAL = 1.0
+
+QUEUED, RUNNING, DONE, CANCELLED, FAILED = 'queued', 'running', 'done', 'cancelled', 'failed'
+STATUS_LABELS = {QUEUED: '排隊中', RUNNING: '執行中', DONE: '已完成', CANCELLED: '已取消', FAILED: '失敗'}
+
+
+def job_id(key):
+    """由工作鍵值產生固定的工作 ID (重跑或重啟後仍相同)。"""
+    return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8).hexdigest()
+
+
+# ====================================
+# 背景工作：逐項執行，定期寫入檢查點
+# ====================================
+class Job:
+    """由多個項目組成的長時間工作；每完成一項即保留結果，可取消並從中斷處繼續。
+
+    run_item(item, job) 計算單一項目；job.state 為跨項目的可序列化狀態 (例如亂數產生器)；
+    finalize(results) 將各項結果彙整為最終結果。persist=False 時不寫入磁碟 (結果過大時使用)。
+    """
+
+    def __init__(self, key, label, items, run_item, finalize=None, state=None, persist=True):
+        self.key = key
+        self.id = job_id(key)
+        self.label = label
+        self.items = list(items)
+        self.run_item = run_item
+        self.finalize = finalize
+        self.state = state
+        self.persist = persist
+        self.results = []
+        self.result = None
+        self.error = None
+        self.nbytes = 0             # 完成後結果的估算大小 (淘汰依據)
+        self.status = QUEUED
+        self.created = time.time()
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def total(self):
+        return len(self.items)
+
+    @property
+    def done(self):
+        # 完成後各項結果已彙整為 result 並釋放
+        return self.total if self.status == DONE else len(self.results)
+
+    @property
+    def progress(self):
+        return self.done / self.total if self.total else 1.0
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def cancel(self):
+        """要求取消；目前這一項完成後停止，已完成的結果保留在檢查點。"""
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+    # ---- 檢查點 ----
+    @property
+    def checkpoint_path(self):
+        return os.path.join(JOB_DIR, f"{self.id}.pkl")
+
+    def save_checkpoint(self):
+        if not self.persist:
+            return
+        os.makedirs(JOB_DIR, exist_ok=True)
+        data = {'key': self.key, 'items': self.items, 'results': self.results, 'state': self.state,
+                'status': self.status, 'result': self.result if self.status == DONE else None,
+                'error': str(self.error) if self.error is not None else None}
+        # 先寫暫存檔再取代，避免中途當機留下損壞的檢查點
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.checkpoint_path)
+
+    def load_checkpoint(self):
+        """讀回同一工作的檢查點 (鍵值與項目需相同)，回傳檢查點中的狀態；沒有時回傳 None。"""
+        if not self.persist or not os.path.exists(self.checkpoint_path):
+            return None
+        try:
+            with open(self.checkpoint_path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            return None
+        if data.get('key') != self.key or data.get('items') != self.items:
+            return None
+        self.results = list(data['results'])
+        self.state = data['state']
+        self.error = data.get('error')
+        if data['status'] == DONE:
+            self.result = data['result']
+            self.nbytes = estimate_nbytes(self.result)
+        return data['status']
+
+    def resume_from(self, other):
+        """沿用同一工作先前 (已取消或失敗) 的部分結果。"""
+        self.results = list(other.results)
+        self.state = other.state
+
+    def _mark_finished(self, status):
+        self.status = status
+        self.finished_at = time.time()
+        self._finished.set()
+
+    # ---- 執行 ----
+    def run(self):
+        with telemetry.timed('job', job=self.label) as event:
+            self._run()
+            event.update(job_id=self.id, status=self.status, rows=self.done)
+
+    def _run(self):
+        self.status = RUNNING
+        last_save = time.monotonic()
+        try:
+            for item in self.items[len(self.results):]:
+                if self._cancel.is_set():
+                    self.status = CANCELLED
+                    self.save_checkpoint()
+                    self._mark_finished(CANCELLED)
+                    return
+                self.results.append(self.run_item(item, self))
+                if self.persist and time.monotonic() - last_save >= CHECKPOINT_INTERVAL:
+                    self.save_checkpoint()
+                    last_save = time.monotonic()
+            self.result = self.finalize(self.results) if self.finalize else self.results
+            # 只保留彙整後的結果 (例如 Monte Carlo 的模擬矩陣)，避免記憶體與檢查點中各有一份
+            self.results = []
+            self.nbytes = estimate_nbytes(self.result)
+            self.status = DONE
+            self.save_checkpoint()
+            self._mark_finished(DONE)
+        except Exception as e:
+            self.error = e
+            self.status = FAILED
+            self.save_checkpoint()
+            self._mark_finished(FAILED)
+
+
+# ====================================
+# 工作佇列 (程序層級單例，所有 session 共用)
+# ====================================
+class JobQueue:
+    """本機背景工作佇列：同鍵的工作只執行一次，並以工作 ID 查詢進度與結果。"""
+
+    def __init__(self, max_workers=JOB_WORKERS, max_jobs=MAX_JOBS, max_bytes=MAX_JOB_BYTES):
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self._jobs = OrderedDict()      # 工作 ID -> Job
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        return self._executor
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(job_id(key))
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def submit(self, key, label, items, run_item, finalize=None, state=None, persist=True, resume=False):
+        """提交工作並回傳 Job；已有同鍵工作時直接回傳該工作。
+
+        已取消或失敗的工作需 resume=True 才會從檢查點繼續執行。
+        """
+        with self._lock:
+            jid = job_id(key)
+            old = self._jobs.get(jid)
+            if old is not None:
+                self._jobs.move_to_end(jid)
+                if old.status not in (CANCELLED, FAILED) or not old.finished or not resume:
+                    return old
+            job = Job(key, label, items, run_item, finalize, state, persist)
+            if old is not None:
+                job.resume_from(old)
+            else:
+                status = job.load_checkpoint()
+                if status == DONE:
+                    job._mark_finished(DONE)
+                elif status in (CANCELLED, FAILED) and not resume:
+                    job._mark_finished(status)
+            self._jobs[jid] = job
+            self._evict()
+            if not job.finished:
+                self._get_executor().submit(job.run)
+            return job
+
+    def _evict(self):
+        # 依工作數與結果大小，由舊到新淘汰已結束的工作 (檢查點仍保留在磁碟上)；剛提交的工作不淘汰
+        total = sum(job.nbytes for job in self._jobs.values())
+        newest = next(reversed(self._jobs))
+        for jid in list(self._jobs):
+            if len(self._jobs) <= self.max_jobs and total <= self.max_bytes:
+                break
+            job = self._jobs[jid]
+            if job.finished and jid != newest:
+                total -= job.nbytes
+                del self._jobs[jid]
+
+
+job_queue = JobQueue()
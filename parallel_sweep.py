@@ -0,0 +1,544 @@
+"""參數掃描與穩健度研究的執行後端 (本機程序池 / Dask / Ray)。
+
+夜間穩健度研究可直接從命令列執行：
+
+    python parallel_sweep.py 加權指數資料.xlsx configs.json -o robustness.csv
+    python parallel_sweep.py prices.parquet configs.json --backend dask --address tcp://scheduler:8786
+
+configs.json 為參數組合清單，例如 [{"ma_days": 13}, {"ma_days": 20, "strategy_mode": "只做多"}]。
+"""
+import argparse
+import atexit
+import json
+import math
+import os
+import sys
+import threading
+import time
+import warnings
+import multiprocessing as mp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from backtest_core import data_fingerprint, date_range_bounds, month_numbers, params_from_dict, run_backtest
+from indicators import build_signal
+from run_store import compact_equity
+from telemetry import telemetry
+
+# 任務數少於此值時，直接在主程序逐一回測 (開程序池不划算)
+PARALLEL_MIN_TASKS = 40
+# 同時保留的資料區塊上限 (不同年份區間會產生不同區塊)
+MAX_SHARED_BLOCKS = 8
+# 每個工作單位的目標執行時間 (秒)：太短時排程成本佔比高，太長時負載不均
+TARGET_UNIT_SECONDS = 0.5
+# 執行後端與叢集位址 (環境變數)：local / dask / ray / serial
+BACKEND_ENV = 'SWEEP_BACKEND'
+ADDRESS_ENV = 'SWEEP_ADDRESS'
+
+
+# ====================================
+# 共享記憶體價格陣列
+# ====================================
+class SharedPriceArrays:
+    """將日期與收盤價發布到一塊共享記憶體，工作程序以 spec 零拷貝掛載。
+
+    記憶體配置：[日期 int64 (ns) * n][收盤價 float64 * n]
+    """
+
+    def __init__(self, shm, n, owner):
+        self.shm = shm
+        self.n = n
+        self.owner = owner
+        self.refs = 0       # 主程序：使用中的掃描數
+        buf = shm.buf
+        self.dates = np.ndarray((n,), dtype='datetime64[ns]', buffer=buf, offset=0)
+        self.closes = np.ndarray((n,), dtype='float64', buffer=buf, offset=8 * n)
+
+    @property
+    def spec(self):
+        """傳給工作程序的描述 (名稱, 長度)，可被 pickle 且極小。"""
+        return (self.shm.name, self.n)
+
+    @classmethod
+    def publish(cls, dates, closes):
+        n = len(closes)
+        shm = shared_memory.SharedMemory(create=True, size=max(16 * n, 1))
+        obj = cls(shm, n, owner=True)
+        obj.dates[:] = np.asarray(dates, dtype='datetime64[ns]')
+        obj.closes[:] = np.asarray(closes, dtype='float64')
+        return obj
+
+    @classmethod
+    def attach(cls, spec):
+        name, n = spec
+        return cls(shared_memory.SharedMemory(name=name), n, owner=False)
+
+    def close(self):
+        # 先釋放 NumPy 對 buffer 的參照，否則 shm.close() 會失敗
+        self.dates = self.closes = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# 主程序：依資料指紋保存已發布的區塊 (LRU)，重跑 (rerun) 時直接沿用；
+# 多個背景工作可能同時掃描，發布與淘汰都在鎖內進行
+_published = OrderedDict()
+_published_lock = threading.Lock()
+
+
+def publish_prices(dates, closes, fingerprint=None):
+    """發布 (或取回已發布的) 共享價格陣列；fingerprint 可由呼叫端傳入，省去重新雜湊。
+
+    回傳的區塊在呼叫 release_prices() 之前不會被淘汰 (工作程序仍可能掛載它)。
+    """
+    key = fingerprint or data_fingerprint(dates, closes)
+    with _published_lock:
+        arrays = _published.get(key)
+        if arrays is None:
+            arrays = _published[key] = SharedPriceArrays.publish(dates, closes)
+        else:
+            _published.move_to_end(key)
+        arrays.refs += 1
+        _evict_published()
+    return arrays
+
+
+def release_prices(arrays):
+    """掃描結束：釋放 publish_prices() 取得的參照。"""
+    with _published_lock:
+        arrays.refs -= 1
+        _evict_published()
+
+
+def _evict_published():
+    """超過區塊上限時，由最久未使用的區塊開始釋放；使用中的區塊保留到掃描結束 (需持有鎖)。"""
+    excess = len(_published) - MAX_SHARED_BLOCKS
+    for key in [k for k, a in _published.items() if a.refs == 0][:max(excess, 0)]:
+        _published.pop(key).close()
+
+
+@atexit.register
+def _release_published():
+    with _published_lock:
+        for arrays in _published.values():
+            arrays.close()
+        _published.clear()
+
+
+# ====================================
+# 工作程序端
+# ====================================
+# 工作程序：每個資料區塊只掛載一次，之後的任務只帶 spec
+_attached = {}
+
+
+def _attached_arrays(spec):
+    arrays = _attached.get(spec)
+    if arrays is None:
+        if len(_attached) >= MAX_SHARED_BLOCKS:
+            _attached.pop(next(iter(_attached))).close()
+        arrays = _attached[spec] = SharedPriceArrays.attach(spec)
+    return arrays
+
+
+def _run_shared_unit(spec, fingerprint, task, args):
+    """本機程序池：由共享記憶體掛載價格陣列後執行任務。"""
+    arrays = _attached_arrays(spec)
+    return task(arrays.dates, arrays.closes, fingerprint, *args)
+
+
+def _run_remote_unit(prices, task, args):
+    """多節點後端：價格陣列隨任務廣播 (各節點只收一次)。"""
+    dates, closes, fingerprint = prices
+    return task(dates, closes, fingerprint, *args)
+
+
+# ====================================
+# 任務：(完整日期, 完整收盤價, 資料指紋, *參數) -> 一個工作單位的結果清單
+# ====================================
+def ma_task(full_dates, full_closes, fingerprint, params, signal_kind, signal_kw, lo, hi, ma_list):
+    """回測一批均線天數，回傳 [(均線天數, 摘要指標, 壓縮資金曲線), ...]。
+
+    指標在完整歷史上計算 (含暖機期)，回測只取 [lo, hi) 區間；失敗時摘要指標為 None。
+    """
+    dates, closes = full_dates[lo:hi], full_closes[lo:hi]
+    months = month_numbers(full_dates)[lo:hi]
+    out = []
+    for ma in ma_list:
+        try:
+            signal = build_signal(signal_kind, full_closes, fingerprint, ma, full_dates, **signal_kw)[lo:hi]
+            result = run_backtest(dates, closes, signal, params, months)
+            out.append((ma, result.metrics(params.start_capital), compact_equity(result.dates, result.capital)))
+        except Exception:
+            out.append((ma, None, None))
+    return out
+
+
+def split_config(config, params):
+    """參數組合 -> (均線天數, 訊號附加參數, BacktestParams)；非 BacktestParams 欄位的鍵視為訊號參數。"""
+    config = dict(config)
+    ma = config.pop('ma_days')
+    kw = {k: config.pop(k) for k in list(config) if k not in params._fields}
+    return ma, kw, params._replace(**config)
+
+
+def robustness_task(full_dates, full_closes, fingerprint, params, signal_kind, lo, hi,
+                    mc_rounds, mc_seed, indexed_configs):
+    """一批參數組合：回測後以 Monte Carlo 重抽樣日報酬，回傳 [(組合序號, 摘要), ...]。
+
+    每個組合的亂數種子由 (mc_seed, 組合序號) 決定，因此結果與工作單位的切法、執行後端無關。
+    """
+    dates, closes = full_dates[lo:hi], full_closes[lo:hi]
+    months = month_numbers(full_dates)[lo:hi]
+    out = []
+    for idx, config in indexed_configs:
+        ma, kw, p = split_config(config, params)
+        try:
+            signal = build_signal(signal_kind, full_closes, fingerprint, ma, full_dates, **kw)[lo:hi]
+            result = run_backtest(dates, closes, signal, p, months)
+        except Exception:
+            out.append((idx, None))
+            continue
+        summary = result.metrics(p.start_capital)
+        capital = result.capital
+        if mc_rounds and len(capital) > 2:
+            prev = capital[:-1].copy()
+            prev[prev == 0] = 1
+            returns = np.diff(capital) / prev
+            rng = np.random.default_rng([int(mc_seed), int(idx)])
+            finals = p.start_capital * np.prod(1 + rng.choice(returns, (mc_rounds, len(returns))), axis=1)
+            summary.update({
+                'mc_p5': float(np.percentile(finals, 5)),
+                'mc_p50': float(np.percentile(finals, 50)),
+                'mc_p95': float(np.percentile(finals, 95)),
+                'mc_loss_prob': float(np.mean(finals < p.start_capital) * 100),
+            })
+        out.append((idx, summary))
+    return out
+
+
+# ====================================
+# 執行後端：run(task, dates, closes, units, progress, fingerprint) 依工作單位順序回傳結果
+# (fingerprint 為 dates/closes 的資料指紋，由呼叫端計算一次後傳入；未提供時才自行計算)
+# ====================================
+class SerialBackend:
+    """在目前程序中逐一執行 (單核心或除錯時使用)。"""
+
+    name = 'serial'
+    workers = 1
+
+    def run(self, task, dates, closes, units, progress=None, fingerprint=None):
+        fingerprint = fingerprint or data_fingerprint(dates, closes)
+        results = []
+        for i, args in enumerate(units):
+            results.append(task(dates, closes, fingerprint, *args))
+            if progress is not None:
+                progress(i + 1, len(units))
+        return results
+
+
+class LocalProcessBackend:
+    """本機程序池；價格陣列經共享記憶體零拷貝傳給工作程序。"""
+
+    name = 'local'
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+
+    @property
+    def workers(self):
+        return get_pool(self.max_workers)._max_workers
+
+    def run(self, task, dates, closes, units, progress=None, fingerprint=None):
+        fingerprint = fingerprint or data_fingerprint(dates, closes)
+        arrays = publish_prices(dates, closes, fingerprint)
+        futures = {}
+        try:
+            pool = get_pool(self.max_workers)
+            futures = {pool.submit(_run_shared_unit, arrays.spec, fingerprint, task, args): i
+                       for i, args in enumerate(units)}
+            return _gather(futures, as_completed(futures), lambda fut: fut.result(), len(units), progress)
+        finally:
+            # 中途失敗或取消時，取消尚未開始的工作單位並等執行中的結束，之後區塊才可被淘汰
+            for fut in futures:
+                fut.cancel()
+            wait(futures)
+            release_prices(arrays)
+
+
+class DaskBackend:
+    """Dask 分散式後端；未指定位址時啟動本機 LocalCluster (測試用)。"""
+
+    name = 'dask'
+
+    def __init__(self, address=None):
+        from dask.distributed import Client, LocalCluster
+        if address:
+            self.client = Client(address)
+        else:
+            self.client = Client(LocalCluster(n_workers=os.cpu_count() or 1, threads_per_worker=1))
+
+    @property
+    def workers(self):
+        return max(1, sum(w['nthreads'] for w in self.client.scheduler_info()['workers'].values()))
+
+    def run(self, task, dates, closes, units, progress=None, fingerprint=None):
+        from dask.distributed import as_completed as dask_completed
+        prices = self.client.scatter((dates, closes, fingerprint or data_fingerprint(dates, closes)), broadcast=True)
+        futures = {self.client.submit(_run_remote_unit, prices, task, args, pure=False): i
+                   for i, args in enumerate(units)}
+        return _gather(futures, dask_completed(list(futures)), lambda fut: fut.result(), len(units), progress)
+
+
+class RayBackend:
+    """Ray 分散式後端；未指定位址時啟動本機 Ray (測試用)。"""
+
+    name = 'ray'
+
+    def __init__(self, address=None):
+        import ray
+        self.ray = ray
+        if not ray.is_initialized():
+            ray.init(address=address or None, ignore_reinit_error=True)
+        self._remote = ray.remote(_run_remote_unit)
+
+    @property
+    def workers(self):
+        return max(1, int(self.ray.cluster_resources().get('CPU', 1)))
+
+    def run(self, task, dates, closes, units, progress=None, fingerprint=None):
+        prices = self.ray.put((dates, closes, fingerprint or data_fingerprint(dates, closes)))
+        refs = {self._remote.remote(prices, task, args): i for i, args in enumerate(units)}
+
+        def completed():
+            pending = list(refs)
+            while pending:
+                ready, pending = self.ray.wait(pending, num_returns=1)
+                yield from ready
+        return _gather(refs, completed(), self.ray.get, len(units), progress)
+
+
+def _gather(handles, completed, result_of, total, progress):
+    """依完成順序收集結果並回報進度，最後依工作單位順序排列 (聚合結果與排程無關)。"""
+    results = [None] * total
+    for done, handle in enumerate(completed, start=1):
+        results[handles[handle]] = result_of(handle)
+        if progress is not None:
+            progress(done, total)
+    return results
+
+
+# 後端註冊表：名稱 -> 類別
+BACKENDS = {'serial': SerialBackend, 'local': LocalProcessBackend, 'dask': DaskBackend, 'ray': RayBackend}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=None, address=None):
+    """取得 (並快取) 執行後端；預設讀取環境變數 SWEEP_BACKEND / SWEEP_ADDRESS。
+
+    Dask / Ray 未安裝或無法連線時，退回本機程序池。
+    """
+    name = (name or os.environ.get(BACKEND_ENV) or 'local').lower()
+    address = address or os.environ.get(ADDRESS_ENV) or None
+    if name not in BACKENDS:
+        raise ValueError(f"未知的執行後端：{name}")
+    with _backends_lock:
+        backend = _backends.get((name, address))
+        if backend is None:
+            try:
+                backend = BACKENDS[name](address) if name in ('dask', 'ray') else BACKENDS[name]()
+            except Exception as e:
+                warnings.warn(f"無法啟動 {name} 執行後端 ({e})，改用本機程序池")
+                backend = LocalProcessBackend()
+            _backends[(name, address)] = backend
+        return backend
+
+
+# ====================================
+# 工作單位大小
+# ====================================
+def auto_unit_size(total, workers, seconds_per_task, target_seconds=TARGET_UNIT_SECONDS):
+    """依單一任務耗時決定每個工作單位的任務數：每單位約 target_seconds 秒，且每個 worker 至少分到 2 個單位。"""
+    if total <= 0:
+        return 1
+    by_time = math.ceil(target_seconds / max(seconds_per_task, 1e-6))
+    by_balance = math.ceil(total / (max(workers, 1) * 2))
+    return max(1, min(by_time, by_balance))
+
+
+def _split(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# ====================================
+# 主程序端
+# ====================================
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def get_pool(max_workers=None):
+    """程序內共用的程序池 (延遲建立，所有 session 共用)。"""
+    global _pool, _pool_workers
+    workers = max_workers or max(1, (os.cpu_count() or 1) - 1)
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            # spawn：與 Windows 行為一致，也避免在多執行緒的 Streamlit 伺服器中 fork
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'))
+            _pool_workers = workers
+        return _pool
+
+
+@atexit.register
+def _shutdown_pool():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+
+
+def sweep_ma(dates, closes, ma_range, params, signal_kind='sma', signal_kw=None,
+             lo=0, hi=None, backend=None, progress=None, fingerprint=None):
+    """掃描均線天數，回傳依均線天數排序的 [(均線天數, 摘要指標, 壓縮資金曲線), ...]。
+
+    dates/closes 為完整歷史，回測區間為切片 [lo, hi)；backend 預設為 get_backend()；
+    progress 為可選的回呼 progress(完成數, 總數)；fingerprint 為完整歷史的資料指紋 (未提供時計算一次)。
+    """
+    ma_list = list(ma_range)
+    total = len(ma_list)
+    if total == 0:
+        return []
+    backend = backend or get_backend()
+    hi = len(closes) if hi is None else hi
+    signal_kw = signal_kw or {}
+    # 先在主程序回測第一個均線天數，量測單一任務耗時以決定工作單位大小
+    t0 = time.perf_counter()
+    fingerprint = fingerprint or data_fingerprint(dates, closes)
+    first = ma_task(dates, closes, fingerprint, params, signal_kind, signal_kw, lo, hi, ma_list[:1])
+    size = auto_unit_size(total - 1, backend.workers, time.perf_counter() - t0)
+    units = [(params, signal_kind, signal_kw, lo, hi, part) for part in _split(ma_list[1:], size)]
+    results = list(first)
+    with telemetry.timed('sweep_dispatch', rows=total - 1, backend=backend.name, units=len(units)):
+        for part in backend.run(ma_task, dates, closes, units, _unit_progress(units, progress, total, 1), fingerprint):
+            results.extend(part)
+    results.sort(key=lambda x: x[0])
+    return results
+
+
+def robustness_sweep(dates, closes, configs, params, signal_kind='sma', lo=0, hi=None,
+                     mc_rounds=200, mc_seed=0, backend=None, progress=None, fingerprint=None):
+    """大量參數組合的穩健度研究：每組回測 + Monte Carlo，回傳與 configs 同順序的摘要清單。
+
+    configs 為 dict 清單，需含 'ma_days'，其餘鍵為 BacktestParams 欄位或訊號附加參數；
+    失敗的組合回傳 None。結果只由輸入與 mc_seed 決定，與後端與工作單位大小無關。
+    fingerprint 為完整歷史的資料指紋 (未提供時計算一次)。
+    """
+    configs = list(configs)
+    total = len(configs)
+    if total == 0:
+        return []
+    backend = backend or get_backend()
+    hi = len(closes) if hi is None else hi
+    indexed = [(i, tuple(sorted(c.items()))) for i, c in enumerate(configs)]
+    t0 = time.perf_counter()
+    fingerprint = fingerprint or data_fingerprint(dates, closes)
+    first = robustness_task(dates, closes, fingerprint, params, signal_kind, lo, hi,
+                            mc_rounds, mc_seed, indexed[:1])
+    size = auto_unit_size(total - 1, backend.workers, time.perf_counter() - t0)
+    units = [(params, signal_kind, lo, hi, mc_rounds, mc_seed, part) for part in _split(indexed[1:], size)]
+    summaries = [None] * total
+    for idx, summary in first:
+        summaries[idx] = summary
+    with telemetry.timed('robustness_dispatch', rows=total - 1, backend=backend.name, units=len(units),
+                         mc_rounds=mc_rounds):
+        for part in backend.run(robustness_task, dates, closes, units, _unit_progress(units, progress, total, 1),
+                                fingerprint):
+            for idx, summary in part:
+                summaries[idx] = summary
+    return summaries
+
+
+def _unit_progress(units, progress, total, already_done):
+    """將「完成的工作單位數」換算成 (約略的) 完成任務數回報。"""
+    if progress is None:
+        return None
+    progress(already_done, total)
+    return lambda done_units, n_units: progress(
+        already_done + round((total - already_done) * done_units / max(n_units, 1)), total)
+
+
+
+# ====================================
+# 命令列：夜間穩健度研究
+# ====================================
+def read_prices(path):
+    """讀取價格檔的 (日期, 收盤價)，依日期排序。Excel 與 App 相同取前兩欄；CSV / Parquet 沿用串流模式的讀檔。"""
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext in ('.xlsx', '.xls'):
+        frame = pd.read_excel(path)
+        dates = pd.to_datetime(frame.iloc[:, 0]).to_numpy(dtype='datetime64[ns]')
+        closes = frame.iloc[:, 1].to_numpy(dtype='float64')
+    else:
+        from streaming import iter_price_chunks
+        chunks = list(iter_price_chunks(path))
+        dates = np.concatenate([d for d, _ in chunks]) if chunks else np.empty(0, dtype='datetime64[ns]')
+        closes = np.concatenate([c for _, c in chunks]) if chunks else np.empty(0, dtype='float64')
+    order = np.argsort(dates, kind='stable')
+    return dates[order], closes[order]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data', help="價格檔 (.xlsx / .csv / .parquet，前兩欄為日期、收盤價)")
+    parser.add_argument('configs', help="參數組合 JSON 檔 (dict 清單，需含 ma_days)")
+    parser.add_argument('-o', '--output', default='robustness.csv', help="結果 CSV (參數組合 + 摘要指標)")
+    parser.add_argument('--params', default='{}', help="基本回測參數 (JSON，BacktestParams 欄位)，參數組合中的鍵會再覆寫")
+    parser.add_argument('--signal', default='sma', help="訊號類型 (indicators.SIGNALS 的鍵)")
+    parser.add_argument('--start', help="回測開始日期 (YYYY-MM-DD)")
+    parser.add_argument('--end', help="回測結束日期 (YYYY-MM-DD)")
+    parser.add_argument('--mc-rounds', type=int, default=200)
+    parser.add_argument('--mc-seed', type=int, default=0)
+    parser.add_argument('--backend', choices=list(BACKENDS), help=f"執行後端 (預設讀取 {BACKEND_ENV}，否則為 local)")
+    parser.add_argument('--address', help=f"Dask / Ray 叢集位址 (預設讀取 {ADDRESS_ENV})")
+    args = parser.parse_args(argv)
+
+    with open(args.configs, encoding='utf-8') as f:
+        configs = json.load(f)
+    if not isinstance(configs, list) or not all(isinstance(c, dict) and 'ma_days' in c for c in configs):
+        parser.error("參數組合需為含 ma_days 的 dict 清單")
+    params = params_from_dict(json.loads(args.params))
+    dates, closes = read_prices(args.data)
+    lo, hi = date_range_bounds(dates, args.start, args.end)
+    if hi == lo:
+        parser.error("所選回測區間沒有任何資料")
+
+    backend = get_backend(args.backend, args.address)
+    print(f"{len(configs)} 組參數，{hi - lo} 根 K 棒，執行後端 {backend.name} ({backend.workers} 個 worker)", file=sys.stderr)
+
+    def progress(done, total):
+        print(f"\r完成 {done}/{total}", end='', file=sys.stderr, flush=True)
+
+    t0 = time.perf_counter()
+    summaries = robustness_sweep(dates, closes, configs, params, args.signal, lo, hi, args.mc_rounds, args.mc_seed,
+                                 backend, progress)
+    print(f"\n耗時 {time.perf_counter() - t0:.1f} 秒", file=sys.stderr)
+    # 失敗的組合摘要欄位留空
+    frame = pd.concat([pd.DataFrame(configs), pd.DataFrame([s or {} for s in summaries])], axis=1)
+    frame.to_csv(args.output, index=False)
+    failed = sum(s is None for s in summaries)
+    print(f"結果已寫入 {args.output}" + (f"，{failed} 組失敗" if failed else ""), file=sys.stderr)
+    return 1 if failed == len(summaries) else 0
+
+
+if __name__ == '__main__':
+    # 以模組名稱匯入後再執行：送往工作程序的任務函式才會是 parallel_sweep.xxx，而不是 __main__.xxx
+    from parallel_sweep import main as _main
+    sys.exit(_main())
@@ -0,0 +1,215 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from backtest_core import (
+    MODE_CODES, NS_DTYPE, BacktestResult, assemble_trades, close_position, kernel_params, month_numbers, njit,
+    position_size, roll_flags, signal_step, trade_buffers,
+)
+from indicators import build_signal
+from telemetry import telemetry
+
+# 策略實例：均線天數、回測模式 (不含「從頭抱到尾」)、資金配置權重
+Sleeve = namedtuple('Sleeve', ['ma_days', 'strategy_mode', 'weight'])
+
+# 投資組合結果：合併結果 (BacktestResult，資金為共用資金池)、每日權益 (含未實現損益)、
+# 各策略累積損益 (K 棒數 × 策略數，含未實現損益)、每筆交易所屬的策略序號
+PortfolioResult = namedtuple('PortfolioResult', ['combined', 'equity', 'sleeve_pnl', 'trade_sleeve'])
+
+
+def sleeve_label(sleeve, j):
+    """策略名稱 (加上序號，相同設定重複加入時仍可區分)。"""
+    return f"#{j + 1} {sleeve.ma_days}日 / {sleeve.strategy_mode}"
+
+
+def normalize_weights(sleeves):
+    """配置權重正規化為總和 1 (全為 0 時平均分配)。"""
+    w = np.array([max(float(s.weight), 0.0) for s in sleeves], dtype='float64')
+    return w / w.sum() if w.sum() > 0 else np.full(len(w), 1.0 / max(len(w), 1))
+
+
+# ====================================
+# 投資組合核心：所有策略在同一次逐日迴圈中同步執行，共用一個資金池
+# ====================================
+@njit(cache=True, nogil=True)
+def portfolio_kernel(months, closes, signals, roll_days, mode_codes, weights, monthly_invest,
+                     fixed_lot_mode, fixed_lots, dynamic_leverage, point_value, fee_per_lot,
+                     slippage, slippage_per_lot, margin_rate, capital,
+                     capital_out, equity_out, pnl_out,
+                     t_entry, t_exit, t_dir, t_lots, t_fee, t_profit, t_capital, t_forced, t_sleeve):
+    """signals 為 (K 棒數, 策略數) 的訊號矩陣；各策略的部位狀態各自獨立，損益與成本都進出同一個資金池。
+
+    動態口數以「當日資金 × 權重」計算 (每日依權重重新分配)，固定口數時每個策略各交易 fixed_lots 口；
+    保證金追繳以資金池總權益對所有部位的維持保證金合計判斷，不足時全部強制平倉。
+    單一策略、權重 1 時與 backtest_kernel 的結果相同。
+    回傳 (交易筆數, 資金)。
+    """
+    n, m = signals.shape
+    trades = (t_entry, t_exit, t_dir, t_lots, t_fee, t_profit, t_capital, t_forced)
+    holding = np.zeros(m, dtype=np.bool_)
+    position = np.zeros(m, dtype=np.int64)
+    entry_price = np.zeros(m)
+    entry_idx = np.full(m, -1, dtype=np.int64)
+    carry = np.zeros(m)
+    realized = np.zeros(m)      # 各策略已實現損益 (含已支付的轉倉成本)
+    lots = np.zeros(m, dtype=np.int64)
+    exit_cost = np.zeros(m)
+    stale = np.ones(m, dtype=np.bool_)
+    sized_capital = np.nan
+    capital_out[0] = capital
+    equity_out[0] = capital
+    pnl_out[0, :] = 0.0
+    n_trades = 0
+
+    for i in range(1, n):
+        # 定期投入
+        if monthly_invest > 0 and months[i] != months[i - 1]:
+            capital += monthly_invest
+
+        current_price = closes[i]
+
+        # 各策略的口數一律以當日開始時的資金池計算 (與策略的處理順序無關)；
+        # 資金與進場價不變時沿用前一日的口數與出場成本，省去逐日除法
+        resize = capital != sized_capital
+        sized_capital = capital
+        total_lots = 0
+        unrealized = 0.0
+        for j in range(m):
+            if not holding[j]:
+                continue
+            if resize or stale[j]:
+                stale[j] = False
+                lots[j], exit_cost[j] = position_size(capital * weights[j], entry_price[j], fixed_lot_mode, fixed_lots,
+                                                      dynamic_leverage, point_value, fee_per_lot, slippage,
+                                                      slippage_per_lot)
+            total_lots += lots[j]
+            unrealized += (current_price - entry_price[j]) * position[j] * lots[j] * point_value
+
+        # 保證金追繳：資金池權益不足全部部位的維持保證金時，全部強制平倉
+        if margin_rate > 0 and total_lots > 0 and capital + unrealized < margin_rate * current_price * point_value * total_lots:
+            for j in range(m):
+                if not holding[j]:
+                    continue
+                capital, profit = close_position(n_trades, i, current_price, entry_price[j], entry_idx[j], position[j],
+                                                 lots[j], point_value, exit_cost[j], carry[j], capital, True, trades)
+                realized[j] += profit
+                t_sleeve[n_trades] = j
+                n_trades += 1
+                holding[j] = False
+                position[j] = 0
+                entry_idx[j] = -1
+                carry[j] = 0.0
+            capital_out[i] = capital
+            equity_out[i] = capital
+            for j in range(m):
+                pnl_out[i, j] = realized[j]
+            continue
+
+        # 各策略的進出場判斷 (與 backtest_kernel 共用同一個狀態轉移)
+        for j in range(m):
+            closed, new_position = signal_step(mode_codes[j], holding[j], position[j], signals[i, j])
+            if closed:
+                capital, profit = close_position(n_trades, i, current_price, entry_price[j], entry_idx[j], position[j],
+                                                 lots[j], point_value, exit_cost[j], carry[j], capital, False, trades)
+                realized[j] += profit
+                t_sleeve[n_trades] = j
+                n_trades += 1
+                carry[j] = 0.0
+            if new_position != 0 and (closed or not holding[j]):
+                # 新進場，或平倉後反手
+                entry_price[j] = current_price
+                entry_idx[j] = i
+                stale[j] = True
+            elif closed:
+                entry_idx[j] = -1
+            holding[j] = new_position != 0
+            position[j] = new_position
+
+        # 每日權益與各策略累積損益 (未平倉部位以收盤價計算，不含尚未支付的出場成本)；
+        # 結算日轉倉只適用於收盤後仍持有、且不是當天才建立的部位 (當天平倉或反手的部位不需轉倉)
+        unrealized = 0.0
+        for j in range(m):
+            open_pnl = 0.0
+            if holding[j]:
+                if roll_days[i] and entry_idx[j] != i:
+                    capital -= exit_cost[j]
+                    carry[j] += exit_cost[j]
+                    realized[j] -= exit_cost[j]
+                open_pnl = (current_price - entry_price[j]) * position[j] * lots[j] * point_value
+            pnl_out[i, j] = realized[j] + open_pnl
+            unrealized += open_pnl
+        capital_out[i] = capital
+        equity_out[i] = capital + unrealized
+
+    return n_trades, capital
+
+
+def portfolio_backtest(dates, closes, signals, sleeves, params, months=None):
+    """多策略共用資金池的回測。signals 為 (K 棒數, 策略數) 的訊號矩陣 (欄位順序同 sleeves)。
+
+    params 中的 strategy_mode 不使用 (由各策略自行指定)，其餘資金、口數與成本設定所有策略共用。
+    """
+    p = params
+    dates = np.asarray(dates, dtype=NS_DTYPE)
+    closes = np.asarray(closes, dtype='float64')
+    signals = np.ascontiguousarray(signals, dtype='float64').reshape(len(closes), len(sleeves))
+    unknown = [s.strategy_mode for s in sleeves if s.strategy_mode not in MODE_CODES]
+    if unknown:
+        raise ValueError(f"投資組合不支援策略模式：{unknown[0]}")
+    n, m = signals.shape
+    if months is None:
+        months = month_numbers(dates)
+
+    capital = np.empty(n, dtype='float64')
+    equity = np.empty(n, dtype='float64')
+    pnl = np.empty((n, m), dtype='float64')
+    if n == 0:
+        return PortfolioResult(BacktestResult(dates, capital, closes, assemble_trades(dates, closes, 0, trade_buffers(0))),
+                               equity, pnl, np.empty(0, dtype='int64'))
+    # 每個策略每天最多平倉一次
+    buffers = trade_buffers(n * m)
+    t_sleeve = np.empty(n * m, dtype='int64')
+    mode_codes = np.array([MODE_CODES[s.strategy_mode] for s in sleeves], dtype='int64')
+    n_trades, _ = portfolio_kernel(
+        months, closes, signals, roll_flags(dates, p), mode_codes, normalize_weights(sleeves), *kernel_params(p),
+        float(p.start_capital), capital, equity, pnl, *buffers, t_sleeve)
+    combined = BacktestResult(dates, capital, closes, assemble_trades(dates, closes, n_trades, buffers))
+    return PortfolioResult(combined, equity, pnl, t_sleeve[:n_trades].copy())
+
+
+def run_portfolio(full_dates, full_closes, fingerprint, sleeves, params, signal_kind='sma', signal_kw=None,
+                  lo=0, hi=None):
+    """在完整歷史上取各策略的訊號 (指標快取與單一回測共用)，切出回測區間 [lo, hi) 後一次回測所有策略。"""
+    hi = len(full_closes) if hi is None else hi
+    signal_kw = signal_kw or {}
+    with telemetry.timed('portfolio', rows=(hi - lo) * len(sleeves), signal=signal_kind, sleeves=len(sleeves)):
+        signals = np.empty((hi - lo, len(sleeves)), dtype='float64')
+        for j, s in enumerate(sleeves):
+            signals[:, j] = build_signal(signal_kind, full_closes, fingerprint, s.ma_days, full_dates, **signal_kw)[lo:hi]
+        return portfolio_backtest(full_dates[lo:hi], full_closes[lo:hi], signals, sleeves, params,
+                                  month_numbers(full_dates)[lo:hi])
+
+
+# ====================================
+# 彙總
+# ====================================
+def sleeve_summary(result, sleeves, start_capital):
+    """各策略的配置權重、累積損益、對初始資金的貢獻 (%)、交易次數與勝率 (DataFrame，索引為策略名稱)。"""
+    weights = normalize_weights(sleeves)
+    profit = result.combined.trades['profit']
+    rows = []
+    for j, s in enumerate(sleeves):
+        mine = profit[result.trade_sleeve == j]
+        final = float(result.sleeve_pnl[-1, j]) if len(result.sleeve_pnl) else 0.0
+        rows.append({'策略': sleeve_label(s, j), '權重 (%)': weights[j] * 100, '累積損益 (元)': final,
+                     '報酬貢獻 (%)': final / start_capital * 100, '交易次數': len(mine),
+                     '勝率 (%)': float((mine > 0).mean() * 100) if len(mine) else 0.0})
+    return pd.DataFrame(rows).set_index('策略')
+
+
+def sleeve_correlation(result, sleeves):
+    """各策略每日損益的相關係數矩陣 (含未實現損益；某策略全程無損益變化時該列為 NaN)。"""
+    labels = [sleeve_label(s, j) for j, s in enumerate(sleeves)]
+    daily = np.diff(result.sleeve_pnl, axis=0)
+    return pd.DataFrame(daily, columns=labels).corr()
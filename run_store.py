@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from backtest_core import EXECUTION_DEFAULTS, BacktestParams
+
+# 執行紀錄資料庫 (與程式同目錄)
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_history.sqlite3')
+# 資金曲線壓縮後保留的點數
+EQUITY_POINTS = 250
+
+# 摘要指標欄位 (與 BacktestResult.metrics() 對應)；最大回撤率越小越好
+METRICS = ('final_capital', 'total_return', 'sharpe', 'max_drawdown', 'n_trades', 'win_rate')
+LOWER_IS_BETTER = {'max_drawdown'}
+METRIC_LABELS = {
+    'sharpe': '夏普值', 'total_return': '累積報酬率 (%)', 'max_drawdown': '最大回撤率 (%)',
+    'win_rate': '勝率 (%)', 'final_capital': '最終資金', 'n_trades': '交易次數',
+}
+PARAM_COLUMNS = BacktestParams._fields
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    run_key TEXT NOT NULL UNIQUE,
+    created REAL NOT NULL,
+    source TEXT NOT NULL,
+    data_fp TEXT NOT NULL,
+    start_date TEXT,
+    end_date TEXT,
+    signal_kind TEXT,
+    signal_kw TEXT,
+    ma_days INTEGER,
+    {', '.join(PARAM_COLUMNS)},
+    {', '.join(f"{m} {'INTEGER' if m == 'n_trades' else 'REAL'}" for m in METRICS)},
+    equity BLOB
+);
+CREATE INDEX IF NOT EXISTS idx_runs_config ON runs (data_fp, signal_kind, ma_days);
+CREATE INDEX IF NOT EXISTS idx_runs_period ON runs (start_date, end_date);
+CREATE INDEX IF NOT EXISTS idx_runs_params ON runs (strategy_mode, signal_kind, ma_days);
+CREATE INDEX IF NOT EXISTS idx_runs_sharpe ON runs (sharpe);
+CREATE INDEX IF NOT EXISTS idx_runs_return ON runs (total_return);
+CREATE INDEX IF NOT EXISTS idx_runs_mdd ON runs (max_drawdown);
+"""
+
+
+# ====================================
+# 鍵值與資金曲線壓縮
+# ====================================
+def run_key(data_fp, signal_kind, signal_kw, ma_days, params):
+    """一組回測設定的唯一鍵值 (資料指紋 + 訊號 + 均線天數 + 回測參數)。"""
+    config = (data_fp, signal_kind, tuple(sorted((signal_kw or {}).items())), int(ma_days), _params_key(params))
+    return hashlib.blake2b(repr(config).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _params_key(params):
+    """鍵值中的回測參數；執行模型欄位為預設值時不納入，加入執行模型前的紀錄鍵值不變。"""
+    base = tuple(params)[:len(params) - len(EXECUTION_DEFAULTS)]
+    extra = tuple((k, getattr(params, k)) for k, v in EXECUTION_DEFAULTS.items() if getattr(params, k) != v)
+    return base + extra if extra else base
+
+
+def compact_equity(dates, capital, points=EQUITY_POINTS):
+    """將資金曲線等距取樣為至多 points 點 (含首尾)，以 float32 + zlib 壓縮。"""
+    n = len(capital)
+    if n == 0:
+        return None
+    idx = np.unique(np.linspace(0, n - 1, min(points, n)).round().astype('int64'))
+    days = np.asarray(dates)[idx].astype('datetime64[D]').astype('int32')
+    values = np.asarray(capital)[idx].astype('float32')
+    return zlib.compress(days.tobytes() + values.tobytes())
+
+
+def expand_equity(blob):
+    """還原 compact_equity 的結果，回傳 (日期 datetime64[D], 資金 float32)。"""
+    raw = np.frombuffer(zlib.decompress(blob), dtype='uint8')
+    half = len(raw) // 2
+    days = raw[:half].view('int32').astype('datetime64[D]')
+    return days, raw[half:].view('float32')
+
+
+def make_row(source, data_fp, dates, signal_kind, signal_kw, ma_days, params, metrics, equity=None):
+    """組成一筆執行紀錄。"""
+    row = {
+        'run_key': run_key(data_fp, signal_kind, signal_kw, ma_days, params),
+        'created': time.time(),
+        'source': source,
+        'data_fp': data_fp,
+        'start_date': str(np.datetime64(dates[0], 'D')) if len(dates) else None,
+        'end_date': str(np.datetime64(dates[-1], 'D')) if len(dates) else None,
+        'signal_kind': signal_kind,
+        'signal_kw': json.dumps(dict(sorted((signal_kw or {}).items()))),
+        'ma_days': int(ma_days),
+        'equity': equity,
+    }
+    row.update(params._asdict())
+    row.update({m: metrics[m] for m in METRICS})
+    return row
+
+
+# ====================================
+# SQLite 執行紀錄
+# ====================================
+class RunStore:
+    """本機執行紀錄：每個執行緒使用自己的連線，寫入以交易批次提交。"""
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            # WAL：讀取不會被寫入阻擋 (多個 session 同時查詢)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            # 舊版資料庫缺少後來新增的參數欄位時補上
+            existing = {row[1] for row in conn.execute('PRAGMA table_info(runs)')}
+            for column in PARAM_COLUMNS:
+                if column not in existing:
+                    conn.execute(f'ALTER TABLE runs ADD COLUMN {column}')
+            self._local.conn = conn
+        return conn
+
+    def record(self, rows):
+        """寫入 (或覆蓋同鍵的) 執行紀錄；寫入失敗時回傳 False，不影響回測本身。"""
+        if not rows:
+            return True
+        columns = list(rows[0])
+        sql = (f"INSERT OR REPLACE INTO runs ({', '.join(columns)}) "
+               f"VALUES ({', '.join('?' for _ in columns)})")
+        try:
+            conn = self._conn()
+            with conn:
+                conn.executemany(sql, [[row[c] for c in columns] for row in rows])
+        except sqlite3.Error:
+            return False
+        return True
+
+    def lookup(self, keys):
+        """依鍵值取回已計算過的摘要指標，回傳 {run_key: {指標: 值}}。"""
+        keys = list(keys)
+        found = {}
+        try:
+            conn = self._conn()
+            # SQLite 單一查詢的參數數量有上限，分批查詢
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT run_key, {', '.join(METRICS)} FROM runs WHERE run_key IN ({', '.join('?' for _ in part)})",
+                    part).fetchall()
+                for r in rows:
+                    found[r['run_key']] = {m: r[m] for m in METRICS}
+        except sqlite3.Error:
+            return {}
+        return found
+
+    def best(self, metric='sharpe', start_date=None, end_date=None, signal_kind=None,
+             strategy_mode=None, limit=20):
+        """依指標排序的最佳紀錄；start_date/end_date 篩選回測期間落在區間內的紀錄。"""
+        if metric not in METRICS:
+            raise ValueError(f"未知的指標：{metric}")
+        where, args = [], []
+        if start_date is not None:
+            where.append('start_date >= ?')
+            args.append(str(start_date))
+        if end_date is not None:
+            where.append('end_date <= ?')
+            args.append(str(end_date))
+        if signal_kind is not None:
+            where.append('signal_kind = ?')
+            args.append(signal_kind)
+        if strategy_mode is not None:
+            where.append('strategy_mode = ?')
+            args.append(strategy_mode)
+        order = 'ASC' if metric in LOWER_IS_BETTER else 'DESC'
+        sql = (f"SELECT id, created, source, start_date, end_date, signal_kind, signal_kw, ma_days, "
+               f"strategy_mode, {', '.join(METRICS)} FROM runs "
+               f"{'WHERE ' + ' AND '.join(where) if where else ''} "
+               f"ORDER BY {metric} {order} LIMIT ?")
+        return self._frame(sql, args + [int(limit)])
+
+    def recent(self, limit=20):
+        """最近的執行紀錄。"""
+        return self._frame(
+            f"SELECT id, created, source, start_date, end_date, signal_kind, signal_kw, ma_days, "
+            f"strategy_mode, {', '.join(METRICS)} FROM runs ORDER BY created DESC LIMIT ?", [int(limit)])
+
+    def equity(self, run_id):
+        """取回某筆紀錄的壓縮資金曲線，回傳 (日期, 資金)；沒有時回傳 None。"""
+        row = self._conn().execute('SELECT equity FROM runs WHERE id = ?', (int(run_id),)).fetchone()
+        if row is None or row['equity'] is None:
+            return None
+        return expand_equity(row['equity'])
+
+    def _frame(self, sql, args):
+        try:
+            rows = self._conn().execute(sql, args).fetchall()
+        except sqlite3.Error:
+            return pd.DataFrame()
+        df = pd.DataFrame([dict(r) for r in rows])
+        if not df.empty:
+            df['created'] = pd.to_datetime(df['created'], unit='s')
+        return df
+
+
+run_store = RunStore()
@@ -0,0 +1,275 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+
+# ====================================
+# 搜尋空間
+# ====================================
+
+
+class IntRange:
+    """整數參數 [low, high] (含兩端)。"""
+
+    __slots__ = ('name', 'low', 'high')
+
+    def __init__(self, name, low, high):
+        self.name, self.low, self.high = name, int(low), int(high)
+
+    def sample(self, rng, n):
+        return rng.integers(self.low, self.high + 1, size=n).tolist()
+
+    def encode(self, values):
+        span = max(self.high - self.low, 1)
+        return ((np.asarray(values, dtype='float64') - self.low) / span)[:, None]
+
+
+class FloatRange:
+    """實數參數 [low, high]；step 不為 None 時取到 step 的倍數 (與側邊欄的步進一致)。"""
+
+    __slots__ = ('name', 'low', 'high', 'step')
+
+    def __init__(self, name, low, high, step=None):
+        self.name, self.low, self.high, self.step = name, float(low), float(high), step
+
+    def sample(self, rng, n):
+        values = rng.uniform(self.low, self.high, size=n)
+        if self.step:
+            values = np.clip(np.round(values / self.step) * self.step, self.low, self.high)
+        return [round(float(v), 10) for v in values]
+
+    def encode(self, values):
+        span = max(self.high - self.low, 1e-12)
+        return ((np.asarray(values, dtype='float64') - self.low) / span)[:, None]
+
+
+class Choice:
+    """類別參數 (例如訊號類型)，以 one-hot 編碼給代理模型。"""
+
+    __slots__ = ('name', 'options')
+
+    def __init__(self, name, options):
+        self.name, self.options = name, list(options)
+
+    def sample(self, rng, n):
+        return [self.options[i] for i in rng.integers(0, len(self.options), size=n)]
+
+    def encode(self, values):
+        index = {opt: i for i, opt in enumerate(self.options)}
+        out = np.zeros((len(values), len(self.options)))
+        out[np.arange(len(values)), [index[v] for v in values]] = 1.0
+        return out
+
+
+def sample_configs(space, rng, n, unique=False):
+    """從搜尋空間隨機抽樣 n 組設定 (dict)；unique=True 時去除重複 (空間太小時可能少於 n 組)。"""
+    if not unique:
+        columns = {dim.name: dim.sample(rng, n) for dim in space}
+        return [{name: columns[name][i] for name in columns} for i in range(n)]
+    configs, seen = [], set()
+    for config in sample_configs(space, rng, n * 4):
+        key = config_key(config)
+        if key not in seen:
+            seen.add(key)
+            configs.append(config)
+            if len(configs) == n:
+                break
+    return configs
+
+
+def encode_configs(space, configs):
+    """將設定轉成 [0, 1] 區間的特徵矩陣。"""
+    return np.hstack([dim.encode([c[dim.name] for c in configs]) for dim in space])
+
+
+def config_key(config):
+    return tuple(sorted(config.items()))
+
+
+# 搜尋結果：最佳設定、最佳目標值、評估紀錄 [(設定, 資料區間比例, 目標值), ...]
+SearchResult = namedtuple('SearchResult', ['best_config', 'best_score', 'history'])
+
+
+def best_of(history):
+    """從評估紀錄中選出最佳設定 (優先採用以完整資料區間評估的結果)。"""
+    history = list(history)
+    full = [h for h in history if h[1] >= 1.0] or history
+    config, _, score = max(full, key=lambda h: h[2])
+    return SearchResult(config, score, history)
+
+
+# ====================================
+# 搜尋策略 (ask / tell 介面：每次 ask 取得一個待評估的 (設定, 資料區間比例)，評估後以 tell 回報)
+# ====================================
+class SuccessiveHalving:
+    """逐步減半：先以短區間評估大量設定，每一輪保留前 1/eta，並將資料區間放大 eta 倍，最後一輪為完整區間。
+
+    budget 為評估次數上限；min_fraction 為第一輪的最短資料區間比例。
+    """
+
+    def __init__(self, space, budget, seed=0, eta=3, min_fraction=0.25):
+        self.space = space
+        self.eta = eta
+        self.rng = np.random.default_rng(seed)
+        self.pending = sample_configs(space, self.rng, self._plan(budget, eta), unique=True)
+        n0 = len(self.pending)
+        self.rounds = rounds = self._rounds(n0, eta)
+        # 各輪的資料區間比例：最後一輪為 1，往前每輪除以 eta (不低於 min_fraction)
+        self.fractions = [max(min_fraction, eta ** (k - rounds + 1)) for k in range(rounds)]
+        self.total = sum(max(1, n0 // eta ** k) for k in range(rounds))
+        self.round = 0
+        self.scores = []
+        self.history = []
+
+    @staticmethod
+    def _rounds(n0, eta):
+        """每輪保留 1/eta，直到只剩不到 eta 組設定為止的輪數。"""
+        rounds = 1
+        while n0 // eta ** rounds >= 1:
+            rounds += 1
+        return rounds
+
+    @classmethod
+    def _plan(cls, budget, eta):
+        """在評估次數上限內，找出最多的初始設定數。"""
+        n0 = 1
+        while sum(max(1, (n0 + 1) // eta ** k) for k in range(cls._rounds(n0 + 1, eta))) <= budget:
+            n0 += 1
+        return n0
+
+    @property
+    def done(self):
+        return self.round >= self.rounds
+
+    def ask(self):
+        return self.pending[len(self.scores)], self.fractions[self.round]
+
+    def tell(self, score):
+        config, fraction = self.ask()
+        score = float(score) if score is not None and np.isfinite(score) else -np.inf
+        self.scores.append(score)
+        self.history.append((config, fraction, score))
+        if len(self.scores) == len(self.pending):
+            # 本輪結束：保留分數最高的前 1/eta 進入下一輪 (同分時依抽樣順序，結果可重現)
+            self.round += 1
+            keep = max(1, len(self.pending) // self.eta)
+            order = np.argsort(-np.asarray(self.scores), kind='stable')[:keep]
+            self.pending = [self.pending[i] for i in order]
+            self.scores = []
+
+    def result(self):
+        return best_of(self.history)
+
+
+class BayesianSearch:
+    """代理模型搜尋：以高斯過程擬合已評估的設定，下一個評估點取期望改善 (EI) 最大的候選設定。
+
+    前 n_init 次為隨機抽樣；每次從 n_candidates 個隨機候選中挑選。
+    代理模型只以分數最高的 top_k 筆加上最近的 recent 筆評估擬合，每次提案的成本不隨評估次數增加
+    (完整歷史的 Cholesky 分解為 O(n³))。
+    """
+
+    def __init__(self, space, budget, seed=0, n_init=None, n_candidates=512, length_scale=0.2,
+                 top_k=100, recent=100):
+        self.space = space
+        self.total = int(budget)
+        self.rng = np.random.default_rng(seed)
+        self.n_init = n_init or min(self.total, max(5, self.total // 5))
+        self.n_candidates = n_candidates
+        self.length_scale = length_scale
+        self.top_k = top_k
+        self.recent = recent
+        self.history = []
+        self._next = None
+
+    @property
+    def done(self):
+        return len(self.history) >= self.total
+
+    def ask(self):
+        if self._next is None:
+            self._next = self._propose()
+        return self._next, 1.0
+
+    def tell(self, score):
+        config, fraction = self.ask()
+        score = float(score) if score is not None and np.isfinite(score) else -np.inf
+        self.history.append((config, fraction, score))
+        self._next = None
+
+    def _propose(self):
+        seen = {config_key(c) for c, _, _ in self.history}
+        if len(self.history) < self.n_init:
+            for _ in range(100):
+                config = sample_configs(self.space, self.rng, 1)[0]
+                if config_key(config) not in seen:
+                    return config
+            return config
+        candidates = [c for c in sample_configs(self.space, self.rng, self.n_candidates)
+                      if config_key(c) not in seen]
+        if not candidates:
+            return sample_configs(self.space, self.rng, 1)[0]
+        try:
+            ei = self._expected_improvement(candidates)
+        except np.linalg.LinAlgError:
+            # 核矩陣數值不穩定時退回隨機抽樣
+            return candidates[0]
+        return candidates[int(np.argmax(ei))]
+
+    def _fit_points(self):
+        """擬合代理模型用的評估紀錄：分數最高的 top_k 筆與最近的 recent 筆 (依評估順序)。"""
+        n = len(self.history)
+        if n <= self.top_k + self.recent:
+            return self.history
+        scores = np.array([s for _, _, s in self.history])
+        best = np.argsort(-scores, kind='stable')[:self.top_k]
+        keep = sorted(set(best.tolist()) | set(range(n - self.recent, n)))
+        return [self.history[i] for i in keep]
+
+    def _expected_improvement(self, candidates):
+        points = self._fit_points()
+        configs = [c for c, _, _ in points]
+        y = np.array([s for _, _, s in points])
+        finite = np.isfinite(y)
+        # 失敗的評估以目前最差值代替，避免代理模型再往該處搜尋
+        y = np.where(finite, y, y[finite].min() if finite.any() else 0.0)
+        mu_y, sd_y = y.mean(), y.std() or 1.0
+        y = (y - mu_y) / sd_y
+
+        X = encode_configs(self.space, configs)
+        Xc = encode_configs(self.space, candidates)
+        K = self._kernel(X, X) + 1e-6 * np.eye(len(X))
+        L = np.linalg.cholesky(K)
+        alpha = np.linalg.solve(L.T, np.linalg.solve(L, y))
+        Ks = self._kernel(Xc, X)
+        mean = Ks @ alpha
+        v = np.linalg.solve(L, Ks.T)
+        std = np.sqrt(np.clip(1.0 - np.sum(v ** 2, axis=0), 1e-12, None))
+
+        z = (mean - y.max()) / std
+        cdf = 0.5 * (1 + _erf(z / math.sqrt(2)))
+        pdf = np.exp(-0.5 * z ** 2) / math.sqrt(2 * math.pi)
+        return (mean - y.max()) * cdf + std * pdf
+
+    def _kernel(self, A, B):
+        d2 = np.sum(A ** 2, axis=1)[:, None] + np.sum(B ** 2, axis=1)[None, :] - 2 * A @ B.T
+        return np.exp(-0.5 * np.clip(d2, 0, None) / self.length_scale ** 2)
+
+    def result(self):
+        return best_of(self.history)
+
+
+def _erf(x):
+    """誤差函數的向量化近似 (Abramowitz-Stegun 7.1.26，誤差 < 1.5e-7)；避免依賴 SciPy。"""
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return sign * (1 - poly * np.exp(-x * x))
+
+
+# 搜尋方法註冊表：key -> (顯示名稱, 類別)
+SEARCH_METHODS = {
+    'halving': ('逐步減半 (Successive Halving)', SuccessiveHalving),
+    'bayes': ('貝氏搜尋 (Bayesian)', BayesianSearch),
+}
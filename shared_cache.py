@@ -0,0 +1,143 @@
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from telemetry import telemetry
+
+# ====================================
+# 程序層級共享快取 (所有 Streamlit session 共用)
+# ====================================
+
+
+def estimate_nbytes(value):
+    """估算快取值佔用的記憶體 (只計算主要的陣列內容)。"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=False).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=False))
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(v) for v in value) + sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(v) for v in value.values()) + sys.getsizeof(value)
+    slots = getattr(type(value), '__slots__', None)
+    if slots:
+        return sum(estimate_nbytes(getattr(value, name, None)) for name in slots)
+    return sys.getsizeof(value)
+
+
+class _Flight:
+    """進行中的計算：同鍵的其他請求等待這一次的結果。"""
+
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SharedCache:
+    """執行緒安全的 LRU 快取，依估算位元組數淘汰，並對同鍵請求做 single-flight 去重。"""
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()     # key -> (value, nbytes)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.waits += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = compute()
+        except BaseException as e:
+            # 失敗不快取，等待中的請求一併收到同一個例外
+            flight.error = e
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+            raise
+
+        flight.value = value
+        self._store(key, value)
+        flight.done.set()
+        return value
+
+    def _store(self, key, value):
+        size = estimate_nbytes(value)
+        with self._lock:
+            del self._flights[key]
+            # 單一值超過上限時不快取
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, old_size) = self._items.popitem(last=False)
+                self.nbytes -= old_size
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'name': self.name, 'entries': len(self._items), 'nbytes': self.nbytes,
+                    'hits': self.hits, 'misses': self.misses, 'waits': self.waits}
+
+
+# 各類快取的記憶體上限
+data_cache = SharedCache('data', max_bytes=256 * 1024 ** 2)
+indicator_cache = SharedCache('indicators', max_bytes=256 * 1024 ** 2)
+result_cache = SharedCache('results', max_bytes=512 * 1024 ** 2)
+
+
+@telemetry.register_collector
+def _cache_metrics():
+    # 匯出遙測時讀取各快取的命中數、命中率與佔用記憶體
+    out = []
+    for cache in (data_cache, indicator_cache, result_cache):
+        s = cache.stats()
+        lookups = s['hits'] + s['misses'] + s['waits']
+        labels = {'cache': s['name']}
+        out += [('cache_hits', labels, s['hits']), ('cache_misses', labels, s['misses']),
+                ('cache_waits', labels, s['waits']), ('cache_bytes', labels, s['nbytes']),
+                ('cache_entries', labels, s['entries']),
+                ('cache_hit_ratio', labels, (s['hits'] + s['waits']) / lookups if lookups else 0.0)]
+    return out
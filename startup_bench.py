@@ -0,0 +1,107 @@
+"""App 啟動時間量測：以全新的 Python 程序執行 app6.py 模組層級的 import，檢查耗時與延遲載入的模組。
+
+    python startup_bench.py              # 量測 5 次取中位數，超過預算或載入了延遲模組時回傳非 0
+    python startup_bench.py --importtime # 另列出 -X importtime 中累計耗時最高的模組
+"""
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(ROOT, 'app6.py')
+
+# 啟動預算 (秒)：新程序執行 app6.py 全部模組層級 import 的時間 (中位數)
+STARTUP_BUDGET_SECONDS = 2.5
+
+# 啟動時不應載入的模組 (只在用到的卡片或第一次回測時才載入)
+DEFERRED_MODULES = (
+    'numba', 'matplotlib', 'sqlite3', 'http.server', 'multiprocessing.shared_memory',
+    'concurrent.futures.process', 'parallel_sweep', 'job_queue', 'run_store', 'search', 'stress',
+    'portfolio', 'bootstrap',
+)
+
+_CHILD = """
+import json, sys, time
+t0 = time.perf_counter()
+{imports}
+seconds = time.perf_counter() - t0
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def app_imports(path=APP):
+    """app6.py 模組層級的 import 敘述 (卡片內的延遲 import 不包含在內)。"""
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+    tree = ast.parse(source)
+    return [ast.get_source_segment(source, node) for node in tree.body
+            if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+
+def _child_env():
+    env = dict(os.environ)
+    # 量測時不啟動遙測端點、不寫遙測檔案
+    env.pop('TELEMETRY_PORT', None)
+    env.pop('TELEMETRY_LOG', None)
+    return env
+
+
+def measure_once(imports):
+    """執行一次，回傳 (import 耗時, 程序總耗時, 已載入的延遲模組)。"""
+    code = _CHILD.format(imports='\n'.join(imports), deferred=DEFERRED_MODULES)
+    t0 = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=_child_env(),
+                         capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - t0
+    data = json.loads(out.stdout.strip().splitlines()[-1])
+    return data['seconds'], wall, data['loaded']
+
+
+def importtime_top(imports, top=15):
+    """以 -X importtime 量測，回傳累計耗時最高的 [(秒, 模組), ...]。"""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', '\n'.join(imports)], cwd=ROOT,
+                         env=_child_env(), capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        # 格式：import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        rows.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET_SECONDS)
+    parser.add_argument('--importtime', action='store_true')
+    args = parser.parse_args(argv)
+
+    imports = app_imports()
+    samples = [measure_once(imports) for _ in range(args.runs)]
+    seconds = statistics.median(s for s, _, _ in samples)
+    wall = statistics.median(w for _, w, _ in samples)
+    loaded = sorted({m for _, _, found in samples for m in found})
+    print(f"import 耗時中位數：{seconds:.3f} 秒 (程序總耗時 {wall:.3f} 秒，共 {args.runs} 次)，預算 {args.budget:.2f} 秒")
+    if args.importtime:
+        for cumulative, name in importtime_top(imports):
+            print(f"  {cumulative:8.3f} 秒  {name}")
+
+    ok = True
+    if seconds > args.budget:
+        print("超過啟動時間預算")
+        ok = False
+    if loaded:
+        print(f"啟動時載入了應延遲的模組：{', '.join(loaded)}")
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
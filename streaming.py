@@ -0,0 +1,213 @@
+"""大型分 K 檔案的串流回測：逐段讀檔，記憶體只與每段的 K 棒數成正比。
+
+    python streaming.py bars.csv --equity equity.csv --trades trades.csv
+    python streaming.py bars.parquet --chunk-rows 200000 --days 60 --params '{"strategy_mode": "只做多"}'
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from backtest_core import (
+    DIRECTION_LABELS, MODE_CODES, NS_DTYPE, TRADE_COLUMNS, TRADE_DTYPE, BacktestResult,
+    assemble_trades, backtest_kernel, kernel_params, month_numbers, params_from_dict, roll_flags, trade_buffers,
+)
+from indicators import build_signal
+from telemetry import telemetry
+
+# 預設每段讀取的 K 棒數 (分 K 一年約 7 萬筆 * 多年份，記憶體只與此值成正比)
+DEFAULT_CHUNK_ROWS = 500_000
+
+# 串流模式支援的訊號與所需暖機筆數 (只支援有限視窗的訊號，跨段結果與一次算完相同)
+STREAM_WARMUP = {
+    'sma': lambda days, kw: days - 1,
+    'band': lambda days, kw: days - 1,
+    'cross': lambda days, kw: max(days, kw.get('slow_days', 60)) - 1,
+}
+
+
+# ====================================
+# 分段讀取 CSV / Parquet
+# ====================================
+def iter_price_chunks(path, chunk_rows=DEFAULT_CHUNK_ROWS, date_col=0, close_col=1):
+    """逐段讀取 (日期, 收盤價)，每段回傳 (datetime64[ns] 陣列, float64 陣列)。
+
+    date_col/close_col 可為欄位名稱或位置；Parquet 需安裝 pyarrow，並以 memory map 讀取。
+    """
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext in ('.parquet', '.pq'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("讀取 Parquet 需要安裝 pyarrow (pip install pyarrow)") from e
+        pf = pq.ParquetFile(path, memory_map=True)
+        names = pf.schema_arrow.names
+        cols = [names[c] if isinstance(c, int) else c for c in (date_col, close_col)]
+        for batch in pf.iter_batches(batch_size=chunk_rows, columns=cols):
+            frame = batch.to_pandas()
+            yield (pd.to_datetime(frame[cols[0]]).to_numpy(dtype=NS_DTYPE),
+                   frame[cols[1]].to_numpy(dtype='float64'))
+    else:
+        reader = pd.read_csv(path, usecols=[date_col, close_col], chunksize=chunk_rows, memory_map=True)
+        for frame in reader:
+            if isinstance(date_col, int):
+                # usecols 以檔案中的欄位順序回傳
+                d, c = (frame.iloc[:, 0], frame.iloc[:, 1]) if date_col < close_col else (frame.iloc[:, 1], frame.iloc[:, 0])
+            else:
+                d, c = frame[date_col], frame[close_col]
+            yield pd.to_datetime(d).to_numpy(dtype=NS_DTYPE), c.to_numpy(dtype='float64')
+
+
+# ====================================
+# 串流回測：跨段保留均線視窗與部位狀態
+# ====================================
+class StreamingBacktest:
+    """逐段餵入 K 棒的回測；每段輸出該段的資金曲線與已平倉交易 (BacktestResult)。"""
+
+    def __init__(self, params, signal_kind='sma', days=13, signal_kw=None):
+        if signal_kind not in STREAM_WARMUP:
+            raise ValueError(f"串流模式不支援訊號類型：{signal_kind}")
+        if (signal_kw or {}).get('timeframe', 'D') != 'D' or (signal_kw or {}).get('trend_tf'):
+            raise ValueError("串流模式只支援日線訊號 (不支援多週期設定)")
+        if params.strategy_mode not in MODE_CODES:
+            raise ValueError(f"串流模式不支援策略模式：{params.strategy_mode}")
+        self.params = params
+        self.signal_kind = signal_kind
+        self.days = days
+        self.signal_kw = signal_kw or {}
+        self.warmup = STREAM_WARMUP[signal_kind](days, self.signal_kw)
+        self._kernel_params = kernel_params(params)
+        self._mode_code = MODE_CODES[params.strategy_mode]
+        # 跨段狀態
+        self.capital = float(params.start_capital)
+        self.holding = False
+        self.position = 0
+        self.entry_price = 0.0
+        self.entry_date = None
+        self.carry = 0.0    # 目前部位已支付的轉倉成本
+        self.bars = 0
+        self.n_trades = 0
+        self._tail_close = np.empty(0, dtype='float64')
+        self._last = None   # 上一段最後一根 K 棒 (日期, 收盤價, 訊號, 月份)
+
+    def feed(self, dates, closes):
+        dates = np.asarray(dates, dtype=NS_DTYPE)
+        closes = np.asarray(closes, dtype='float64')
+        m = len(closes)
+        if m == 0:
+            return BacktestResult(dates, np.empty(0), closes, np.empty(0, dtype=TRADE_DTYPE))
+        if self._last is not None and dates[0] < self._last[0]:
+            raise ValueError("K 棒資料需依時間遞增排序")
+
+        # 訊號：以上一段尾端的收盤價作為暖機，計算後只取本段
+        window = np.concatenate([self._tail_close, closes])
+        signal = build_signal(self.signal_kind, window, None, self.days, **self.signal_kw)[-m:]
+        months = month_numbers(dates)
+
+        # 以上一段最後一根 K 棒作為第 0 筆 (只提供月份與前日狀態)
+        first = self._last is None
+        if first:
+            k_dates, k_close, k_signal, k_months = dates, closes, signal, months
+            carried = None
+        else:
+            ld, lc, ls, lm = self._last
+            k_dates = np.concatenate([[ld], dates])
+            k_close = np.concatenate([[lc], closes])
+            k_signal = np.concatenate([[ls], signal])
+            k_months = np.concatenate([[lm], months])
+            carried = (self.entry_date, self.entry_price) if self.holding else None
+
+        capital_out = np.empty(len(k_close), dtype='float64')
+        buffers = trade_buffers(len(k_close))
+        # 部位若在本段之前建立，進場索引以 -1 表示
+        (n_trades, self.capital, self.holding, self.position, self.entry_price, entry_idx,
+         self.carry) = backtest_kernel(
+            k_months, k_close, k_signal, roll_flags(k_dates, self.params), self._mode_code, *self._kernel_params,
+            self.capital, self.holding, self.position, self.entry_price, -1, self.carry,
+            capital_out, *buffers)
+        trades = assemble_trades(k_dates, k_close, n_trades, buffers, carried)
+        if self.holding and entry_idx >= 0:
+            self.entry_date = k_dates[entry_idx]
+
+        # 更新跨段狀態
+        # 複製尾端，避免保留整段資料的參照
+        self._tail_close = window[-self.warmup:].copy() if self.warmup > 0 else np.empty(0, dtype='float64')
+        self._last = (dates[-1], closes[-1], signal[-1], months[-1])
+        self.bars += m
+        self.n_trades += n_trades
+
+        out_capital = capital_out if first else capital_out[1:]
+        chunk = BacktestResult(dates, out_capital, closes, trades)
+        chunk.holding = self.holding
+        if self.holding:
+            chunk.position = DIRECTION_LABELS[self.position]
+            chunk.entry_price = self.entry_price
+            chunk.entry_date = pd.Timestamp(self.entry_date)
+        return chunk
+
+
+def stream_backtest(path, params, signal_kind='sma', days=13, signal_kw=None,
+                    chunk_rows=DEFAULT_CHUNK_ROWS, date_col=0, close_col=1):
+    """逐段讀檔並回測，逐段產出 BacktestResult；記憶體只與 chunk_rows 成正比。"""
+    bt = StreamingBacktest(params, signal_kind, days, signal_kw)
+    for dates, closes in iter_price_chunks(path, chunk_rows, date_col, close_col):
+        with telemetry.timed('stream_chunk', rows=len(closes)):
+            chunk = bt.feed(dates, closes)
+        yield chunk
+
+
+def stream_backtest_to_csv(path, params, equity_path, trades_path, **kwargs):
+    """串流回測並將資金曲線與交易明細逐段附加寫入 CSV，回傳 (最終資金, 總 K 棒數, 總交易數)。"""
+    bars = trades = 0
+    capital = float(params.start_capital)
+    for i, chunk in enumerate(stream_backtest(path, params, **kwargs)):
+        mode, header = ('w', True) if i == 0 else ('a', False)
+        chunk.capital_frame().to_csv(equity_path, mode=mode, header=header, index=False)
+        chunk.trades_frame().reindex(columns=list(TRADE_COLUMNS.values())).to_csv(
+            trades_path, mode=mode, header=header, index=False)
+        bars += len(chunk)
+        trades += len(chunk.trades)
+        if len(chunk):
+            capital = chunk.final_capital
+    return capital, bars, trades
+
+
+# ====================================
+# 命令列
+# ====================================
+def _column(value):
+    """欄位參數：數字視為欄位位置，其餘為欄位名稱。"""
+    return int(value) if value.isdigit() else value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="K 棒檔 (.csv / .parquet)，需依時間遞增排序")
+    parser.add_argument('--equity', default='stream_equity.csv', help="資金曲線輸出 CSV")
+    parser.add_argument('--trades', default='stream_trades.csv', help="交易明細輸出 CSV")
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS, help="每段讀取的 K 棒數")
+    parser.add_argument('--date-col', type=_column, default=0, help="日期欄位 (名稱或位置)")
+    parser.add_argument('--close-col', type=_column, default=1, help="收盤價欄位 (名稱或位置)")
+    parser.add_argument('--signal', choices=list(STREAM_WARMUP), default='sma', help="訊號類型")
+    parser.add_argument('--days', type=int, default=13, help="均線長度 (K 棒數)")
+    parser.add_argument('--signal-kw', default='{}', help="訊號附加參數 (JSON，例如 {\"slow_days\": 60})")
+    parser.add_argument('--params', default='{}', help="回測參數 (JSON，BacktestParams 欄位)")
+    args = parser.parse_args(argv)
+
+    params = params_from_dict(json.loads(args.params))
+    t0 = time.perf_counter()
+    capital, bars, trades = stream_backtest_to_csv(
+        args.path, params, args.equity, args.trades, signal_kind=args.signal, days=args.days,
+        signal_kw=json.loads(args.signal_kw), chunk_rows=args.chunk_rows, date_col=args.date_col,
+        close_col=args.close_col)
+    print(f"{bars} 根 K 棒，{trades} 筆交易，最終資金 {capital:,.0f} 元，耗時 {time.perf_counter() - t0:.1f} 秒", file=sys.stderr)
+    print(f"資金曲線：{args.equity}，交易明細：{args.trades}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from backtest_core import NS_DTYPE, data_fingerprint, date_range_bounds, month_numbers, run_backtest
+from indicators import build_signal
+from parallel_sweep import _split, _unit_progress, auto_unit_size, get_backend, split_config
+from telemetry import telemetry
+
+# 壓力情境：歷史區間 (start/end) 或合成衝擊 (shock 為逐日報酬率，接在資料尾端)
+Scenario = namedtuple('Scenario', ['label', 'start', 'end', 'shock'])
+
+# 合成衝擊前保留的真實 K 棒數 (讓部位在衝擊發生時已依訊號建立)
+PRE_SHOCK_DAYS = 60
+
+
+def _geometric(total_pct, days):
+    """在 days 天內以固定日報酬率累計 total_pct (%) 的逐日報酬率。"""
+    return ((1 + total_pct / 100) ** (1 / days) - 1,) * days
+
+
+SCENARIOS = {
+    'gfc_2008': Scenario('2008 金融海嘯', '2008-05-01', '2009-03-31', None),
+    'crash_2015': Scenario('2015 股災', '2015-04-27', '2015-09-30', None),
+    'covid_2020': Scenario('2020 新冠疫情', '2020-01-13', '2020-04-30', None),
+    'bear_2022': Scenario('2022 升息空頭', '2022-01-03', '2022-10-31', None),
+    'gap_down': Scenario('合成：單日跳空 -10%', None, None, (-0.10,)),
+    'crash_week': Scenario('合成：5 日急跌 -20%', None, None, _geometric(-20, 5)),
+    'v_shape': Scenario('合成：V 型 10 日 -20% 後 10 日收復', None, None,
+                        _geometric(-20, 10) + _geometric(25, 10)),
+    'whipsaw': Scenario('合成：20 日 ±5% 來回震盪', None, None, (-0.05, 0.05) * 10),
+    'grind_down': Scenario('合成：60 日緩跌 -30%', None, None, _geometric(-30, 60)),
+}
+
+# 壓力指標 -> (中文名稱, 跨情境取最差值的函式)
+STRESS_METRICS = {
+    'total_return': ('累積報酬率 (%)', min),
+    'max_drawdown': ('最大回撤率 (%)', max),
+    'worst_day': ('最大單日跌幅 (%)', min),
+}
+
+
+# ====================================
+# 情境資料
+# ====================================
+def scenario_window(full_dates, full_closes, scenario, at=None):
+    """情境的 (日期, 收盤價, lo, hi)：回測區間為切片 [lo, hi)。
+
+    歷史情境直接以二分搜尋在完整歷史中切出區間；合成衝擊將報酬序列接在第 at 筆 (預設為資料尾端) 之後，
+    回測區間為衝擊前 PRE_SHOCK_DAYS 筆到衝擊結束。
+    """
+    if scenario.shock is None:
+        lo, hi = date_range_bounds(full_dates, scenario.start, scenario.end)
+        return full_dates, full_closes, lo, hi
+    at = len(full_closes) if at is None else at
+    shock = np.asarray(scenario.shock, dtype='float64')
+    closes = np.concatenate([full_closes[:at], full_closes[at - 1] * np.cumprod(1 + shock)])
+    # 衝擊期間的日期以下一個營業日遞延
+    last_day = full_dates[at - 1].astype('datetime64[D]')
+    shock_days = np.busday_offset(last_day, np.arange(1, len(shock) + 1), roll='forward')
+    dates = np.concatenate([full_dates[:at], shock_days.astype(NS_DTYPE)])
+    return dates, closes, max(0, at - PRE_SHOCK_DAYS), len(closes)
+
+
+def scenario_info(full_dates, full_closes, scenarios=None, at=None):
+    """各情境的區間、K 棒數與指數漲跌幅 (DataFrame，索引為情境名稱)。"""
+    rows = []
+    for key, sc in (scenarios or SCENARIOS).items():
+        dates, closes, lo, hi = scenario_window(full_dates, full_closes, sc, at)
+        if hi - lo < 2:
+            rows.append({'情境': sc.label, '開始': None, '結束': None, 'K 棒數': hi - lo, '指數漲跌幅 (%)': np.nan})
+            continue
+        rows.append({'情境': sc.label, '開始': pd.Timestamp(dates[lo]).date(), '結束': pd.Timestamp(dates[hi - 1]).date(),
+                     'K 棒數': hi - lo, '指數漲跌幅 (%)': (closes[hi - 1] / closes[lo] - 1) * 100})
+    return pd.DataFrame(rows).set_index('情境')
+
+
+# ====================================
+# 任務：一批參數組合 × 所有情境
+# ====================================
+def stress_task(full_dates, full_closes, fingerprint, params, signal_kind, scenarios, at, indexed_configs):
+    """回傳 [(組合序號, {情境: 摘要指標 或 None}), ...]。
+
+    歷史情境直接切用完整歷史上的訊號 (指標快取中與主回測、掃描共用，含正確的暖機)；
+    合成情境的價格序列每批只建立一次，訊號在接上衝擊的序列上計算，並以
+    (資料指紋, 情境, 接入位置, 衝擊序列) 作為指標快取的鍵值，跨批次與重跑共用。
+    """
+    windows = []
+    for key, sc in scenarios:
+        dates, closes, lo, hi = scenario_window(full_dates, full_closes, sc, at)
+        if sc.shock is None:
+            series_fp = fingerprint
+        else:
+            series_fp = f"{fingerprint}:{key}:{len(full_closes) if at is None else at}:{hash(tuple(sc.shock))}"
+        windows.append((key, series_fp, dates, closes, month_numbers(dates), lo, hi))
+    out = []
+    for idx, config in indexed_configs:
+        ma, kw, p = split_config(config, params)
+        row = {}
+        for key, series_fp, dates, closes, months, lo, hi in windows:
+            if hi - lo < 2:
+                row[key] = None
+                continue
+            try:
+                signal = build_signal(signal_kind, closes, series_fp, ma, dates, **kw)
+                result = run_backtest(dates[lo:hi], closes[lo:hi], signal[lo:hi], p, months[lo:hi])
+            except Exception:
+                row[key] = None
+                continue
+            summary = result.metrics(p.start_capital)
+            capital = result.capital
+            prev = capital[:-1].copy()
+            prev[prev == 0] = 1
+            summary['worst_day'] = float(min((np.diff(capital) / prev).min() * 100, 0.0))
+            row[key] = summary
+        out.append((idx, row))
+    return out
+
+
+def stress_sweep(dates, closes, configs, params, signal_kind='sma', scenarios=None, at=None,
+                 backend=None, progress=None, fingerprint=None):
+    """所有 (情境 × 參數組合) 的壓力測試，回傳與 configs 同順序的 [{情境: 摘要指標}, ...]。
+
+    dates/closes 為完整歷史；configs 格式同 robustness_sweep；at 為合成衝擊的接入位置 (預設資料尾端)；
+    fingerprint 為完整歷史的資料指紋 (未提供時計算一次)。
+    """
+    configs = list(configs)
+    total = len(configs)
+    if total == 0:
+        return []
+    backend = backend or get_backend()
+    scenarios = list((scenarios or SCENARIOS).items())
+    indexed = [(i, tuple(sorted(c.items()))) for i, c in enumerate(configs)]
+    t0 = time.perf_counter()
+    fingerprint = fingerprint or data_fingerprint(dates, closes)
+    first = stress_task(dates, closes, fingerprint, params, signal_kind, scenarios, at, indexed[:1])
+    size = auto_unit_size(total - 1, backend.workers, time.perf_counter() - t0)
+    units = [(params, signal_kind, scenarios, at, part) for part in _split(indexed[1:], size)]
+    rows = [None] * total
+    for idx, row in first:
+        rows[idx] = row
+    with telemetry.timed('stress_dispatch', rows=(total - 1) * len(scenarios), backend=backend.name, units=len(units)):
+        for part in backend.run(stress_task, dates, closes, units, _unit_progress(units, progress, total, 1),
+                                fingerprint):
+            for idx, row in part:
+                rows[idx] = row
+    return rows
+
+
+def worst_case_matrix(rows, labels, metric='total_return', scenarios=None):
+    """壓力測試結果 -> 矩陣 (列：參數組合，欄：情境)，並附上各組合的最差情境與最差值。"""
+    scenarios = scenarios or SCENARIOS
+    pick = np.nanargmin if STRESS_METRICS[metric][1] is min else np.nanargmax
+    names = [sc.label for sc in scenarios.values()]
+    values = np.array([[row[key][metric] if row and row.get(key) else np.nan for key in scenarios]
+                       for row in rows], dtype='float64').reshape(len(rows), len(names))
+    matrix = pd.DataFrame(values, index=pd.Index(labels, name='參數組合'), columns=names)
+    # 全部情境都無法回測的組合，最差值留空
+    valid = ~np.isnan(values).all(axis=1)
+    worst_idx = np.full(len(rows), -1)
+    worst_idx[valid] = [pick(v) for v in values[valid]]
+    matrix['最差情境'] = [names[i] if i >= 0 else None for i in worst_idx]
+    matrix['最差值'] = [values[r, i] if i >= 0 else np.nan for r, i in enumerate(worst_idx)]
+    return matrix
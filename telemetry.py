@@ -0,0 +1,210 @@
+import atexit
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows 沒有 resource 模組，峰值記憶體改以 0 表示
+    resource = None
+
+# 遙測輸出 (環境變數，皆為選用)：JSON lines 檔案路徑與 Prometheus 文字端點的埠號 (由 app6.py 啟動)
+LOG_ENV = 'TELEMETRY_LOG'
+PORT_ENV = 'TELEMETRY_PORT'
+# 延遲直方圖的桶界 (秒)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in key) + '}'
+
+
+def log_path_for_process(path):
+    """子程序 (程序池、Dask/Ray 工作程序) 各自寫入 <路徑>.<pid>，避免多個程序附加寫入同一個檔案。"""
+    if not path or mp.parent_process() is None:
+        return path
+    return f"{path}.{os.getpid()}"
+
+
+def peak_memory_bytes():
+    """目前程序的峰值常駐記憶體 (Linux 的 ru_maxrss 單位為 KB，macOS 為 bytes)。"""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, n_buckets):
+        self.counts = [0] * n_buckets
+        self.sum = 0.0
+        self.count = 0
+
+
+# ====================================
+# 遙測登錄器 (程序層級單例)
+# ====================================
+class Telemetry:
+    """計數器與延遲直方圖；每個階段事件另以 JSON lines 寫入檔案。"""
+
+    def __init__(self, log_path=None):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._counters = {}         # (名稱, 標籤) -> 值
+        self._histograms = {}       # (名稱, 標籤) -> _Histogram
+        self._collectors = []       # 匯出時才讀取的量測值：fn() -> [(名稱, 標籤 dict, 值), ...]
+        self._log_file = None
+
+    # ---- 量測 ----
+    def count(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = _Histogram(len(LATENCY_BUCKETS))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist.counts[i] += 1
+            hist.sum += seconds
+            hist.count += 1
+
+    def register_collector(self, fn):
+        """登錄匯出時才呼叫的量測函式 (例如快取命中數)。"""
+        self._collectors.append(fn)
+        return fn
+
+    @contextmanager
+    def timed(self, stage, rows=None, **labels):
+        """量測一個階段的耗時；可在 with 區塊內設定 event['rows'] 等欄位，一併寫入 JSON lines。"""
+        event = {'stage': stage, **labels}
+        if rows is not None:
+            event['rows'] = rows
+        t0 = time.perf_counter()
+        status = 'ok'
+        try:
+            yield event
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            seconds = time.perf_counter() - t0
+            self.observe('stage_seconds', seconds, stage=stage)
+            self.count('stage_runs_total', stage=stage, status=status)
+            rows = event.get('rows')
+            if rows:
+                self.count('rows_processed_total', rows, stage=stage)
+                event['rows_per_second'] = rows / seconds if seconds > 0 else None
+            event.update(ts=time.time(), seconds=seconds, status=status, peak_memory_bytes=peak_memory_bytes())
+            self.log(event)
+
+    # ---- JSON lines ----
+    def log(self, event):
+        if not self.log_path:
+            return
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            try:
+                if self._log_file is None:
+                    self._log_file = open(self.log_path, 'a', encoding='utf-8', buffering=1)
+                self._log_file.write(line + '\n')
+            except OSError:
+                # 寫入失敗不影響主流程；停用檔案輸出
+                self.log_path = None
+
+    def close(self):
+        with self._lock:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+
+    # ---- Prometheus 文字格式 ----
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (list(h.counts), h.sum, h.count) for k, h in self._histograms.items()}
+        gauges = [('process_peak_memory_bytes', {}, peak_memory_bytes())]
+        for fn in self._collectors:
+            try:
+                gauges.extend(fn())
+            except Exception:
+                continue
+
+        for name in sorted({n for n, _ in counters}):
+            lines.append(f'# TYPE backtest_{name} counter')
+            for (n, key), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f'backtest_{name}{_format_labels(key)} {value}')
+        for name in sorted({n for n, _ in histograms}):
+            lines.append(f'# TYPE backtest_{name} histogram')
+            for (n, key), (counts, total, count) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bound, c in zip(LATENCY_BUCKETS, counts):
+                    lines.append(f'backtest_{name}_bucket{_format_labels(key + (("le", str(bound)),))} {c}')
+                lines.append(f'backtest_{name}_bucket{_format_labels(key + (("le", "+Inf"),))} {count}')
+                lines.append(f'backtest_{name}_sum{_format_labels(key)} {total}')
+                lines.append(f'backtest_{name}_count{_format_labels(key)} {count}')
+        for name in sorted({g[0] for g in gauges}):
+            lines.append(f'# TYPE backtest_{name} gauge')
+            for n, labels, value in gauges:
+                if n == name:
+                    lines.append(f'backtest_{name}{_format_labels(_label_key(labels))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# ====================================
+# Prometheus 端點 (選用)
+# ====================================
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """在背景執行緒提供 /metrics (Prometheus 文字格式)；同一程序只啟動一次。"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    global _server
+    with _server_lock:
+        if _server is not None:
+            return _server
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = telemetry.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        _server = ThreadingHTTPServer((host, int(port)), Handler)
+        threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+        return _server
+
+
+telemetry = Telemetry(log_path_for_process(os.environ.get(LOG_ENV) or None))
+atexit.register(telemetry.close)